@@ -0,0 +1,70 @@
+# Compara estrategias de chunking sobre data/conocimiento.pdf:
+#   - cantidad de fragmentos (= puntos en Qdrant)
+#   - llamadas de embeddings que costaría la ingesta (con el batching de rag.make_batches)
+#   - hit rate@3 de recuperación sobre un set de preguntas con respuesta conocida
+#
+# Uso:  python benchmarks/bench_chunking.py [--dense] [--pdf data/conocimiento.pdf]
+# Sin --dense se mide con BM25 (offline). Con --dense usa embeddings reales (o OPENAI_BASE_URL)
+# y también reporta el modo híbrido (RRF).
+
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-offline")  # El cliente solo se usa con --dense
+
+import rag
+from chunking import CHUNKERS
+from prompting import count_tokens
+from lexical import BM25Index, rrf_fuse
+
+# (pregunta, texto que debe aparecer en alguno de los 3 fragmentos recuperados)
+EVAL_SET = [
+    ("¿Cuánto cuesta la instalación industrial?", "5,000"),
+    ("precio instalación residencial", "1,000"),
+    ("cuánto sale el mantenimiento", "$100"),
+    ("¿en qué horarios atienden?", "9:00"),
+    ("cuál es la misión de la empresa", "Proveer soluciones"),
+    ("qué hago en la fase qualifying", "Casa o Industria"),
+    ("qué pasa cuando el cliente da el correo", "confirmar cita"),
+    ("quiénes son SolarTech", "empresa ficticia"),
+]
+
+def hit_rate(results_per_query):
+    hits = sum(any(expected in r["text"] for r in results) for results, (_, expected) in zip(results_per_query, EVAL_SET))
+    return hits / len(EVAL_SET)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf", default="data/conocimiento.pdf")
+    parser.add_argument("--dense", action="store_true", help="Medir también recuperación densa e híbrida")
+    args = parser.parse_args()
+
+    query_vecs = None
+    if args.dense:
+        query_vecs = np.array(rag.embed_batch([q for q, _ in EVAL_SET]), dtype=np.float32)
+
+    print(f"{'estrategia':<10} {'fragmentos':>10} {'llamadas':>9} {'tokens/frag':>12} {'bm25@3':>7}"
+          + (f" {'denso@3':>8} {'híbrido@3':>10}" if args.dense else ""))
+    for name in CHUNKERS:
+        chunks = [{**c, "id": str(i)} for i, c in enumerate(rag.iter_pdf_chunks(args.pdf, name))]
+        calls = sum(1 for _ in rag.make_batches(chunks))
+        avg_tokens = np.mean([count_tokens(c["text"]) for c in chunks]) if chunks else 0
+
+        index = BM25Index(chunks)
+        lexical = [index.search(q, limit=10) for q, _ in EVAL_SET]
+        row = f"{name:<10} {len(chunks):>10} {calls:>9} {avg_tokens:>12.1f} {hit_rate([r[:3] for r in lexical]):>7.0%}"
+
+        if args.dense:
+            matrix = np.array(rag.embed_batch([c["text"] for c in chunks]), dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+            scores = query_vecs @ matrix.T
+            dense = [[chunks[i] for i in np.argsort(-s)[:10]] for s in scores]
+            hybrid = [rrf_fuse([d, l], limit=3) for d, l in zip(dense, lexical)]
+            row += f" {hit_rate([d[:3] for d in dense]):>8.0%} {hit_rate(hybrid):>10.0%}"
+        print(row)
+
+if __name__ == "__main__":
+    main()
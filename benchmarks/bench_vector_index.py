@@ -0,0 +1,100 @@
+# Compara los backends vectoriales (vector_store.py) sobre vectores sintéticos:
+#   - tiempo de carga (upsert de todo el corpus en tandas, dentro de un batch como en rag.sync_collection)
+#   - latencia de búsqueda p50 / p95 (top-3, una consulta a la vez, como en el webhook)
+#   - memoria de los vectores en RAM
+#   - pico de memoria temporal por consulta (tracemalloc; NumPy reporta sus buffers)
+#   - recall@3 contra la búsqueda exacta en float32
+#
+# Uso:  python benchmarks/bench_vector_index.py [--n 20000] [--queries 200] [--no-qdrant]
+# Los vectores se generan agrupados en "temas" (como los fragmentos de un manual),
+# que es el caso difícil para la cuantización: muchos vecinos casi empatados.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_store import NumpyStore, QdrantStore
+
+def synthetic(n, dim, topics, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(topics, dim)).astype(np.float32)
+    labels = rng.integers(0, topics, size=n)
+    vectors = centers[labels] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) * 1000
+
+def run(name, store, vectors, queries, truth, k):
+    points = [(i, vectors[i], {"source": "bench", "page": i}) for i in range(len(vectors))]
+    t0 = time.perf_counter()
+    with store.batch():
+        for start in range(0, len(points), 256):  # Mismo tamaño de tanda que UPSERT_BATCH_SIZE
+            store.upsert(points[start:start + 256])
+    build = time.perf_counter() - t0
+
+    store.search(queries[0], k)  # Calentamiento
+    latencies, recall = [], 0
+    for q, expected in zip(queries, truth):
+        t0 = time.perf_counter()
+        hits = store.search(q, k)
+        latencies.append(time.perf_counter() - t0)
+        recall += len({int(h["page"]) for h in hits} & expected) / k
+
+    # Pico de memoria por consulta, medido aparte (tracemalloc enlentece las búsquedas)
+    peaks = []
+    for q in queries[:20]:
+        tracemalloc.start()
+        store.search(q, k)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    memory = f"{store.memory_bytes() / 2**20:.1f}MB" if hasattr(store, "memory_bytes") else "-"
+    print(f"{name:<16} {build:>8.2f}s {percentile(latencies, 50):>8.2f}ms {percentile(latencies, 95):>8.2f}ms "
+          f"{memory:>11} {max(peaks) / 2**20:>10.1f}MB {recall / len(queries):>9.1%}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000, help="Cantidad de fragmentos")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--block", type=int, default=2048, help="Filas por bloque al puntuar (NUMPY_SCORE_BLOCK)")
+    parser.add_argument("--no-qdrant", action="store_true", help="No medir Qdrant en memoria")
+    args = parser.parse_args()
+
+    vectors = synthetic(args.n, args.dim, args.topics)
+    queries = synthetic(args.queries, args.dim, args.topics, seed=1)
+    exact = queries @ vectors.T
+    truth = [set(np.argsort(-row)[:args.k].tolist()) for row in exact]
+
+    print(f"{args.n} vectores de {args.dim} dims, {args.queries} consultas, top-{args.k}")
+    print(f"{'backend':<16} {'carga':>9} {'p50':>10} {'p95':>10} {'memoria':>11} {'pico/consulta':>12} {'recall@3':>10}")
+    for mode in ("none", "float16", "int8"):
+        run(f"numpy/{mode}", NumpyStore(args.dim, quantization=mode, oversample=args.oversample, block=args.block),
+            vectors, queries, truth, args.k)
+
+    # int8 con los float32 en disco (memmap): solo quedan en RAM los int8 + escalas
+    with tempfile.TemporaryDirectory() as path:
+        store = NumpyStore(args.dim, quantization="int8", path=path, oversample=args.oversample, block=args.block)
+        store.upsert([(i, vectors[i], {"source": "bench", "page": i}) for i in range(len(vectors))])
+        store.persist()
+        run("numpy/int8+mmap", NumpyStore(args.dim, quantization="int8", path=path, oversample=args.oversample, block=args.block),
+            np.zeros((0, args.dim), dtype=np.float32), queries, truth, args.k)
+
+    if not args.no_qdrant:
+        from qdrant_client import QdrantClient
+        store = QdrantStore(QdrantClient(":memory:"), "bench", args.dim)
+        store.ensure()
+        run("qdrant/:memory:", store, vectors, queries, truth, args.k)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Servidor falso de OpenAI para pruebas de carga sin red ni costo.
+# Implementa /v1/embeddings y /v1/chat/completions (normal y streaming) con:
+#   - latencia configurable (primer token + tokens/s) y jitter
+#   - vectores deterministas: bolsa de palabras con hashing, así textos parecidos
+#     dan vectores parecidos (el RAG y el router se comportan de forma razonable)
+#   - tool calls deterministas: un correo o "me llamo X" en el mensaje -> update_lead_info
+#   - errores 500 opcionales (--error-rate) para probar reintentos
+#
+# Uso:  python benchmarks/fake_openai.py --port 9000 --latency 0.8 --jitter 0.2
+#       OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake uvicorn main:app
+# GET /stats devuelve cuántas llamadas recibió (para comparar contra lo que reporta la app).
+
+import re
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+config = {"latency": 0.5, "jitter": 0.1, "embed_latency": 0.05, "tokens_per_sec": 80.0,
+          "tool_rate": 0.0, "error_rate": 0.0, "dim": 1536, "seed": 0}
+stats = {"chat": 0, "chat_stream": 0, "embeddings": 0, "embedded_texts": 0, "tool_calls": 0, "errors": 0}
+rng = random.Random(0)
+app = FastAPI()
+
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+NAME = re.compile(r"me llamo\s+(\w+)", re.IGNORECASE)
+_token_vectors = {}
+
+def token_vector(token):
+    vec = _token_vectors.get(token)
+    if vec is None:
+        seed = int(hashlib.md5(token.encode("utf-8")).hexdigest()[:8], 16)
+        vec = _token_vectors[token] = np.random.default_rng(seed).standard_normal(config["dim"]).astype(np.float32)
+    return vec
+
+def embed(text):
+    tokens = re.findall(r"\w+", text.casefold()) or ["<vacío>"]
+    vec = np.sum([token_vector(t) for t in tokens], axis=0)
+    return (vec / np.linalg.norm(vec)).tolist()
+
+def stable_fraction(text):
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+
+async def delay(base):
+    await asyncio.sleep(max(0.0, base + rng.uniform(-config["jitter"], config["jitter"])))
+
+def usage(messages, completion_tokens):
+    prompt_tokens = sum(len(str(m.get("content") or "")) // 4 for m in messages)
+    system = next((str(m.get("content") or "") for m in messages if m.get("role") == "system"), "")
+    cached = (len(system) // 4) // 128 * 128  # El proveedor cachea en bloques de 128 tokens
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": cached}}
+
+def reply_for(body):
+    # -> (texto, tool_calls)
+    messages = body["messages"]
+    last = messages[-1]
+    if last.get("role") == "tool":
+        return "Listo, ya quedó registrado. ¿Te ayudo con algo más?", []
+
+    text = str(last.get("content") or "")
+    system = next((str(m.get("content") or "") for m in messages if m.get("role") == "system"), "")
+    source = re.search(r"\[Fuente: ([^,]+), Pag: (\d+)\]", system)
+    answer = f"Respuesta simulada a: {text[:60]}"
+    if source: answer += f" (Fuente: Pag {source.group(2)})"
+
+    args = {}
+    if EMAIL.search(text): args["email"] = EMAIL.search(text).group(0)
+    if NAME.search(text): args["name"] = NAME.search(text).group(1).title()
+    if not args and stable_fraction(text) < config["tool_rate"]: args["stage"] = "interested"
+    if not args or not body.get("tools"):
+        return answer, []
+    call = {"id": "call_" + hashlib.md5(text.encode("utf-8")).hexdigest()[:12], "type": "function",
+            "function": {"name": "update_lead_info", "arguments": json.dumps(args)}}
+    return answer, [call]
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    stats["embeddings"] += 1
+    stats["embedded_texts"] += len(texts)
+    await delay(config["embed_latency"])
+    return {"object": "list", "model": body["model"],
+            "data": [{"object": "embedding", "index": i, "embedding": embed(t)} for i, t in enumerate(texts)],
+            "usage": {"prompt_tokens": sum(len(t) // 4 for t in texts), "total_tokens": sum(len(t) // 4 for t in texts)}}
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if rng.random() < config["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "fallo simulado", "type": "server_error"}})
+
+    text, tool_calls = reply_for(body)
+    stats["tool_calls"] += len(tool_calls)
+    words = text.split(" ")
+    base = {"id": "chatcmpl-fake", "created": 0, "model": body["model"]}
+
+    if body.get("stream"):
+        stats["chat_stream"] += 1
+        async def events():
+            await delay(config["latency"])
+            for i, word in enumerate(words):
+                delta = {"content": word + (" " if i < len(words) - 1 else "")}
+                if i == 0: delta["role"] = "assistant"
+                yield "data: " + json.dumps({**base, "object": "chat.completion.chunk",
+                                             "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}) + "\n\n"
+                await asyncio.sleep(1 / config["tokens_per_sec"])
+            for i, call in enumerate(tool_calls):
+                yield "data: " + json.dumps({**base, "object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": {"tool_calls": [{"index": i, **call}]}, "finish_reason": None}]}) + "\n\n"
+            finish = "tool_calls" if tool_calls else "stop"
+            yield "data: " + json.dumps({**base, "object": "chat.completion.chunk",
+                                         "choices": [{"index": 0, "delta": {}, "finish_reason": finish}]}) + "\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield "data: " + json.dumps({**base, "object": "chat.completion.chunk", "choices": [],
+                                             "usage": usage(body["messages"], len(words))}) + "\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    stats["chat"] += 1
+    await delay(config["latency"] + len(words) / config["tokens_per_sec"])
+    message = {"role": "assistant", "content": text}
+    if tool_calls: message["tool_calls"] = tool_calls
+    return {**base, "object": "chat.completion",
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": usage(body["messages"], len(words))}
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=config["latency"], help="Segundos hasta el primer token")
+    parser.add_argument("--jitter", type=float, default=config["jitter"])
+    parser.add_argument("--embed-latency", type=float, default=config["embed_latency"])
+    parser.add_argument("--tokens-per-sec", type=float, default=config["tokens_per_sec"])
+    parser.add_argument("--tool-rate", type=float, default=config["tool_rate"], help="Fracción extra de mensajes con tool call")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"])
+    parser.add_argument("--seed", type=int, default=config["seed"])
+    args = parser.parse_args()
+    config.update({k: v for k, v in vars(args).items() if k in config})
+    rng.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
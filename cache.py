@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Almacén de embeddings en disco, direccionado por contenido:
+# la clave es sha256(modelo + texto), así que un fragmento que no cambió
+# nunca se vuelve a pagar, aunque cambie su página o el orden del PDF.
+
+def content_key(model: str, text: str):
+    return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    def __init__(self, path: str):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder: os.makedirs(folder, exist_ok=True)
+
+        # SQLite permite que varios workers de uvicorn compartan el mismo caché
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL)"
+        )
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def get_many(self, model: str, texts):
+        # Devuelve {texto: vector} solo para los textos que ya están en caché
+        keys = {content_key(model, t): t for t in texts}
+        found = {}
+        items = list(keys)
+        with self.lock:
+            for start in range(0, len(items), 500):
+                part = items[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[keys[key]] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, texts, vectors):
+        rows = [
+            (content_key(model, t), model, len(v), np.asarray(v, dtype=np.float32).tobytes())
+            for t, v in zip(texts, vectors)
+        ]
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+# Caché en memoria LRU + TTL (para consultas repetidas del webhook).
+# Cuenta aciertos/fallos para poder dimensionarlo en producción.
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # clave -> (expira_en, valor)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.data), "maxsize": self.maxsize, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+# Caché semántico de respuestas: la clave es un embedding (consultas parecidas, no idénticas)
+# dentro de un "grupo" exacto (p. ej. los mismos fragmentos recuperados + la etapa del usuario).
+# Acierto = similitud coseno >= threshold con alguna entrada viva del mismo grupo.
+# Los grupos son chicos (pocas variantes de una pregunta), así que se recorren sin índice.
+
+class SemanticCache:
+    def __init__(self, maxsize=512, ttl=21600, threshold=0.92):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.groups = {}            # grupo -> {id: (expira_en, vector, valor)}
+        self.order = OrderedDict()  # id -> grupo, en orden LRU
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.skipped = {}           # motivo -> turnos que no usaron el caché
+
+    @staticmethod
+    def unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def best(self, vector, group):
+        # -> (id, similitud) de la entrada viva más parecida, o (None, -1)
+        entries = self.groups.get(group, {})
+        now = time.monotonic()
+        for entry_id in [i for i, (expires, _, _) in entries.items() if expires < now]:
+            self.drop(entry_id)
+        best_id, best_score = None, -1.0
+        for entry_id, (_, stored, _) in entries.items():
+            score = float(stored @ vector)
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def drop(self, entry_id):
+        group = self.order.pop(entry_id)
+        entries = self.groups[group]
+        del entries[entry_id]
+        if not entries: del self.groups[group]
+
+    def get(self, vector, group, default=None):
+        vector = self.unit(vector)
+        with self.lock:
+            entry_id, score = self.best(vector, group)
+            if entry_id is None or score < self.threshold:
+                self.misses += 1
+                return default
+            self.order.move_to_end(entry_id)
+            self.hits += 1
+            return self.groups[group][entry_id][2]
+
+    def set(self, vector, group, value):
+        vector = self.unit(vector)
+        with self.lock:
+            entry_id, score = self.best(vector, group)
+            if entry_id is None or score < self.threshold:
+                entry_id = self.next_id
+                self.next_id += 1
+                self.groups.setdefault(group, {})
+            self.groups[group][entry_id] = (time.monotonic() + self.ttl, vector, value)
+            self.order[entry_id] = group
+            self.order.move_to_end(entry_id)
+            self.stores += 1
+            while len(self.order) > self.maxsize:
+                self.drop(next(iter(self.order)))
+                self.evictions += 1
+
+    def skip(self, reason):
+        with self.lock:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.groups.clear()
+            self.order.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.order), "maxsize": self.maxsize, "ttl": self.ttl, "threshold": self.threshold,
+                "hits": self.hits, "misses": self.misses, "stores": self.stores, "evictions": self.evictions,
+                "skipped": dict(self.skipped), "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+def normalize_query(text: str):
+    # "  ¿Precio?  " y "precio" deben caer en la misma entrada
+    text = re.sub(r"\s+", " ", text.casefold()).strip()
+    return text.strip("¿?¡!.,;: ")
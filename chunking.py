@@ -0,0 +1,51 @@
+import os
+import re
+from prompting import count_tokens
+
+# Estrategias de chunking intercambiables (CHUNK_STRATEGY).
+# Todas trabajan sobre UNA página, así que ningún fragmento mezcla páginas
+# y el payload conserva `source` / `page`.
+
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "window")
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 120))     # Tamaño de la ventana
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 30))    # Tokens compartidos con la ventana anterior
+
+def chunk_lines(text: str):
+    # Estrategia original: una línea = un fragmento (se descartan las cortas, p. ej. precios)
+    return [t for t in text.split('\n') if len(t) > 30]
+
+def chunk_window(text: str, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    # Ventanas deslizantes de ~max_tokens con solapamiento, cortando en límites de palabra.
+    # Los saltos de línea se conservan para no pegar títulos con el texto siguiente.
+    words = re.findall(r"\S+\s*", text)
+    if not words: return []
+    costs = [count_tokens(w) for w in words]
+
+    chunks, start = [], 0
+    while start < len(words):
+        end, size = start, 0
+        while end < len(words) and (size + costs[end] <= max_tokens or end == start):
+            size += costs[end]
+            end += 1
+        chunk = "".join(words[start:end]).strip()
+        if chunk: chunks.append(chunk)
+        if end >= len(words): break
+
+        # Retrocedemos hasta cubrir `overlap` tokens (siempre avanzando al menos una palabra)
+        back, covered = end, 0
+        while back > start + 1 and covered + costs[back - 1] <= overlap:
+            back -= 1
+            covered += costs[back]
+        start = back
+    return chunks
+
+CHUNKERS = {
+    "lines": chunk_lines,
+    "window": chunk_window,
+}
+
+def get_chunker(name=None):
+    name = name or CHUNK_STRATEGY
+    if name not in CHUNKERS:
+        raise ValueError(f"Estrategia de chunking desconocida: {name} (opciones: {', '.join(CHUNKERS)})")
+    return CHUNKERS[name]
@@ -0,0 +1,53 @@
+import os
+import threading
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Clientes HTTP compartidos: un solo pool de conexiones (keep-alive) por proceso,
+# así cada request reutiliza el TLS ya abierto con la API en lugar de negociarlo de nuevo.
+# Se construyen en el primer uso: importar openai (~0.5s) no frena el arranque del servidor.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))
+
+limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE)
+
+class LazyClient:
+    # Se usa igual que el cliente real (client.embeddings.create(...)); lo arma al primer acceso
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    @property
+    def built(self):
+        return self._client is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def build_client():
+    from openai import OpenAI
+    return OpenAI(http_client=httpx.Client(limits=limits, timeout=HTTP_TIMEOUT))
+
+def build_aclient():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(http_client=httpx.AsyncClient(limits=limits, timeout=HTTP_TIMEOUT))
+
+# Síncrono: ingesta de documentos (hilos)
+client = LazyClient(build_client)
+# Asíncrono: camino del webhook
+aclient = LazyClient(build_aclient)
+
+async def close_clients():
+    if aclient.built: await aclient.close()
+    if client.built: client.close()
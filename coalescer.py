@@ -0,0 +1,134 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+# Agrupador de mensajes por teléfono (ráfagas de WhatsApp: "hola" / "una pregunta" / "cuánto cuesta?").
+#   - Un mensaje suelto (nada pendiente ni en curso para ese teléfono) arranca su turno al instante.
+#   - Debounce: si ya hay mensajes pendientes o un turno en curso, se espera COALESCE_WINDOW desde
+#     el último (máx. COALESCE_MAX_WAIT desde el primero) y los acumulados van en UN solo turno.
+#   - Serialización: un solo turno a la vez por teléfono, así el historial se lee y se guarda en orden.
+#   - Cancelación: si llega un mensaje mientras se genera la respuesta y ese turno todavía no tuvo
+#     efectos (tools, guardado), se cancela y sus mensajes se vuelven a encolar con el nuevo.
+# La respuesta completa la recibe la petición del ÚLTIMO mensaje del lote; las anteriores
+# reciben response=None (ya quedaron respondidas dentro del turno combinado).
+# Como el historial, es por proceso: con varios workers hace falta ruteo "sticky" por teléfono.
+
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 0.8))      # Segundos; 0 = sin agrupar
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", 3.0))  # Tope de espera desde el primer mensaje
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", 8))
+
+class PhoneState:
+    def __init__(self):
+        self.pending = []        # [(mensaje, future)] aún sin turno
+        self.first_at = None     # Llegada del primer mensaje pendiente
+        self.timer = None        # Tarea del debounce
+        self.running = None      # Tarea del turno en curso
+        self.committed = False   # El turno en curso ya tuvo efectos: no se puede cancelar
+        self.lock = asyncio.Lock()
+        self.holders = 0         # Quienes tienen o esperan el lock (el estado no se libera mientras tanto)
+
+class MessageCoalescer:
+    def __init__(self, handler, window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT, max_messages=COALESCE_MAX_MESSAGES):
+        # handler(phone, mensajes, commit) -> texto. Debe llamar commit() antes de cualquier
+        # efecto (tools, guardar historial); hasta ahí el turno es cancelable.
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self.phones = {}
+        self.stats = {"messages": 0, "turns": 0, "merged": 0, "cancelled": 0, "errors": 0}
+
+    def state(self, phone):
+        state = self.phones.get(phone)
+        if state is None:
+            state = self.phones[phone] = PhoneState()
+        return state
+
+    def forget(self, phone, state):
+        # Libera el estado del teléfono cuando ya no queda nada en vuelo
+        if not state.pending and state.running is None and state.timer is None and not state.holders:
+            self.phones.pop(phone, None)
+
+    async def submit(self, phone: str, message: str):
+        # -> (texto | None, mensajes en el turno)
+        state = self.state(phone)
+        future = asyncio.get_running_loop().create_future()
+        if not state.pending: state.first_at = time.monotonic()
+        state.pending.append((message, future))
+        self.stats["messages"] += 1
+        alone = len(state.pending) == 1 and state.running is None
+
+        if state.running and not state.running.done() and not state.committed:
+            # La respuesta en curso ya no contesta a todo lo que dijo el usuario
+            state.running.cancel()
+        self.schedule(phone, state, wait=not alone)
+        return await future
+
+    def schedule(self, phone, state, wait=True):
+        if state.timer: state.timer.cancel()
+        waited = time.monotonic() - (state.first_at or time.monotonic())
+        delay = max(0.0, min(self.window, self.max_wait - waited)) if wait else 0.0
+        if len(state.pending) >= self.max_messages: delay = 0.0
+        state.timer = asyncio.create_task(self.fire(phone, state, delay))
+
+    async def fire(self, phone, state, delay):
+        await asyncio.sleep(delay)
+        state.timer = None
+        if state.running and not state.running.done():
+            return  # Al terminar el turno en curso se vuelve a programar
+        batch, state.pending = state.pending[:self.max_messages], state.pending[self.max_messages:]
+        if not batch:
+            return self.forget(phone, state)
+        state.first_at = time.monotonic() if state.pending else None
+        state.running = asyncio.create_task(self.run(phone, state, batch))
+
+    async def run(self, phone, state, batch):
+        def commit():
+            state.committed = True
+
+        cancelled = False
+        state.holders += 1
+        try:
+            async with state.lock:
+                state.committed = False
+                text = await self.handler(phone, [m for m, _ in batch], commit)
+        except asyncio.CancelledError:
+            # Superado por un mensaje nuevo: el lote vuelve al frente de la cola
+            cancelled = True
+            self.stats["cancelled"] += 1
+            state.pending[:0] = batch
+            state.first_at = state.first_at or time.monotonic()
+        except Exception as e:
+            self.stats["errors"] += 1
+            for _, future in batch:
+                if not future.done(): future.set_exception(e)
+        else:
+            self.stats["turns"] += 1
+            self.stats["merged"] += len(batch) - 1
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result((text if i == len(batch) - 1 else None, len(batch)))
+        finally:
+            state.holders -= 1
+            state.running = None
+            state.committed = False
+            if state.pending:
+                if cancelled or state.timer is None: self.schedule(phone, state)
+            else:
+                self.forget(phone, state)
+
+    @asynccontextmanager
+    async def phone_lock(self, phone: str):
+        # Para caminos que no se agrupan (p. ej. streaming) pero sí deben ir en orden
+        state = self.state(phone)
+        state.holders += 1
+        try:
+            async with state.lock:
+                yield
+        finally:
+            state.holders -= 1
+            self.forget(phone, state)
+
+    def snapshot(self):
+        return {**self.stats, "active_phones": len(self.phones)}
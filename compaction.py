@@ -0,0 +1,237 @@
+import io
+import os
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal, Message, ConversationSummary, init_db
+from history import conversation_store, HISTORY_MAXLEN
+from prompting import truncate_tokens, record_usage
+from router import CHAT_MODEL_SMALL
+
+# Compactación del historial: `messages` solo necesita los últimos turnos de cada usuario
+# (get_chat_history lee 10, el caché 20). Un worker en segundo plano, por usuario:
+#   1. toma los turnos viejos (todo menos los COMPACTION_KEEP más recientes),
+#   2. los pliega en un resumen acumulado (`conversation_summaries`) con el modelo chico;
+#      el resumen se inyecta en el system prompt,
+#   3. los agrega a un archivo frío comprimido: ARCHIVE_DIR/messages-AAAA-MM.jsonl.zst
+#      (un frame zstd por lote; los frames concatenados se leen de corrido),
+#   4. y recién entonces los borra de la tabla caliente (una transacción con el resumen).
+# Si el proceso muere entre 3 y 4, el lote se vuelve a archivar en la próxima pasada:
+# read_archive descarta los ids repetidos. Con varios workers el resumen se actualiza
+# con un UPDATE condicional (compacted_until), así que dos pasadas simultáneas no lo pisan.
+# Auditoría:  python compaction.py --read 2026-10 [--user 5]
+# Una pasada a mano:  python compaction.py --once
+
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "1") == "1"
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", 600))               # Segundos entre pasadas
+COMPACTION_KEEP = max(int(os.getenv("COMPACTION_KEEP", 40)), HISTORY_MAXLEN)    # Filas que quedan en caliente por usuario
+COMPACTION_MIN_ROWS = int(os.getenv("COMPACTION_MIN_ROWS", 40))                 # Filas viejas mínimas para compactar
+COMPACTION_MAX_ROWS = int(os.getenv("COMPACTION_MAX_ROWS", 200))                # Filas por resumen (el resto, en la próxima)
+COMPACTION_USERS_PER_RUN = int(os.getenv("COMPACTION_USERS_PER_RUN", 50))
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", CHAT_MODEL_SMALL)
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_LEVEL = int(os.getenv("ARCHIVE_LEVEL", 10))  # Nivel de zstd (1-22)
+
+SUMMARY_PROMPT = (
+    "Eres la memoria de SolarBot, asistente comercial de SolarTech. Actualiza el resumen de la "
+    "conversación con el cliente incorporando los mensajes nuevos. Conserva solo lo útil para la venta: "
+    "nombre, tipo de proyecto (casa o industria), necesidades, productos y precios consultados, "
+    "objeciones, acuerdos y pendientes. Viñetas cortas en español, máximo 120 palabras. No inventes nada."
+)
+
+def archive_path(month: str):
+    return os.path.join(ARCHIVE_DIR, f"messages-{month}.jsonl.zst")
+
+def write_archive(rows):
+    # Corre en un hilo. Un frame por mes y por lote, agregado al final del archivo
+    import zstandard
+    by_month = {}
+    for row in rows:
+        by_month.setdefault((row["timestamp"] or "0000-00")[:7], []).append(row)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    compressor = zstandard.ZstdCompressor(level=ARCHIVE_LEVEL)
+    for month, part in by_month.items():
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in part).encode("utf-8")
+        with open(archive_path(month), "ab") as f:
+            f.write(compressor.compress(data))
+            f.flush()
+            os.fsync(f.fileno())  # Tiene que estar en disco antes de borrar las filas
+
+def read_archive(month: str, user_id=None):
+    # Filas archivadas de un mes, en orden de compactación (ids repetidos descartados)
+    import zstandard
+    seen = set()
+    with open(archive_path(month), "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        for line in io.TextIOWrapper(reader, encoding="utf-8"):
+            row = json.loads(line)
+            if row["id"] in seen: continue
+            seen.add(row["id"])
+            if user_id is None or row["user_id"] == user_id:
+                yield row
+
+async def summarize(previous, rows):
+    from clients import aclient
+    transcript = "\n".join(f"{r['role']}: {truncate_tokens(r['content'] or '', 200)}" for r in rows)
+    resp = await aclient.chat.completions.create(
+        model=COMPACTION_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Resumen anterior:\n{previous or '(vacío)'}\n\nMensajes nuevos:\n{transcript}"},
+        ],
+        temperature=0.0,
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
+    record_usage(resp.usage)
+    return (resp.choices[0].message.content or "").strip()
+
+class HistoryCompactor:
+    def __init__(self):
+        self.worker = None
+        self.closing = False
+        self.wakeup = asyncio.Event()
+        self.stats = {"runs": 0, "users": 0, "compacted_rows": 0, "conflicts": 0, "errors": 0, "last_run_seconds": 0.0}
+
+    async def candidates(self):
+        # Usuarios con suficientes filas viejas (recorre el índice user_id, id; no la tabla)
+        async with SessionLocal() as db:
+            return (await db.execute(
+                select(Message.user_id).group_by(Message.user_id)
+                .having(func.count() >= COMPACTION_KEEP + COMPACTION_MIN_ROWS)
+                .limit(COMPACTION_USERS_PER_RUN)
+            )).scalars().all()
+
+    async def compact_user(self, user_id: int):
+        async with SessionLocal() as db:
+            state = await db.get(ConversationSummary, user_id)
+            previous = state.summary if state else None
+            previous_until = state.compacted_until if state else None
+            # Primera fila que se queda en caliente: la COMPACTION_KEEP-ésima más reciente
+            keep_from = (await db.execute(
+                select(Message.id).where(Message.user_id == user_id)
+                .order_by(Message.id.desc()).offset(COMPACTION_KEEP - 1).limit(1)
+            )).scalar()
+            if keep_from is None: return 0
+            messages = (await db.execute(
+                select(Message).where(Message.user_id == user_id, Message.id < keep_from)
+                .order_by(Message.id).limit(COMPACTION_MAX_ROWS)
+            )).scalars().all()
+        if len(messages) < COMPACTION_MIN_ROWS: return 0
+        rows = [{"id": m.id, "user_id": m.user_id, "role": m.role, "content": m.content,
+                 "timestamp": m.timestamp.isoformat() if m.timestamp else None} for m in messages]
+
+        # El resumen y el archivo van fuera de la transacción (no se retiene la BD durante la llamada al modelo)
+        summary = await summarize(previous, rows)
+        if not summary: return 0
+        await asyncio.to_thread(write_archive, rows)
+
+        last_id = rows[-1]["id"]
+        async with SessionLocal() as db:
+            # Si otro proceso compactó a este usuario al mismo tiempo, su resumen gana
+            if state:
+                result = await db.execute(
+                    update(ConversationSummary)
+                    .where(ConversationSummary.user_id == user_id, ConversationSummary.compacted_until == previous_until)
+                    .values(summary=summary, compacted_until=last_id, updated_at=datetime.utcnow(),
+                            compacted_messages=ConversationSummary.compacted_messages + len(rows))
+                )
+                updated = result.rowcount == 1
+            else:
+                try:
+                    db.add(ConversationSummary(user_id=user_id, summary=summary, compacted_until=last_id,
+                                               compacted_messages=len(rows), updated_at=datetime.utcnow()))
+                    await db.flush()
+                    updated = True
+                except IntegrityError:
+                    updated = False
+            if not updated:
+                await db.rollback()
+                self.stats["conflicts"] += 1
+                return 0
+            await db.execute(delete(Message).where(Message.user_id == user_id, Message.id <= last_id))
+            await db.commit()
+        conversation_store.remember_summary(user_id, summary)
+        self.stats["users"] += 1
+        self.stats["compacted_rows"] += len(rows)
+        return len(rows)
+
+    async def run_once(self):
+        start = time.perf_counter()
+        # -> usuarios compactados (si llega a COMPACTION_USERS_PER_RUN, puede que queden más)
+        users = await self.candidates()
+        compacted, done = 0, 0
+        for user_id in users:
+            if self.closing: break
+            try:
+                rows = await self.compact_user(user_id)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"⚠️ Error compactando el historial del usuario {user_id}: {e}")
+                continue
+            compacted += rows
+            done += 1 if rows else 0
+        self.stats["runs"] += 1
+        self.stats["last_run_seconds"] = round(time.perf_counter() - start, 3)
+        if compacted:
+            print(f"🗜️ Compactación: {compacted} mensajes de {done} usuarios archivados y resumidos.")
+        return done
+
+    async def run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=COMPACTION_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                # Pasadas seguidas mientras queden usuarios por compactar
+                while not self.closing and await self.run_once() == COMPACTION_USERS_PER_RUN:
+                    pass
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"⚠️ Error en la compactación del historial: {e}")
+
+    async def start(self):
+        if COMPACTION_ENABLED and self.worker is None:
+            self.closing = False
+            self.worker = asyncio.create_task(self.run())
+
+    async def close(self):
+        # Termina el usuario en curso; el resto queda para la próxima pasada
+        self.closing = True
+        if self.worker:
+            self.wakeup.set()
+            await self.worker
+            self.worker = None
+
+    def snapshot(self):
+        return dict(self.stats)
+
+history_compactor = HistoryCompactor()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compactación y archivo del historial")
+    parser.add_argument("--once", action="store_true", help="Corre una pasada de compactación y termina")
+    parser.add_argument("--read", metavar="AAAA-MM", help="Imprime (JSONL) los mensajes archivados de ese mes")
+    parser.add_argument("--user", type=int, help="Con --read: solo los de este user_id")
+    args = parser.parse_args()
+
+    if args.read:
+        for row in read_archive(args.read, args.user):
+            print(json.dumps(row, ensure_ascii=False))
+    elif args.once:
+        async def main():
+            from clients import close_clients
+            init_db()
+            while await history_compactor.run_once() == COMPACTION_USERS_PER_RUN:
+                pass
+            print(history_compactor.snapshot())
+            await close_clients()
+        asyncio.run(main())
+    else:
+        parser.print_help()
@@ -1,5 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from sqlalchemy import create_engine, select, Index, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -8,8 +10,21 @@ load_dotenv()
 "sqlite:///./chat_crm.db"
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+
+def async_url(url: str):
+    # Mismo DATABASE_URL, pero con un driver asíncrono (aiosqlite / asyncpg)
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return url.replace(prefix, "postgresql+asyncpg://", 1)
+    return url
+
+# Motor síncrono: solo para crear tablas al arrancar
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Motor asíncrono: el que usa el webhook
+async_engine = create_async_engine(async_url(DATABASE_URL), pool_pre_ping=True)
+SessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 Base = declarative_base()
 
 class User(Base):
@@ -28,35 +43,92 @@ class Message(Base):
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+    # Respaldo de get_chat_history: WHERE user_id = ? ORDER BY id DESC LIMIT n
+    __table_args__ = (Index("ix_messages_user_id_id", "user_id", "id"),)
+
+class ConversationSummary(Base):
+    # Resumen acumulado de los turnos que la compactación sacó de `messages` (compaction.py)
+    __tablename__ = "conversation_summaries"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    summary = Column(Text, nullable=False)
+    compacted_until = Column(Integer, nullable=False)  # Último messages.id incluido en el resumen
+    compacted_messages = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class OutboxEmail(Base):
+    # Correos pendientes de envío (los manda el worker de outbox.py, no el webhook)
+    __tablename__ = "outbox_emails"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    to_email = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    status = Column(String, default="pending")  # pending -> sending -> sent | failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)  # También sirve de "lease" mientras está en sending
+    claimed_by = Column(String, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    # El worker busca: WHERE status IN (...) AND next_attempt_at <= now ORDER BY id
+    __table_args__ = (Index("ix_outbox_status_next", "status", "next_attempt_at"),)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all no agrega índices nuevos a tablas que ya existían
+    for index in Message.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+def dialect_insert(table):
+    # INSERT con soporte de ON CONFLICT según el motor
+    if async_engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+async def get_or_create_user(db: AsyncSession, phone: str):
+    # Camino rápido (usuario existente): un solo SELECT, sin commit
+    user = (await db.execute(select(User).where(User.phone == phone))).scalars().first()
+    if user:
+        return user, False
+
+    # Usuario nuevo: INSERT ... ON CONFLICT DO NOTHING RETURNING en un solo viaje.
+    # Si dos mensajes del mismo teléfono llegan a la vez, el segundo no revienta con
+    # IntegrityError: simplemente no inserta y lee la fila que creó el primero.
+    stmt = dialect_insert(User).values(phone=phone, stage="onboarding") \
+        .on_conflict_do_nothing(index_elements=["phone"]).returning(User)
+    user = (await db.execute(select(User).from_statement(stmt))).scalars().first()
+    is_new = user is not None
+    if not is_new:
+        user = (await db.execute(select(User).where(User.phone == phone))).scalars().one()
+    # Commit inmediato (una vez en la vida del teléfono) para no retener el lock de escritura
+    await db.commit()
+    return user, is_new
+
+async def save_messages(db: AsyncSession, user_id: int, messages):
+    # Guarda todos los turnos de la petición (y los cambios pendientes del usuario,
+    # p. ej. de update_lead_info) en UNA sola transacción
+    db.add_all([Message(user_id=user_id, role=role, content=content) for role, content in messages])
+    await db.commit()
+
+async def save_message(db: AsyncSession, user_id: int, role: str, content: str):
+    await save_messages(db, user_id, [(role, content)])
+
+async def get_summary(db: AsyncSession, user_id: int):
+    row = await db.get(ConversationSummary, user_id)
+    return row.summary if row else None
 
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
-
-def get_or_create_user(db: Session, phone: str):
-    user = db.query(User).filter(User.phone == phone).first()
-    if not user:
-        user = User(phone=phone)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-        return user, True
-    return user, False
-
-def save_message(db: Session, user_id: int, role: str, content: str):
-    msg = Message(user_id=user_id, role=role, content=content)
-    db.add(msg)
-    db.commit()
-
-def get_chat_history(db: Session, user_id: int, limit=10):
+async def get_chat_history(db: AsyncSession, user_id: int, limit=10):
     # 1. Obtenemos los últimos 10 mensajes (orden descendente por ID para sacar los últimos)
-    msgs = db.query(Message).filter(Message.user_id == user_id)\
-             .order_by(Message.id.desc()).limit(limit).all()
+    msgs = (await db.execute(
+        select(Message).where(Message.user_id == user_id).order_by(Message.id.desc()).limit(limit)
+    )).scalars().all()
     
     # 2. Invertimos la lista para que OpenAI lea en orden cronológico (Viejo -> Nuevo)
     # Ejemplo: [Hola (hoy), Hola (ayer)] -> [Hola (ayer), Hola (hoy)]
     history = [{"role": m.role, "content": m.content} for m in reversed(msgs)]
-    return history
\ No newline at end of file
+    return history
@@ -0,0 +1,56 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Extracción de texto de documentos como productor en streaming para la ingesta.
+# extract_text() de pypdf es CPU puro: en manuales grandes se reparte por rangos de
+# páginas en un pool de procesos. Solo hay EXTRACT_WORKERS * 2 rangos "en vuelo",
+# así que la memoria no crece con el tamaño del documento, y las páginas salen
+# en orden para alimentar directamente el chunking / embeddings / upsert.
+# Este módulo solo importa pypdf: es lo único que cargan los procesos hijos.
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 1))
+EXTRACT_PAGES_PER_TASK = int(os.getenv("EXTRACT_PAGES_PER_TASK", 8))
+EXTRACT_PARALLEL_MIN_PAGES = int(os.getenv("EXTRACT_PARALLEL_MIN_PAGES", 16))  # Debajo de esto no vale la pena el pool
+
+def extract_page_range(path, start, end):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return [(i + 1, reader.pages[i].extract_text() or "") for i in range(start, end)]
+
+def iter_pdf_pages(path):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    total = len(reader.pages)
+
+    if total < EXTRACT_PARALLEL_MIN_PAGES or EXTRACT_WORKERS <= 1:
+        # Documento chico: secuencial, página a página
+        for i, page in enumerate(reader.pages):
+            yield i + 1, page.extract_text() or ""
+        return
+    del reader
+
+    ranges = iter([(s, min(s + EXTRACT_PAGES_PER_TASK, total)) for s in range(0, total, EXTRACT_PAGES_PER_TASK)])
+    # "spawn": los hijos no heredan los hilos/sockets del servidor
+    with ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        window = deque()
+        for _ in range(EXTRACT_WORKERS * 2):
+            r = next(ranges, None)
+            if r is None: break
+            window.append(pool.submit(extract_page_range, path, *r))
+
+        while window:
+            future = window.popleft()
+            r = next(ranges, None)
+            if r is not None:
+                window.append(pool.submit(extract_page_range, path, *r))
+            yield from future.result()
+
+def iter_document_pages(path):
+    # (número de página, texto). Los .txt / .md cuentan como una sola página.
+    if path.lower().endswith(".pdf"):
+        yield from iter_pdf_pages(path)
+    else:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            yield 1, f.read()
@@ -0,0 +1,163 @@
+import os
+import asyncio
+from collections import OrderedDict, deque
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import SessionLocal, Message, get_chat_history, get_summary, save_messages
+
+# Historial de conversación con caché por usuario + escritura diferida (write-behind).
+#   - Lecturas: se sirven desde un ring buffer con los últimos N turnos por usuario.
+#     Solo un fallo de caché toca la BD (índice compuesto user_id, id).
+#   - Escrituras: se encolan y un worker las inserta por lotes en `messages`.
+#     Al apagar el servidor se vacía la cola (close()).
+# Ojo: el caché es por proceso. Con varios workers de uvicorn hay que usar ruteo
+# "sticky" por teléfono, un backend compartido, o HISTORY_WRITE_BEHIND=0.
+
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "1") == "1"
+HISTORY_MAXLEN = int(os.getenv("HISTORY_MAXLEN", 20))             # Turnos guardados por usuario
+HISTORY_MAX_USERS = int(os.getenv("HISTORY_MAX_USERS", 10000))    # Usuarios en memoria (LRU)
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 0.5))
+HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", 200))
+
+class InMemoryHistoryBackend:
+    # Backend por defecto. Cualquier objeto con get/set/append sirve
+    # (p. ej. uno sobre Redis para compartirlo entre procesos).
+    def __init__(self, maxlen=HISTORY_MAXLEN, max_users=HISTORY_MAX_USERS):
+        self.maxlen = maxlen
+        self.max_users = max_users
+        self.users = OrderedDict()  # user_id -> deque de {"role", "content"}
+
+    def get(self, user_id):
+        ring = self.users.get(user_id)
+        if ring is None:
+            return None
+        self.users.move_to_end(user_id)
+        return list(ring)
+
+    def set(self, user_id, messages):
+        self.users[user_id] = deque(messages, maxlen=self.maxlen)
+        self.users.move_to_end(user_id)
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+
+    def append(self, user_id, messages):
+        # Solo se actualiza si el usuario ya está en caché; si no, el próximo
+        # fallo lo cargará completo desde la BD (+ lo pendiente de escribir)
+        ring = self.users.get(user_id)
+        if ring is not None:
+            ring.extend(messages)
+
+class ConversationStore:
+    def __init__(self, backend=None, write_behind=HISTORY_WRITE_BEHIND):
+        self.backend = backend or InMemoryHistoryBackend()
+        self.summaries = OrderedDict()  # user_id -> resumen de lo compactado (o None)
+        self.write_behind = write_behind
+        self.pending = []           # Filas aún no escritas, en orden de llegada
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()  # Un fallo de caché no debe leer la BD a mitad de un flush
+        self.worker = None
+        self.closing = False
+        self.stats = {"hits": 0, "misses": 0, "flushes": 0, "flushed_rows": 0, "flush_errors": 0}
+
+    async def get_history(self, db: AsyncSession, user_id: int, limit=10):
+        cached = self.backend.get(user_id)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached[-limit:]
+
+        self.stats["misses"] += 1
+        async with self.lock:
+            history = await get_chat_history(db, user_id, limit=self.backend.maxlen)
+            # Lo que está en cola todavía no llegó a la BD
+            history += [
+                {"role": row["role"], "content": row["content"]}
+                for row in self.pending if row["user_id"] == user_id
+            ]
+        self.backend.set(user_id, history)
+        return history[-limit:]
+
+    async def get_summary(self, db: AsyncSession, user_id: int):
+        # Solo cambia cuando corre la compactación, que lo actualiza acá (remember_summary)
+        if user_id in self.summaries:
+            self.summaries.move_to_end(user_id)
+            return self.summaries[user_id]
+        summary = await get_summary(db, user_id)
+        self.remember_summary(user_id, summary)
+        return summary
+
+    def remember_summary(self, user_id, summary):
+        self.summaries[user_id] = summary
+        self.summaries.move_to_end(user_id)
+        while len(self.summaries) > HISTORY_MAX_USERS:
+            self.summaries.popitem(last=False)
+
+    async def save_turn(self, db: AsyncSession, user_id: int, messages):
+        entries = [{"role": role, "content": content} for role, content in messages]
+
+        if not self.write_behind:
+            await save_messages(db, user_id, messages)
+            self.backend.append(user_id, entries)
+            return
+
+        self.backend.append(user_id, entries)
+        now = datetime.utcnow()
+        self.pending += [{"user_id": user_id, "timestamp": now, **e} for e in entries]
+        if len(self.pending) >= HISTORY_FLUSH_BATCH:
+            self.wakeup.set()
+
+        # Cambios del usuario (update_lead_info) sí se confirman en línea
+        if db.dirty or db.new:
+            await db.commit()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending: return
+            batch, self.pending = self.pending, []
+            ok = False
+            try:
+                async with SessionLocal() as db:
+                    await db.execute(insert(Message), batch)
+                    await db.commit()
+                ok = True
+                self.stats["flushes"] += 1
+                self.stats["flushed_rows"] += len(batch)
+            except Exception as e:
+                self.stats["flush_errors"] += 1
+                print(f"⚠️ Error guardando historial ({len(batch)} mensajes), se reintentará: {e}")
+            finally:
+                # No se pierde nada: si falló, el lote vuelve al frente de la cola
+                if not ok:
+                    self.pending = batch + self.pending
+
+    async def run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=HISTORY_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        if self.write_behind and self.worker is None:
+            self.closing = False
+            self.worker = asyncio.create_task(self.run())
+
+    async def close(self):
+        # Apagado ordenado: dejamos terminar el lote en curso y escribimos todo lo pendiente
+        self.closing = True
+        if self.worker:
+            self.wakeup.set()
+            await self.worker
+            self.worker = None
+        for _ in range(3):
+            await self.flush()
+            if not self.pending: break
+        if self.pending:
+            print(f"❌ {len(self.pending)} mensajes de historial no se pudieron guardar al apagar.")
+
+    def snapshot(self):
+        return {**self.stats, "pending": len(self.pending), "cached_users": len(getattr(self.backend, "users", ()))}
+
+conversation_store = ConversationStore()
@@ -0,0 +1,350 @@
+import os
+import json
+import time
+import uuid
+import random
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+import httpx
+
+# Modo cola del webhook (WEBHOOK_MODE=queue): /webhook valida, guarda el mensaje con una
+# clave de idempotencia y responde 202 al instante. Un pool de workers procesa la cola con
+# concurrencia acotada y un rate limit hacia la API del modelo; la respuesta se entrega por
+# callback (callback_url) o consultando GET /jobs/{id}.
+#   - Reintentos del gateway con la misma clave no generan trabajo duplicado.
+#   - Si el proceso muere con un job en curso, otro worker lo retoma al vencer su lease.
+#     Mientras el turno corre, el worker renueva el lease (un turno lento no se procesa dos veces)
+#     y solo quien tiene el claim vigente (mismo `attempts`) puede completarlo o fallarlo.
+# La cola por defecto es un archivo SQLite local (sirve para desarrollo / pruebas y para un
+# solo servidor). Cualquier objeto con la misma interfaz que SQLiteJobQueue puede reemplazarla.
+
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")               # sync | queue
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", ".cache/jobs.sqlite")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))                 # Turnos en paralelo como máximo
+JOB_RATE_LIMIT = float(os.getenv("JOB_RATE_LIMIT", 0))         # Turnos por segundo hacia el modelo; 0 = sin límite
+JOB_RATE_BURST = int(os.getenv("JOB_RATE_BURST", 5))
+JOB_MAX_DEPTH = int(os.getenv("JOB_MAX_DEPTH", 1000))          # Con más en cola se responde 429 (backpressure)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_LEASE = float(os.getenv("JOB_LEASE", 120))                 # Segundos que un worker "posee" un job sin renovar (se renueva mientras corre)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_DEDUP_WINDOW = int(os.getenv("JOB_DEDUP_WINDOW", 0))       # Opcional: sin clave, mismo teléfono+texto en esta ventana = duplicado
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 86400))       # Los jobs terminados se borran después de esto
+JOB_CALLBACK_URL = os.getenv("JOB_CALLBACK_URL")               # Callback por defecto (el request puede traer el suyo)
+JOB_CALLBACK_RETRIES = int(os.getenv("JOB_CALLBACK_RETRIES", 3))
+# Hosts a los que se puede enviar un callback_url que viene en el request (separados por coma).
+# Sin lista solo se acepta el host de JOB_CALLBACK_URL: el servidor no le manda el teléfono
+# y la respuesta a cualquier URL que elija quien llama.
+JOB_CALLBACK_HOSTS = {h.strip().lower() for h in os.getenv("JOB_CALLBACK_HOSTS", "").split(",") if h.strip()}
+if JOB_CALLBACK_URL and urlsplit(JOB_CALLBACK_URL).hostname:
+    JOB_CALLBACK_HOSTS.add(urlsplit(JOB_CALLBACK_URL).hostname.lower())
+
+def callback_allowed(url: str):
+    # urlsplit descarta en silencio caracteres de control al inicio: se rechazan antes
+    if any(ord(c) <= 32 or ord(c) == 127 for c in url):
+        return False
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+    except ValueError:
+        return False
+    return parts.scheme in ("http", "https") and bool(host) and host.lower() in JOB_CALLBACK_HOSTS
+
+def idempotency_key(phone: str, message: str, explicit=None):
+    # Solo la clave del gateway (header Idempotency-Key / id del mensaje de WhatsApp) identifica
+    # un reintento. Sin ella cada request es un mensaje nuevo: un usuario que contesta "si" dos
+    # veces seguidas manda dos mensajes. Con JOB_DEDUP_WINDOW > 0 (para gateways que reintentan
+    # sin clave) el mismo texto del mismo teléfono dentro de la ventana cuenta como reintento.
+    if explicit:
+        return f"k:{explicit}"
+    if JOB_DEDUP_WINDOW <= 0:
+        return f"u:{uuid.uuid4().hex}"
+    bucket = int(time.time() // JOB_DEDUP_WINDOW)
+    return "h:" + hashlib.sha256(f"{phone}\x00{message}\x00{bucket}".encode("utf-8")).hexdigest()
+
+class SQLiteJobQueue:
+    def __init__(self, path=JOB_QUEUE_PATH):
+        folder = os.path.dirname(path)
+        if folder: os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, idem_key TEXT UNIQUE NOT NULL, phone TEXT NOT NULL, payload TEXT NOT NULL,"
+            " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL,"
+            " created_at REAL NOT NULL, started_at REAL, finished_at REAL, result TEXT, error TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_available ON jobs (status, available_at)")
+        self.lock = threading.Lock()
+
+    def row(self, r):
+        if r is None: return None
+        job = dict(r)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(self, idem_key, phone, payload):
+        # -> (job, creado). Si la clave ya existe se devuelve el job original
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT INTO jobs (id, idem_key, phone, payload, status, available_at, created_at)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?) ON CONFLICT(idem_key) DO NOTHING",
+                (uuid.uuid4().hex, idem_key, phone, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            created = cur.rowcount == 1
+            job = self.conn.execute("SELECT * FROM jobs WHERE idem_key = ?", (idem_key,)).fetchone()
+        return self.row(job), created
+
+    def claim(self):
+        # Toma el job más viejo disponible (o uno "running" cuyo lease venció) de forma atómica
+        now = time.time()
+        with self.lock:
+            job = self.conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, available_at = ?"
+                " WHERE id = (SELECT id FROM jobs WHERE status IN ('queued', 'running') AND available_at <= ?"
+                "             ORDER BY created_at LIMIT 1)"
+                " RETURNING *",
+                (now, now + JOB_LEASE, now),
+            ).fetchone()
+        return self.row(job)
+
+    # complete / fail / extend reciben el `attempts` del claim: si el lease venció y otro worker
+    # reclamó el job, attempts ya no coincide y no se toca nada (devuelven False)
+    def extend(self, job_id, attempts):
+        with self.lock:
+            return self.conn.execute(
+                "UPDATE jobs SET available_at = ? WHERE id = ? AND attempts = ? AND status = 'running'",
+                (time.time() + JOB_LEASE, job_id, attempts),
+            ).rowcount == 1
+
+    def complete(self, job_id, attempts, result):
+        with self.lock:
+            return self.conn.execute(
+                "UPDATE jobs SET status = 'done', finished_at = ?, result = ?, error = NULL"
+                " WHERE id = ? AND attempts = ? AND status = 'running'",
+                (time.time(), json.dumps(result, ensure_ascii=False), job_id, attempts),
+            ).rowcount == 1
+
+    def fail(self, job_id, attempts, error, retry_in=None):
+        # retry_in=None: falla definitiva
+        with self.lock:
+            if retry_in is None:
+                cur = self.conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, error = ?"
+                    " WHERE id = ? AND attempts = ? AND status = 'running'",
+                    (time.time(), error, job_id, attempts))
+            else:
+                cur = self.conn.execute(
+                    "UPDATE jobs SET status = 'queued', available_at = ?, error = ?"
+                    " WHERE id = ? AND attempts = ? AND status = 'running'",
+                    (time.time() + retry_in, error, job_id, attempts))
+            return cur.rowcount == 1
+
+    def get(self, job_id):
+        with self.lock:
+            return self.row(self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+            oldest = self.conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        counts = {status: n for status, n in rows}
+        return counts, oldest
+
+    def purge(self, older_than):
+        with self.lock:
+            return self.conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (time.time() - older_than,)
+            ).rowcount
+
+class RateLimiter:
+    # Token bucket asíncrono: `rate` permisos por segundo, ráfagas de hasta `burst`
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0: return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def percentile(values, p):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class JobRunner:
+    def __init__(self, handler, queue=None, workers=JOB_WORKERS):
+        # handler(job) -> dict con el resultado (se guarda y se envía al callback)
+        self.handler = handler
+        self.queue = queue or SQLiteJobQueue()
+        self.workers = workers
+        self.limiter = RateLimiter(JOB_RATE_LIMIT, JOB_RATE_BURST)
+        self.tasks = []
+        self.wakeup = asyncio.Event()
+        self.closing = False
+        self.http = None
+        self.waits = deque(maxlen=1000)    # Segundos en cola antes de empezar
+        self.latencies = deque(maxlen=1000)  # Segundos de procesamiento
+        self.stats = {"accepted": 0, "duplicates": 0, "rejected": 0, "done": 0, "retried": 0, "failed": 0,
+                      "callbacks": 0, "callback_errors": 0, "worker_errors": 0, "lease_lost": 0}
+
+    async def submit(self, phone, payload, key=None):
+        # -> (job, creado) ; (None, False) si la cola está llena
+        counts, _ = await asyncio.to_thread(self.queue.counts)
+        if counts.get("queued", 0) >= JOB_MAX_DEPTH:
+            self.stats["rejected"] += 1
+            return None, False
+        job, created = await asyncio.to_thread(
+            self.queue.enqueue, idempotency_key(phone, payload["message"], key), phone, payload
+        )
+        self.stats["accepted" if created else "duplicates"] += 1
+        if created: self.wakeup.set()
+        return job, created
+
+    async def worker(self):
+        permit = False
+        while not self.closing:
+            try:
+                # El rate limit va ANTES del claim: un job reclamado no espera con el lease corriendo.
+                # El permiso se conserva mientras la cola esté vacía (no se gasta en cada sondeo)
+                if not permit:
+                    await self.limiter.acquire()
+                    permit = True
+                job = await asyncio.to_thread(self.queue.claim)
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.wakeup.clear()
+                    continue
+                permit = False
+                await self.process(job)
+            except Exception as e:
+                # Un error fuera del handler (p. ej. "database is locked") no puede matar al worker:
+                # el job que estuviera en curso vuelve a la cola cuando vence su lease
+                self.stats["worker_errors"] += 1
+                print(f"⚠️ Error en el worker de jobs: {e.__class__.__name__}: {e}")
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def heartbeat(self, job):
+        # Renueva el lease mientras el handler corre (un pico de latencia del proveedor
+        # no debe hacer que otro worker reclame el mismo turno)
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            try:
+                if not await asyncio.to_thread(self.queue.extend, job["id"], job["attempts"]):
+                    return  # Ya no es nuestro (o terminó)
+            except Exception as e:
+                print(f"⚠️ No se pudo renovar el lease de {job['id'][:8]}: {e}")
+
+    async def process(self, job):
+        self.waits.append(job["started_at"] - job["created_at"])
+        started = time.monotonic()
+        heartbeat = asyncio.create_task(self.heartbeat(job))
+        try:
+            result = await self.handler(job)
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+            if job["attempts"] < JOB_MAX_ATTEMPTS:
+                delay = min(2 ** job["attempts"], 60) + random.random()
+                print(f"⏳ Job {job['id'][:8]} falló ({error}), reintento en {delay:.1f}s.")
+                owned = await asyncio.to_thread(self.queue.fail, job["id"], job["attempts"], error, delay)
+                self.stats["retried" if owned else "lease_lost"] += 1
+            else:
+                print(f"❌ Job {job['id'][:8]} descartado tras {job['attempts']} intentos: {error}")
+                owned = await asyncio.to_thread(self.queue.fail, job["id"], job["attempts"], error)
+                self.stats["failed" if owned else "lease_lost"] += 1
+            return
+        finally:
+            heartbeat.cancel()
+        self.latencies.append(time.monotonic() - started)
+        if not await asyncio.to_thread(self.queue.complete, job["id"], job["attempts"], result):
+            # Otro worker lo reclamó: su resultado es el que vale (y el que se entrega)
+            self.stats["lease_lost"] += 1
+            print(f"⚠️ Job {job['id'][:8]} terminó con el lease perdido; no se entrega dos veces.")
+            return
+        self.stats["done"] += 1
+        await self.deliver(job, result)
+
+    async def deliver(self, job, result):
+        url = job["payload"].get("callback_url") or JOB_CALLBACK_URL
+        if not url: return  # Solo polling
+        if url != JOB_CALLBACK_URL and not callback_allowed(url):
+            self.stats["callback_errors"] += 1
+            print(f"⚠️ Callback de {job['id'][:8]} a un host no permitido; queda disponible en GET /jobs/{job['id']}.")
+            return
+        if self.http is None:
+            self.http = httpx.AsyncClient(timeout=10)
+        body = {"job_id": job["id"], "phone": job["phone"], **result}
+        for attempt in range(JOB_CALLBACK_RETRIES):
+            try:
+                resp = await self.http.post(url, json=body)
+                resp.raise_for_status()
+                self.stats["callbacks"] += 1
+                return
+            except httpx.HTTPError as e:
+                if attempt == JOB_CALLBACK_RETRIES - 1:
+                    self.stats["callback_errors"] += 1
+                    print(f"⚠️ Callback de {job['id'][:8]} falló ({e}); queda disponible en GET /jobs/{job['id']}.")
+                    return
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                # URL inválida u otro error que no se arregla reintentando
+                self.stats["callback_errors"] += 1
+                print(f"⚠️ Callback de {job['id'][:8]} falló ({e.__class__.__name__}: {e}); queda disponible en GET /jobs/{job['id']}.")
+                return
+
+    async def janitor(self):
+        # Borra jobs terminados viejos para que la tabla no crezca sin límite
+        while not self.closing:
+            await asyncio.sleep(min(JOB_RETENTION, 600))
+            try:
+                await asyncio.to_thread(self.queue.purge, JOB_RETENTION)
+            except Exception as e:
+                print(f"⚠️ Error limpiando la cola de jobs: {e}")
+
+    async def start(self):
+        if self.tasks: return
+        self.closing = False
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.janitor()))
+
+    async def close(self):
+        # Los jobs a medio procesar vuelven a la cola cuando vence su lease (no se pierden)
+        self.closing = True
+        self.wakeup.set()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.http:
+            await self.http.aclose()
+
+    async def snapshot(self):
+        counts, oldest = await asyncio.to_thread(self.queue.counts)
+        waits, latencies = list(self.waits), list(self.latencies)
+        return {
+            **self.stats, "depth": counts.get("queued", 0), "running": counts.get("running", 0),
+            "workers": self.workers, "oldest_wait": round(time.time() - oldest, 3) if oldest else 0.0,
+            "wait_p50": round(percentile(waits, 50), 3), "wait_p95": round(percentile(waits, 95), 3),
+            "process_p50": round(percentile(latencies, 50), 3), "process_p95": round(percentile(latencies, 95), 3),
+        }
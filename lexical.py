@@ -0,0 +1,103 @@
+import re
+import math
+import unicodedata
+from collections import Counter, defaultdict
+
+# Índice léxico BM25 en memoria sobre los mismos fragmentos que están en Qdrant.
+# Sirve para consultas que dependen de tokens exactos ("$5000", "Industrial", "9am")
+# donde la búsqueda densa suele traer la línea equivocada. Responde en microsegundos.
+
+STOPWORDS = set("""
+a al algo como con cual cuales cuando de del donde el ella en es esa ese eso esta este esto
+hay la las le les lo los mas me mi mis muy no o para pero por que se si sin sobre son su sus
+te tiene tu tus un una uno unos unas y ya yo the and
+""".split())
+
+TOKEN = re.compile(r"\$?\w+")
+THOUSANDS = re.compile(r"(?<=\d)[.,](?=\d{3}\b)")
+
+def strip_accents(text: str):
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+def stem(token: str):
+    # Stemming mínimo para español: plurales
+    if token.isdigit() or len(token) <= 4: return token
+    if token.endswith("es") and len(token) > 5: return token[:-2]
+    if token.endswith("s"): return token[:-1]
+    return token
+
+def tokenize(text: str):
+    # "$5,000 USD" -> ["$5000", "5000", "usd"] ; "Instalación" -> ["instalacion"]
+    text = THOUSANDS.sub("", strip_accents(text.casefold()))
+    tokens = []
+    for raw in TOKEN.findall(text):
+        word = raw.lstrip("$")
+        if not word or word in STOPWORDS: continue
+        if raw.startswith("$"):
+            tokens.append(raw)
+        tokens.append(stem(word))
+    return tokens
+
+def is_exact_token(token: str):
+    return token.startswith("$") or any(c.isdigit() for c in token)
+
+class BM25Index:
+    def __init__(self, docs=(), k1=1.5, b=0.75):
+        # docs: lista de dicts con al menos "text" (el payload del fragmento + "id")
+        self.k1 = k1
+        self.b = b
+        self.docs = list(docs)
+        self.postings = defaultdict(list)  # término -> [(doc, tf)]
+        self.doc_len = []
+        for i, doc in enumerate(self.docs):
+            counts = Counter(tokenize(doc["text"]))
+            self.doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings[term].append((i, tf))
+        n = len(self.docs)
+        self.avg_len = (sum(self.doc_len) / n) if n else 0.0
+        self.idf = {
+            term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self.postings.items()
+        }
+
+    def __len__(self):
+        return len(self.docs)
+
+    def search(self, query: str, limit=3, where=None):
+        # where(doc) -> bool: filtro sobre el payload (los que no cumplen ni se puntúan)
+        terms = [t for t in dict.fromkeys(tokenize(query)) if t in self.postings]
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        allowed = {}
+        for term in terms:
+            idf = self.idf[term]
+            for i, tf in self.postings[term]:
+                if where is not None:
+                    if i not in allowed: allowed[i] = where(self.docs[i])
+                    if not allowed[i]: continue
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[i] / self.avg_len)
+                scores[i] += idf * tf * (self.k1 + 1) / norm
+                matched[i] += 1
+        top = sorted(scores, key=scores.get, reverse=True)[:limit]
+        return [{**self.docs[i], "score": scores[i], "matched": matched[i]} for i in top]
+
+    def confident(self, query: str, results):
+        # ¿Alcanza con el resultado léxico? Solo para consultas cortas, con algún token
+        # exacto (precio, número), donde el mejor fragmento contiene TODOS los términos.
+        terms = set(tokenize(query))
+        if not results or not terms or len(terms) > 4:
+            return False
+        if not any(is_exact_token(t) for t in terms):
+            return False
+        return results[0]["matched"] == len(terms)
+
+def rrf_fuse(rankings, limit=3, k=60):
+    # Reciprocal Rank Fusion: combina rankings sin tener que calibrar sus scores
+    fused, docs = defaultdict(float), {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking):
+            fused[hit["id"]] += 1.0 / (k + rank + 1)
+            docs.setdefault(hit["id"], hit)
+    top = sorted(fused, key=fused.get, reverse=True)[:limit]
+    return [{**docs[i], "score": fused[i]} for i in top]
@@ -1,124 +1,529 @@
-from fastapi import FastAPI, Depends
+import time
+IMPORT_STARTED = time.perf_counter()  # Para medir cuánto tarda en importarse la app
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from openai import OpenAI
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
+from types import SimpleNamespace
+from typing import Optional
+import asyncio
 import json
+import os
+import secrets
 
 # Módulos propios (Asegúrate de que existan)
-from database import init_db, get_db, get_or_create_user, save_message, get_chat_history
-from rag import init_vector_db, search_context
-from tools import tools_schema, execute_tool
+from database import init_db, SessionLocal, get_or_create_user, async_engine
+from rag import init_vector_db, search_hits, format_context, cache_stats, documents_signature, index_ready
+from rag import answer_cache, answer_key, depends_on_history, ANSWER_CACHE, resolve_tenant, needs_stage, tenants
+from prompting import assemble_messages, load_prompt_template, record_usage, prompt_cache_stats
+from tools import tools_schema, apply_lead_updates, run_tools_parallel, needs_followup, record_followup, tool_stats
+from router import route_message, finalize_route, record_route, router_snapshot, mentions_personal_data
+from clients import aclient as client, close_clients
+from history import conversation_store
+from compaction import history_compactor
+from outbox import email_outbox
+from coalescer import MessageCoalescer, COALESCE_WINDOW
+from jobs import JobRunner, WEBHOOK_MODE, callback_allowed
+import metrics
+from metrics import span, record_cache
 
 load_dotenv()
 app = FastAPI()
-client = OpenAI()
+SYSTEM_PROMPT = load_prompt_template(os.getenv("PROMPT_PATH", "prompt.txt"))
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", 0))  # Segundos; 0 = sin watcher
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Arranque: el servidor acepta tráfico apenas están la BD y los workers; el índice se
+# construye en segundo plano y, hasta que está listo, se responde sin RAG.
+# /healthz = el proceso vive; /readyz = índice cargado (503 mientras tanto).
+boot = {"import_seconds": None, "startup_seconds": None, "index": "pending", "index_seconds": None,
+        "ready_after_seconds": None, "index_error": None}
+INDEX_RETRY_MAX = float(os.getenv("INDEX_RETRY_MAX", 60))  # Tope del backoff si la indexación inicial falla
+background_tasks = []
 
 @app.on_event("startup")
-def startup():
+async def startup():
     print("🚀 Iniciando Cerebro...")
+    started = time.perf_counter()
     init_db()
-    init_vector_db()
+    await conversation_store.start()
+    await email_outbox.start()
+    await history_compactor.start()
+    if job_runner:
+        await job_runner.start()
+    background_tasks.append(asyncio.create_task(build_index()))
+    # El cliente de OpenAI se arma en un hilo para que el primer request no pague el import
+    background_tasks.append(asyncio.create_task(asyncio.to_thread(client.get)))
+    if INDEX_WATCH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(watch_documents()))
+    boot["startup_seconds"] = round(time.perf_counter() - started, 3)
+    print(f"⏱️ Import: {boot['import_seconds']}s, startup: {boot['startup_seconds']}s. Indexando en segundo plano...")
+
+async def build_index():
+    boot["index"] = "building"
+    started, delay = time.perf_counter(), 1.0
+    while True:
+        try:
+            await asyncio.to_thread(init_vector_db)
+            break
+        except Exception as e:
+            boot["index_error"] = f"{e.__class__.__name__}: {e}"
+            print(f"❌ Error en la indexación inicial ({e}), reintento en {delay:.0f}s. Se responde sin RAG.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, INDEX_RETRY_MAX)
+    boot.update(index="ready", index_error=None, index_seconds=round(time.perf_counter() - started, 3),
+                ready_after_seconds=round(time.perf_counter() - IMPORT_STARTED, 3))
+    print(f"✅ Índice listo en {boot['index_seconds']}s ({boot['ready_after_seconds']}s desde el import).")
+
+async def watch_documents():
+    # Re-indexa en caliente cuando cambia algo en data/ (sin reiniciar el servidor)
+    last = await asyncio.to_thread(documents_signature)
+    while True:
+        await asyncio.sleep(INDEX_WATCH_INTERVAL)
+        current = await asyncio.to_thread(documents_signature)
+        if current == last: continue
+        last = current
+        print("🔄 Cambios en data/, re-indexando...")
+        try:
+            await asyncio.to_thread(init_vector_db)
+        except Exception as e:
+            print(f"❌ Error re-indexando: {e}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Primero dejamos de tomar jobs, después el historial pendiente, y al final las conexiones
+    for task in background_tasks:
+        task.cancel()
+    if job_runner:
+        await job_runner.close()
+    await history_compactor.close()
+    await conversation_store.close()
+    await email_outbox.close()
+    await close_clients()
+    await async_engine.dispose()
+
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    # Cada request junta sus spans en una traza que vuelve en el header Server-Timing
+    # (curl -i / DevTools muestran el desglose). En streaming los headers salen antes que las
+    # etapas, así que ahí solo llega el total hasta los headers; los histogramas sí lo registran todo.
+    trace, token = metrics.start_trace()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.end_trace(token)
+        route = request.scope.get("route")
+        path = getattr(route, "path", None) or "other"  # Plantilla (/jobs/{job_id}), no la URL: acota las series
+        metrics.chat_requests.observe(elapsed, path, str(status))
+    if metrics.METRICS_ENABLED:
+        response.headers["Server-Timing"] = metrics.server_timing(trace, elapsed)
+    return response
 
 class WebhookReq(BaseModel):
     phone: str
     message: str
+    message_id: Optional[str] = None    # Id del mensaje en el gateway (clave de idempotencia en modo cola)
+    callback_url: Optional[str] = None  # Modo cola: a dónde enviar la respuesta
 
-@app.post("/webhook")
-def chat(req: WebhookReq, db: Session = Depends(get_db)):
-    
-    # 1. Recuperar Estado (Postgres)
-    user, is_new = get_or_create_user(db, req.phone)
-    history = get_chat_history(db, user.id, limit=10) # Max 10 mensajes
-    
-    # 2. Recuperar Contexto (RAG con Metadatos)
-    rag_context = search_context(req.message) if len(req.message) > 5 else ""
-
-    # 3. PROMPT ENGINEERING
-    system_instruction = f"""
-    ### ASIGNACIÓN DE ROL (Persona Pattern) ###
-    Eres 'SolarBot', el asistente comercial experto en energía solar de 'SolarTech'.
-    Tu tono es profesional, persuasivo pero conciso.
-
-    ### INYECCIÓN DE CONTEXTO (RAG) ###
-    Usa EXCLUSIVAMENTE la siguiente información para responder dudas técnicas. 
-    Cada fragmento tiene su fuente y página, ÚSALA si es necesario citar.
-    
-    {rag_context}
-
-    ### DATOS DEL USUARIO ###
-    - Nombre: {user.name or 'No identificado'}
-    - Etapa actual: {user.stage} (Las etapas son: onboarding -> qualifying -> closed)
-
-    ### INSTRUCCIONES (Chain of Thought / Zero-Shot CoT) ###
-    Antes de responder, PIENSA PASO A PASO internamente:
-    1. Analiza en qué etapa de venta está el usuario.
-    2. Revisa si el usuario te acaba de dar su nombre o correo.
-    3. Si te dio datos, DEBES ejecutar la herramienta 'update_lead_info'.
-    4. Verifica el contexto RAG. Si la respuesta no está ahí, di que no sabes.
-    
-    ### FORMATO Y RESTRICCIONES ###
-    - Respuestas cortas (máximo 50 palabras).
-    - Si usas información del contexto, cita la página así: (Fuente: Pag X).
-    
-    ### FEW-SHOT PROMPTING (Ejemplos) ###
-    Usuario: "Hola"
-    Tú: "¡Hola! Bienvenido a SolarTech. Soy SolarBot. Para empezar, ¿cuál es tu nombre?"
-    
-    Usuario: "Me llamo Juan"
-    Tú (Tool call): update_lead_info(name="Juan", stage="qualifying")
-    Tú (Respuesta): "Gracias Juan. ¿Buscas paneles para Casa o Industria?"
-
-    ### NEGATIVE PROMPTING ###
-    - NO inventes precios que no estén en el contexto.
-    - NO saludes de nuevo si ya hay historial reciente.
-    - NO pidas el correo si estás en etapa 'onboarding', primero el nombre.
-    """
-
-    messages_payload = [
-        {"role": "system", "content": system_instruction}
-    ] + history + [{"role": "user", "content": req.message}]
-
-    # 4. PRIMERA LLAMADA (PENSAMIENTO)
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages_payload,
-        tools=tools_schema,
-        tool_choice="auto",
-        temperature=0.0
+async def load_state(db: AsyncSession, phone: str):
+    with span("db.user") as s:
+        user, is_new = await get_or_create_user(db, phone)
+        s.set(new=is_new)
+    with span("db.history") as s:
+        misses = conversation_store.stats["misses"]
+        history = await conversation_store.get_history(db, user.id, limit=10) # Max 10 mensajes
+        s.set(cache_hit=conversation_store.stats["misses"] == misses)
+        summary = await conversation_store.get_summary(db, user.id)  # Lo que ya se compactó (suele venir del caché)
+    return user, history, summary
+
+async def safe_search(query: str, tenant=None):
+    # Si falla la recuperación respondemos sin RAG en lugar de tumbar el turno
+    try:
+        with span("rag.search", tenant=tenant) as s:
+            hits = await search_hits(query, tenant=tenant)
+            s.set(hits=len(hits))
+        return hits
+    except Exception as e:
+        print(f"⚠️ RAG no disponible ({e.__class__.__name__}: {e}), respondiendo sin contexto.")
+        return []
+
+def build_system_prompt(user, rag_context: str, summary=None):
+    # Prefijo estático (cacheable) + contexto y datos del usuario al final
+    return SYSTEM_PROMPT.render(
+        rag_context=rag_context,
+        user_name=user.name or 'No identificado',
+        user_stage=user.stage,
+        conversation_summary=summary or 'Ninguno',
     )
-    
+
+async def route_and_search(message: str, tenant=None):
+    # El router decide si hace falta RAG; si hace falta, la búsqueda reutiliza su embedding
+    with span("router") as s:
+        route = await route_message(message, tenant)
+        s.set(intent=route["intent"], source=route["source"])
+    hits = await safe_search(message, tenant) if route["rag"] else []
+    return route, hits
+
+def answer_scope(user, history, route, hits, message: str):
+    # Solo preguntas de catálogo respondidas con RAG y sin datos del usuario en el mensaje.
+    # La etapa y si hay historial (el prompt cambia con eso) separan grupos; el nombre no:
+    # las respuestas que lo mencionan no se guardan (ver store_answer).
+    if not ANSWER_CACHE or route["reply"] or route["intent"] != "question" or not hits:
+        return None
+    if mentions_personal_data(message):
+        answer_cache.skip("personal_data")
+        return None
+    if all(hit.get("retrieval") == "lexical" for hit in hits):
+        # La búsqueda resolvió sin embedding: el caché no justifica calcularlo ahora
+        answer_cache.skip("lexical_only")
+        return None
+    if depends_on_history(message, hits, history):
+        answer_cache.skip("follow_up")
+        return None
+    return route["model"], user.stage, bool(history)
+
+async def lookup_answer(user, history, route, hits, message: str):
+    # Acierto: la respuesta guardada pasa a ser la respuesta fija del turno (sin completion)
+    scope = answer_scope(user, history, route, hits, message)
+    if scope is None: return
+    try:
+        with span("answer_cache") as s:
+            key = await answer_key(message, hits, *scope)
+            cached = answer_cache.get(*key)
+            s.set(hit=cached is not None)
+    except Exception as e:
+        print(f"⚠️ Caché de respuestas no disponible ({e.__class__.__name__}).")
+        return
+    record_cache("answer", cached is not None)
+    if cached is not None:
+        route.update(reply=cached, source="answer_cache")
+    else:
+        route["answer_key"] = key
+
+def store_answer(user, route, text, tool_calls):
+    if not route["answer_key"] or not text: return
+    if tool_calls:
+        answer_cache.skip("tools")  # Tuvo efectos: no es una respuesta de catálogo
+    elif user.name and user.name.casefold() in text.casefold():
+        answer_cache.skip("personalized")
+    else:
+        answer_cache.set(*route["answer_key"], text)
+
+async def prepare_turn(db: AsyncSession, req: WebhookReq):
+    # 1. Recuperar Estado (Postgres) y 2. Ruta + Contexto (RAG con Metadatos) EN PARALELO,
+    # salvo que la colección dependa de la etapa del usuario (hay que leerlo primero)
+    if needs_stage(req.phone):
+        user, history, summary = await load_state(db, req.phone)
+        route, hits = await route_and_search(req.message, resolve_tenant(req.phone, user.stage))
+    else:
+        (user, history, summary), (route, hits) = await asyncio.gather(
+            load_state(db, req.phone),
+            route_and_search(req.message, resolve_tenant(req.phone)),
+        )
+    route = finalize_route(route, user, history)
+    await lookup_answer(user, history, route, hits, req.message)
+    record_route(route)
+    if route["updates"]:
+        apply_lead_updates(user, route["updates"])
+    if route["reply"]:
+        return user, None, route  # Respuesta fija: no hace falta armar el prompt
+
+    # 3. PROMPT ENGINEERING (dentro del presupuesto de tokens)
+    with span("prompt.assemble") as s:
+        messages_payload, stats = assemble_messages(
+            lambda rag_context: build_system_prompt(user, rag_context, summary),
+            history, hits, req.message, format_context,
+        )
+        s.set(tokens=stats["prompt_tokens"], saved=stats["saved_tokens"])
+    print(f"✂️ Prompt: {stats['prompt_tokens']} tokens (ahorro {stats['saved_tokens']}), "
+          f"historial {stats['turns_kept']}/{stats['turns_total']}, contexto {stats['hits_kept']}/{stats['hits_total']}")
+    return user, messages_payload, route
+
+def turn_messages(user_messages, final_text):
+    # Cada mensaje del usuario en su propia fila (en orden de llegada) y después la respuesta
+    if not final_text: return []
+    return [("user", m) for m in user_messages] + [("assistant", final_text)]
+
+async def run_tools(tool_calls, db: AsyncSession, user, messages_payload):
+    # Ejecutar lógica Python: todas las herramientas EN PARALELO (con timeout cada una)
+    results = await run_tools_parallel(tool_calls, db, user)
+
+    # Agregar el resultado de cada herramienta, en el orden en que las pidió el modelo
+    for tool, (result, _) in zip(tool_calls, results):
+        messages_payload.append({
+            "role": "tool",
+            "tool_call_id": tool.id,
+            "content": str(result)
+        })
+    return results
+
+async def process_turn(phone: str, user_messages, commit=lambda: None):
+    # Un turno completo para uno o varios mensajes seguidos del mismo teléfono.
+    # commit() marca el punto sin retorno: antes de eso el coalescer puede cancelar el turno
+    # (no hubo efectos; la sesión hace rollback), después ya no.
+    req = WebhookReq(phone=phone, message="\n".join(user_messages))
+    async with SessionLocal() as db:
+        return await answer_turn(db, req, user_messages, commit)
+
+async def answer_turn(db: AsyncSession, req: WebhookReq, user_messages, commit):
+    user, messages_payload, route = await prepare_turn(db, req)
+    if route["reply"]:
+        commit()
+        await conversation_store.save_turn(db, user.id, turn_messages(user_messages, route["reply"]))
+        return route["reply"]
+
+    # 4. PRIMERA LLAMADA (PENSAMIENTO), con el modelo que eligió el router
+    with span("llm.first", model=route["model"]) as s:
+        response = await client.chat.completions.create(
+            model=route["model"],
+            messages=messages_payload,
+            tools=tools_schema,
+            tool_choice="auto",
+            temperature=0.0
+        )
+        if response.usage: s.set(tokens=response.usage.total_tokens)
+
+    record_usage(response.usage)
     ai_msg = response.choices[0].message
     final_text = ai_msg.content
+    store_answer(user, route, final_text, ai_msg.tool_calls)
 
     # 5. EJECUCIÓN DE TOOLS (CORREGIDO ✅)
     if ai_msg.tool_calls:
         print(f"🛠️ El Bot quiere ejecutar {len(ai_msg.tool_calls)} herramientas.")
         
         # A) Agregamos la intención del asistente AL HISTORIAL UNA SOLA VEZ
+        commit()  # Las tools tienen efectos (BD, correos): este turno ya no se cancela
         messages_payload.append(ai_msg)
 
         # B) Ejecutamos TODAS las herramientas que pidió
-        for tool in ai_msg.tool_calls:
-            # Ejecutar lógica Python
-            result = execute_tool(tool, db, user)
-            
-            # Agregar el resultado de ESTA herramienta específica
-            messages_payload.append({
-                "role": "tool", 
-                "tool_call_id": tool.id, 
-                "content": str(result)
-            })
-
-        # C) Hacemos la SEGUNDA llamada UNA SOLA VEZ (con todos los resultados listos)
-        resp_2 = client.chat.completions.create(
-            model="gpt-4o", messages=messages_payload
-        )
-        final_text = resp_2.choices[0].message.content
+        with span("tools", n=len(ai_msg.tool_calls)):
+            results = await run_tools(ai_msg.tool_calls, db, user, messages_payload)
+
+        # C) SEGUNDA llamada UNA SOLA VEZ (con todos los resultados listos), solo si hace falta:
+        #    si el modelo ya respondió y las tools eran de puro efecto, su texto sirve tal cual
+        followup = needs_followup(final_text, ai_msg.tool_calls, results)
+        record_followup(followup)
+        if followup:
+            with span("llm.second", model=route["model"]):
+                resp_2 = await client.chat.completions.create(
+                    model=route["model"], messages=messages_payload
+                )
+            record_usage(resp_2.usage)
+            final_text = resp_2.choices[0].message.content
+        else:
+            print("⏭️ Tools de solo efecto y respuesta lista: se omite la segunda llamada.")
 
-    # 6. GUARDAR HISTORIAL
-    if final_text:
-        save_message(db, user.id, "user", req.message)
-        save_message(db, user.id, "assistant", final_text)
+    # 6. GUARDAR HISTORIAL (caché + escritura diferida) y cambios del usuario
+    commit()
+    with span("history.save"):
+        await conversation_store.save_turn(db, user.id, turn_messages(user_messages, final_text))
+    return final_text
+
+coalescer = MessageCoalescer(process_turn)
+
+async def answer_message(phone: str, message: str):
+    # -> (texto | None, mensajes en el turno)
+    if COALESCE_WINDOW <= 0:
+        # Sin agrupar, pero igual un turno a la vez por teléfono
+        async with coalescer.phone_lock(phone):
+            return await process_turn(phone, [message]), 1
+    return await coalescer.submit(phone, message)
+
+async def handle_job(job):
+    # Worker del modo cola: mismo turno que el modo síncrono
+    final_text, merged = await answer_message(job["phone"], job["payload"]["message"])
+    return {"response": final_text, "merged": merged}
+
+job_runner = JobRunner(handle_job) if WEBHOOK_MODE == "queue" else None
+
+def job_view(job):
+    view = {"job_id": job["id"], "status": job["status"], "attempts": job["attempts"], "status_url": f"/jobs/{job['id']}"}
+    if job["started_at"]: view["wait_seconds"] = round(job["started_at"] - job["created_at"], 3)
+    if job["status"] == "done": view.update(job["result"])
+    if job["status"] == "failed": view["error"] = job["error"]
+    return view
+
+@app.post("/webhook")
+async def chat(req: WebhookReq, idempotency_key: str = Header(default=None)):
+    if job_runner:
+        # Modo cola: se acepta, se guarda y se responde 202 sin esperar al modelo
+        if req.callback_url and not callback_allowed(req.callback_url):
+            raise HTTPException(status_code=422, detail="callback_url no permitida (solo http/https a JOB_CALLBACK_HOSTS)")
+        payload = {"message": req.message, "callback_url": req.callback_url}
+        job, created = await job_runner.submit(req.phone, payload, idempotency_key or req.message_id)
+        if job is None:
+            raise HTTPException(status_code=429, detail="Cola llena, reintentar más tarde", headers={"Retry-After": "5"})
+        return JSONResponse(status_code=202, content={**job_view(job), "duplicate": not created})
+
+    # Ráfagas del mismo teléfono: un solo turno para todos los mensajes. La respuesta va en la
+    # petición del último; las anteriores reciben None (ya están contestadas en ese turno).
+    final_text, merged = await answer_message(req.phone, req.message)
+    return {"response": final_text, "merged": merged}
+
+def sse(event: dict):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+async def stream_completion(stage="llm.first", **kwargs):
+    # Reenvía los tokens apenas llegan y arma en paralelo el texto y las tool calls
+    # (los argumentos de una tool call llegan fragmentados en varios deltas)
+    started = time.perf_counter()
+    with span(stage, model=kwargs.get("model")) as s:
+        stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        text, calls = "", {}
+        async for chunk in stream:
+            if chunk.usage:
+                record_usage(chunk.usage)
+                s.set(tokens=chunk.usage.total_tokens)
+            if not chunk.choices: continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if not text:
+                    # Tiempo hasta el primer token: lo que el usuario percibe como latencia
+                    metrics.chat_stages.observe(time.perf_counter() - started, stage + ".ttft")
+                text += delta.content
+                yield "delta", delta.content
+            for tc in delta.tool_calls or []:
+                call = calls.setdefault(tc.index, {"id": None, "name": "", "arguments": ""})
+                if tc.id: call["id"] = tc.id
+                if tc.function and tc.function.name: call["name"] += tc.function.name
+                if tc.function and tc.function.arguments: call["arguments"] += tc.function.arguments
+    tool_calls = [
+        SimpleNamespace(id=c["id"], type="function", function=SimpleNamespace(name=c["name"], arguments=c["arguments"]))
+        for _, c in sorted(calls.items())
+    ]
+    yield "end", (text, tool_calls)
+
+@app.post("/webhook/stream")
+async def chat_stream(req: WebhookReq):
+    # Mismo flujo que /webhook, pero la respuesta sale como Server-Sent Events.
+    # La sesión de BD vive dentro del generador porque el cuerpo se envía después de que el endpoint retorna.
+    # No se agrupa (cada petición es su propio turno), pero sí va en orden con el resto del teléfono.
+    async def events():
+        async with coalescer.phone_lock(req.phone), SessionLocal() as db:
+            user, messages_payload, route = await prepare_turn(db, req)
+            if route["reply"]:
+                await conversation_store.save_turn(db, user.id, turn_messages([req.message], route["reply"]))
+                yield sse({"type": "delta", "content": route["reply"]})
+                yield sse({"type": "done", "response": route["reply"]})
+                return
+
+            # 4. PRIMERA LLAMADA (en streaming)
+            async for kind, value in stream_completion(
+                model=route["model"], messages=messages_payload,
+                tools=tools_schema, tool_choice="auto", temperature=0.0
+            ):
+                if kind == "delta": yield sse({"type": "delta", "content": value})
+                else: final_text, tool_calls = value
+            store_answer(user, route, final_text, tool_calls)
+
+            # 5. EJECUCIÓN DE TOOLS a mitad del stream, luego seguimos transmitiendo la segunda respuesta
+            if tool_calls:
+                print(f"🛠️ El Bot quiere ejecutar {len(tool_calls)} herramientas.")
+                yield sse({"type": "tools", "names": [t.function.name for t in tool_calls]})
+                messages_payload.append({
+                    "role": "assistant",
+                    "content": final_text or None,
+                    "tool_calls": [
+                        {"id": t.id, "type": "function", "function": {"name": t.function.name, "arguments": t.function.arguments}}
+                        for t in tool_calls
+                    ],
+                })
+                with span("tools", n=len(tool_calls)):
+                    results = await run_tools(tool_calls, db, user, messages_payload)
+
+                followup = needs_followup(final_text, tool_calls, results)
+                record_followup(followup)
+                if followup:
+                    async for kind, value in stream_completion("llm.second", model=route["model"], messages=messages_payload):
+                        if kind == "delta": yield sse({"type": "delta", "content": value})
+                        else: final_text, _ = value
+                else:
+                    print("⏭️ Tools de solo efecto y respuesta lista: se omite la segunda llamada.")
+
+            # 6. GUARDAR HISTORIAL (el texto completo ya ensamblado)
+            with span("history.save"):
+                await conversation_store.save_turn(db, user.id, turn_messages([req.message], final_text))
+
+            yield sse({"type": "done", "response": final_text})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def check_admin(token):
+    # Sin ADMIN_TOKEN configurado los endpoints de administración no existen (nada de reindexar gratis)
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Token inválido")
+
+def check_tenant(tenant):
+    if tenant and tenant not in tenants:
+        raise HTTPException(status_code=404, detail=f"Tenant desconocido: {tenant}")
+
+@app.post("/admin/reindex")
+async def admin_reindex(tenant: Optional[str] = None, x_admin_token: str = Header(default=None)):
+    # Re-indexación incremental bajo demanda; las búsquedas siguen funcionando mientras tanto
+    check_admin(x_admin_token)
+    check_tenant(tenant)
+    return await asyncio.to_thread(init_vector_db, None, tenant)
+
+@app.get("/admin/search")
+async def admin_search(q: str, tenant: Optional[str] = None, source: Optional[str] = None,
+                       doc_type: Optional[str] = None, page_from: Optional[int] = None,
+                       page_to: Optional[int] = None, limit: int = 3, x_admin_token: str = Header(default=None)):
+    # Para revisar qué recupera cada colección / filtro (sin pasar por el modelo)
+    check_admin(x_admin_token)
+    check_tenant(tenant)
+    filters = {"source": source, "doc_type": doc_type, "page": (page_from, page_to)}
+    hits = await search_hits(q, limit=limit, tenant=tenant, filters=filters)
+    return [{k: v for k, v in hit.items() if k != "page_hash"} for hit in hits]
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    # Polling de la respuesta en modo cola
+    job = await asyncio.to_thread(job_runner.queue.get, job_id) if job_runner else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    return job_view(job)
+
+@app.get("/stats/cache")
+async def stats_cache():
+    # Aciertos/fallos de los cachés de RAG e historial (para dimensionarlos) + decisiones del router
+    return {**cache_stats(), "history": conversation_store.snapshot(), "prompt_cache": prompt_cache_stats(),
+            "router": router_snapshot(), "outbox": email_outbox.snapshot(),
+            "tools": dict(tool_stats), "coalescer": coalescer.snapshot(), "compaction": history_compactor.snapshot(),
+            "queue": await job_runner.snapshot() if job_runner else None}
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    ready = index_ready.is_set()
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, **boot})
+
+@app.get("/metrics")
+async def get_metrics():
+    # Formato de texto de Prometheus: histogramas por etapa + colas y cachés al momento del scrape
+    history = conversation_store.snapshot()
+    queue = await job_runner.snapshot() if job_runner else {"depth": 0, "running": 0, "oldest_wait": 0.0}
+    caches = {name: stats["size"] for name, stats in cache_stats().items() if "size" in stats}
+    lines = (
+        metrics.gauge_lines("queue_depth", "Jobs en cola y en ejecución (modo cola)",
+                            {"queued": queue["depth"], "running": queue["running"]})
+        + metrics.gauge_lines("queue_oldest_wait_seconds", "Espera del job más viejo en cola", queue["oldest_wait"])
+        + metrics.gauge_lines("history_pending_writes", "Turnos de historial pendientes de escribir", history["pending"])
+        + metrics.gauge_lines("coalescer_active_phones", "Teléfonos con turnos en vuelo", coalescer.snapshot()["active_phones"])
+        + metrics.gauge_lines("cache_entries", "Entradas por caché", caches)
+        + metrics.gauge_lines("index_ready", "1 si el índice terminó de cargar", int(index_ready.is_set()))
+    )
+    return PlainTextResponse(metrics.render(lines))
 
-    return {"response": final_text}
\ No newline at end of file
+boot["import_seconds"] = round(time.perf_counter() - IMPORT_STARTED, 3)
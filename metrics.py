@@ -0,0 +1,165 @@
+import os
+import time
+import bisect
+import threading
+from contextvars import ContextVar
+
+# Instrumentación liviana del pipeline (pensada para dejarla prendida en producción):
+#   - span("etapa", **atributos): mide una etapa y la acumula en un histograma
+#     (`chat_stage_seconds{stage=...}`, o el que se indique) y en la traza del request actual.
+#   - La traza del request (ContextVar) se devuelve en el header Server-Timing,
+#     así el navegador / curl -v muestran en qué se fue el tiempo.
+#   - /metrics expone todo en formato de texto de Prometheus.
+# Costo por span: dos perf_counter + un bisect + un lock; nada de I/O.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_trace = ContextVar("trace", default=None)
+
+def format_labels(names, values):
+    if not names: return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(34), chr(39))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # valores de labels -> [conteos por bucket..., +Inf], suma
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(k, list(v[0]), v[1]) for k, v in self.series.items()]
+        for label_values, counts, total in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        lines += [f"{self.name}{format_labels(self.labels, k)} {v}" for k, v in items]
+        return lines
+
+registry = []
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help, labels, buckets)
+    registry.append(metric)
+    return metric
+
+def counter(name, help, labels=()):
+    metric = Counter(name, help, labels)
+    registry.append(metric)
+    return metric
+
+chat_stages = histogram("chat_stage_seconds", "Duración de cada etapa del turno de chat", ("stage",))
+chat_requests = histogram("chat_request_seconds", "Duración total de los requests HTTP", ("path", "status"))
+index_stages = histogram("index_stage_seconds", "Duración de cada etapa de la indexación", ("stage",))
+tokens_total = counter("chat_tokens_total", "Tokens reportados por la API del modelo", ("kind",))
+cache_events = counter("cache_events_total", "Aciertos y fallos de caché por etapa", ("cache", "result"))
+
+class Span:
+    # with span("rag.embed") as s: ... ; s.set(cache_hit=True)
+    # Funciona igual en código síncrono y dentro de corutinas (solo mide tiempo de pared).
+    __slots__ = ("name", "metric", "attrs", "start")
+
+    def __init__(self, name, metric=chat_stages, **attrs):
+        self.name = name
+        self.metric = metric
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not METRICS_ENABLED: return False
+        elapsed = time.perf_counter() - self.start
+        self.metric.observe(elapsed, self.name)
+        if exc_type is not None: self.attrs["error"] = exc_type.__name__
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((self.name, elapsed, self.attrs))
+        return False
+
+def span(name, metric=chat_stages, **attrs):
+    return Span(name, metric, **attrs)
+
+def record_cache(cache: str, hit: bool):
+    if METRICS_ENABLED:
+        cache_events.inc(1, cache, "hit" if hit else "miss")
+
+def start_trace():
+    # Devuelve (traza, token); la traza es una lista que se comparte con las tareas hijas
+    trace = []
+    return trace, _trace.set(trace)
+
+def end_trace(token):
+    _trace.reset(token)
+
+def server_timing(trace, total=None):
+    # Server-Timing: db.user;dur=1.2, rag.search;dur=35.0;desc="cache_hit=True"
+    parts = []
+    for name, elapsed, attrs in trace[:40]:  # Un tope para no inflar el header
+        part = f"{name};dur={elapsed * 1000:.1f}"
+        if attrs:
+            desc = " ".join(f"{k}={v}" for k, v in attrs.items()).replace('"', "'")
+            desc = desc.encode("ascii", "ignore").decode()  # Los headers HTTP son latin-1
+            part += f';desc="{desc}"'
+        parts.append(part)
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+def gauge_lines(name, help, values):
+    # Valores instantáneos (profundidad de colas, tamaño de cachés) calculados al momento del scrape.
+    # values: {etiqueta: número} o un número solo
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    if isinstance(values, dict):
+        lines += [f'{name}{{name="{k}"}} {v}' for k, v in values.items()]
+    else:
+        lines.append(f"{name} {values}")
+    return lines
+
+def render(extra_lines=()):
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    lines += list(extra_lines)
+    return "\n".join(lines) + "\n"
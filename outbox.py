@@ -0,0 +1,271 @@
+import os
+import time
+import uuid
+import queue
+import random
+import smtplib
+import asyncio
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from sqlalchemy import select, update
+from database import SessionLocal, OutboxEmail
+
+# Outbox de correos: send_email solo inserta una fila en `outbox_emails` y responde
+# al instante; un worker en segundo plano los envía por lotes reutilizando
+# conexiones SMTP (sin handshake TLS + login por cada correo) y reintenta con backoff.
+#   - Los correos sobreviven a un reinicio: están en la BD, no en memoria.
+#   - Con varios workers de uvicorn cada fila se "reclama" con un UPDATE condicional
+#     (claimed_by) y un lease en next_attempt_at, así que no se envía dos veces.
+# Para probar en local: SMTP_HOST=localhost SMTP_PORT=1025 SMTP_SSL=0 y un servidor de
+# depuración (p. ej. `python -m aiosmtpd -n -l localhost:1025`) y SMTP_AUTH=0 (sin login).
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
+SMTP_SSL = os.getenv("SMTP_SSL", "1") == "1"            # 0 = texto plano (o STARTTLS con SMTP_STARTTLS=1)
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "0") == "1"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 20))
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))    # Conexiones simultáneas al servidor
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", 60))  # Segundos antes de descartar una conexión ociosa
+EMAIL_SENDER = os.getenv("EMAIL_SENDER")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+SMTP_AUTH = os.getenv("SMTP_AUTH", "1") == "1"  # 0 = servidor sin autenticación (relay interno, pruebas)
+
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "1") == "1"
+OUTBOX_INTERVAL = float(os.getenv("OUTBOX_INTERVAL", 2))        # Cada cuánto revisa la cola (además del aviso al encolar)
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", 20))               # Correos por lote
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 6))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 5))    # Segundos; se duplica en cada intento
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 600))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", 300))            # Si un proceso muere enviando, otro lo retoma después de esto
+
+class SMTPPool:
+    # Conexiones smtplib reutilizables. smtplib es bloqueante: se usan desde hilos,
+    # cada conexión por un solo hilo a la vez (la cola hace de préstamo/devolución).
+    def __init__(self, size=SMTP_POOL_SIZE):
+        self.size = size
+        self.idle = queue.LifoQueue()  # (conexión, último uso); LIFO = la más "caliente" primero
+        self.slots = queue.Queue()
+        for _ in range(size): self.slots.put(None)
+        self.stats = {"opened": 0, "reused": 0, "closed": 0}
+
+    def connect(self):
+        if SMTP_SSL:
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_STARTTLS: server.starttls()
+        if SMTP_AUTH:
+            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        self.stats["opened"] += 1
+        return server
+
+    def acquire(self):
+        self.slots.get()  # Acota las conexiones abiertas a `size`
+        while True:
+            try:
+                server, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - last_used < SMTP_IDLE_TIMEOUT:
+                self.stats["reused"] += 1
+                return server
+            self.discard(server)  # El servidor probablemente ya la cerró
+        try:
+            return self.connect()
+        except Exception:
+            self.slots.put(None)
+            raise
+
+    def release(self, server, broken=False):
+        if broken: self.discard(server)
+        else: self.idle.put((server, time.monotonic()))
+        self.slots.put(None)
+
+    def reconnect(self, server):
+        # Reemplaza una conexión caída sin soltar su lugar en el pool
+        self.discard(server)
+        return self.connect()
+
+    def discard(self, server):
+        self.stats["closed"] += 1
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(server)
+
+def build_message(row):
+    msg = MIMEText(row["body"])
+    msg['Subject'] = row["subject"]
+    msg['From'] = EMAIL_SENDER
+    msg['To'] = row["to_email"]
+    return msg
+
+def is_permanent(error):
+    # 5xx (destinatario inválido, mensaje rechazado) no se arregla reintentando
+    if isinstance(error, smtplib.SMTPRecipientsRefused): return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600 \
+        and not isinstance(error, smtplib.SMTPAuthenticationError)
+
+def send_group(pool: SMTPPool, rows):
+    # Corre en un hilo: una conexión del pool para todo el grupo.
+    # Devuelve {id: None si salió, o la excepción}
+    try:
+        server = pool.acquire()
+    except Exception as e:
+        return {row["id"]: e for row in rows}
+
+    results, broken = {}, False
+    for row in rows:
+        try:
+            if broken:
+                server = pool.reconnect(server)
+                broken = False
+            try:
+                server.send_message(build_message(row))
+            except smtplib.SMTPServerDisconnected:
+                # La conexión reutilizada se cayó: reconectamos una vez y reintentamos este correo
+                broken = True
+                server = pool.reconnect(server)
+                broken = False
+                server.send_message(build_message(row))
+            results[row["id"]] = None
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            results[row["id"]] = e  # Error del mensaje (p. ej. destinatario rechazado); la conexión sigue sirviendo
+        except Exception as e:
+            broken = True
+            results[row["id"]] = e
+    pool.release(server, broken=broken)
+    return results
+
+def retry_delay(attempts):
+    return min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX) * (0.8 + 0.4 * random.random())
+
+class EmailOutbox:
+    def __init__(self):
+        self.pool = SMTPPool()
+        self.worker_id = uuid.uuid4().hex
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.closing = False
+        self.stats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "batches": 0, "errors": 0}
+
+    def configured(self):
+        # Sin contraseña el servidor rechaza el envío (530) y el correo terminaría en `failed`
+        return bool(EMAIL_SENDER) and (bool(EMAIL_PASSWORD) or not SMTP_AUTH)
+
+    async def enqueue(self, to_email, subject, body, user_id=None):
+        # Sesión propia con commit inmediato: el worker tiene que ver la fila, y las tools
+        # corren en paralelo sobre la sesión del webhook (que no admite uso concurrente)
+        row = OutboxEmail(user_id=user_id, to_email=to_email, subject=subject, body=body,
+                          status="pending", attempts=0, next_attempt_at=datetime.utcnow())
+        async with SessionLocal() as db:
+            db.add(row)
+            await db.commit()
+        self.stats["queued"] += 1
+        self.wakeup.set()
+        return row.id
+
+    async def claim(self):
+        # Reclama hasta OUTBOX_BATCH correos vencidos; el lease evita que otro proceso los tome
+        now = datetime.utcnow()
+        async with SessionLocal() as db:
+            ids = (await db.execute(
+                select(OutboxEmail.id)
+                .where(OutboxEmail.status.in_(("pending", "sending")), OutboxEmail.next_attempt_at <= now)
+                .order_by(OutboxEmail.id).limit(OUTBOX_BATCH)
+            )).scalars().all()
+            if not ids: return []
+            await db.execute(
+                update(OutboxEmail)
+                .where(OutboxEmail.id.in_(ids), OutboxEmail.status.in_(("pending", "sending")),
+                       OutboxEmail.next_attempt_at <= now)
+                .values(status="sending", claimed_by=self.worker_id,
+                        next_attempt_at=now + timedelta(seconds=OUTBOX_LEASE))
+            )
+            await db.commit()
+            rows = (await db.execute(
+                select(OutboxEmail).where(OutboxEmail.id.in_(ids), OutboxEmail.claimed_by == self.worker_id,
+                                          OutboxEmail.status == "sending")
+            )).scalars().all()
+            return [{"id": r.id, "to_email": r.to_email, "subject": r.subject, "body": r.body,
+                     "attempts": r.attempts} for r in rows]
+
+    async def process_batch(self):
+        rows = await self.claim()
+        if not rows: return 0
+
+        # Se reparte el lote entre las conexiones del pool, cada grupo en su hilo
+        groups = [rows[i::self.pool.size] for i in range(self.pool.size) if rows[i::self.pool.size]]
+        results = {}
+        for part in await asyncio.gather(*(asyncio.to_thread(send_group, self.pool, g) for g in groups)):
+            results.update(part)
+
+        now = datetime.utcnow()
+        async with SessionLocal() as db:
+            for row in rows:
+                error = results.get(row["id"], RuntimeError("sin resultado"))
+                if error is None:
+                    values = {"status": "sent", "sent_at": now, "attempts": row["attempts"] + 1, "last_error": None}
+                    self.stats["sent"] += 1
+                else:
+                    attempts = row["attempts"] + 1
+                    if is_permanent(error) or attempts >= OUTBOX_MAX_ATTEMPTS:
+                        values = {"status": "failed", "attempts": attempts, "last_error": str(error)[:500]}
+                        self.stats["failed"] += 1
+                        print(f"❌ Correo {row['id']} a {row['to_email']} descartado tras {attempts} intentos: {error}")
+                    else:
+                        delay = retry_delay(attempts)
+                        values = {"status": "pending", "attempts": attempts, "last_error": str(error)[:500],
+                                  "next_attempt_at": now + timedelta(seconds=delay)}
+                        self.stats["retried"] += 1
+                        print(f"⏳ Correo {row['id']} falló ({error.__class__.__name__}), reintento en {delay:.0f}s.")
+                await db.execute(
+                    update(OutboxEmail).where(OutboxEmail.id == row["id"], OutboxEmail.claimed_by == self.worker_id)
+                    .values(**values)
+                )
+            await db.commit()
+        self.stats["batches"] += 1
+        print(f"📧 Outbox: {sum(1 for e in results.values() if e is None)}/{len(rows)} correos enviados.")
+        return len(rows)
+
+    async def run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=OUTBOX_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                # Lotes seguidos mientras haya trabajo vencido
+                while not self.closing and await self.process_batch() == OUTBOX_BATCH:
+                    pass
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"⚠️ Error en el outbox de correos: {e}")
+
+    async def start(self):
+        if OUTBOX_ENABLED and self.worker is None:
+            self.closing = False
+            self.worker = asyncio.create_task(self.run())
+
+    async def close(self):
+        # Termina el lote en curso; lo que quede pendiente sigue en la BD para el próximo arranque
+        self.closing = True
+        if self.worker:
+            self.wakeup.set()
+            await self.worker
+            self.worker = None
+        await asyncio.to_thread(self.pool.close)
+
+    def snapshot(self):
+        return {**self.stats, "smtp": dict(self.pool.stats)}
+
+email_outbox = EmailOutbox()
@@ -0,0 +1,155 @@
+import os
+import re
+import textwrap
+from metrics import tokens_total
+
+# Armado del prompt con presupuesto de tokens.
+# Orden de prioridad al llenar el presupuesto:
+#   1. System prompt + mensaje actual del usuario (siempre)
+#   2. Los turnos más recientes del historial (PROMPT_MIN_TURNS)
+#   3. El contexto RAG, en orden de ranking
+#   4. El resto del historial, del más nuevo al más viejo
+# Los turnos muy largos (p. ej. una ficha técnica pegada) se recortan a PROMPT_MAX_TURN_TOKENS.
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 3000))
+PROMPT_MIN_TURNS = int(os.getenv("PROMPT_MIN_TURNS", 2))
+PROMPT_MAX_TURN_TOKENS = int(os.getenv("PROMPT_MAX_TURN_TOKENS", 400))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")  # La de gpt-4o / gpt-4o-mini
+MESSAGE_OVERHEAD = 4  # Tokens extra que agrega cada mensaje del chat (rol, separadores)
+
+_encoder = None
+_encoder_loaded = False
+
+def get_encoder():
+    # tiktoken descarga el vocabulario la primera vez; si no hay red ni caché
+    # (TIKTOKEN_CACHE_DIR), usamos una aproximación para no tumbar el webhook
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        _encoder_loaded = True
+        try:
+            import tiktoken
+            _encoder = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"⚠️ Tokenizador no disponible ({e.__class__.__name__}), usando conteo aproximado.")
+    return _encoder
+
+def count_tokens(text: str):
+    if not text: return 0
+    encoder = get_encoder()
+    if encoder:
+        return len(encoder.encode(text))
+    # ~1 token por palabra/símbolo, y las palabras largas cuentan más
+    return sum(1 + len(w) // 6 for w in re.findall(r"\w+|[^\w\s]", text))
+
+def truncate_tokens(text: str, max_tokens: int):
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoder = get_encoder()
+    if encoder:
+        return encoder.decode(encoder.encode(text)[:max_tokens]) + " [...]"
+    words = text.split()
+    while words and count_tokens(" ".join(words)) > max_tokens:
+        words = words[:int(len(words) * 0.8)]
+    return " ".join(words) + " [...]"
+
+def message_tokens(message: dict):
+    return MESSAGE_OVERHEAD + count_tokens(message.get("content") or "")
+
+def assemble_messages(render_system, history, hits, user_message, format_context, budget=PROMPT_TOKEN_BUDGET):
+    # render_system(contexto) -> str ; format_context(hits) -> str
+    user_msg = {"role": "user", "content": user_message}
+    used = message_tokens({"content": render_system("")}) + message_tokens(user_msg)
+
+    turns = [
+        {**m, "content": truncate_tokens(m["content"] or "", PROMPT_MAX_TURN_TOKENS)}
+        for m in history
+    ]
+    keep = [False] * len(turns)
+    newest_first = list(range(len(turns) - 1, -1, -1))
+
+    def take_turns(indices):
+        nonlocal used
+        for i in indices:
+            cost = message_tokens(turns[i])
+            if used + cost > budget:
+                return  # Si no entra un turno, los más viejos tampoco (no dejamos huecos)
+            keep[i] = True
+            used += cost
+
+    # 2. Turnos más recientes
+    take_turns(newest_first[:PROMPT_MIN_TURNS])
+
+    # 3. Contexto RAG por ranking (si un fragmento no entra, probamos el siguiente)
+    selected_hits = []
+    for hit in hits:
+        cost = count_tokens(format_context([hit]))
+        if used + cost <= budget:
+            selected_hits.append(hit)
+            used += cost
+
+    # 4. Resto del historial, solo si el tramo reciente entró completo
+    if all(keep[i] for i in newest_first[:PROMPT_MIN_TURNS]):
+        take_turns(newest_first[PROMPT_MIN_TURNS:])
+
+    messages = [{"role": "system", "content": render_system(format_context(selected_hits))}]
+    messages += [t for t, k in zip(turns, keep) if k]
+    messages.append(user_msg)
+
+    # Lo que habría costado el prompt sin presupuesto (historial y contexto completos)
+    full = message_tokens({"content": render_system(format_context(hits))}) \
+        + sum(message_tokens(m) for m in history) + message_tokens(user_msg)
+    stats = {
+        "prompt_tokens": used, "full_tokens": full, "saved_tokens": max(full - used, 0),
+        "turns_kept": sum(keep), "turns_total": len(turns),
+        "hits_kept": len(selected_hits), "hits_total": len(hits),
+    }
+    return messages, stats
+
+
+# Plantilla del system prompt (prompt.txt), compilada UNA vez al arrancar.
+# Las secciones sin variables forman un prefijo invariante (idéntico byte a byte en
+# cada request) para que el proveedor pueda cachearlo; las secciones con variables
+# ({rag_context}, {user_name}, ...) se mueven al final.
+
+SECTION_HEADER = re.compile(r"^### .+ ###$", re.MULTILINE)
+PLACEHOLDER = re.compile(r"{\w+}")
+
+class PromptTemplate:
+    def __init__(self, text: str):
+        text = textwrap.dedent(text).strip()
+        starts = [m.start() for m in SECTION_HEADER.finditer(text)] or [0]
+        if starts[0] != 0: starts.insert(0, 0)
+        sections = [text[a:b].strip() for a, b in zip(starts, starts[1:] + [len(text)])]
+
+        self.prefix = "\n\n".join(s for s in sections if not PLACEHOLDER.search(s))
+        self.suffix = "\n\n".join(s for s in sections if PLACEHOLDER.search(s))
+        self.prefix_tokens = count_tokens(self.prefix)
+
+    def render(self, **values):
+        return self.prefix + "\n\n" + self.suffix.format(**values)
+
+def load_prompt_template(path: str):
+    with open(path, encoding="utf-8") as f:
+        template = PromptTemplate(f.read())
+    print(f"📝 Prompt compilado: prefijo estático de {template.prefix_tokens} tokens.")
+    return template
+
+# Uso reportado por la API: cuántos tokens del prompt salieron del caché del proveedor
+usage_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+def record_usage(usage):
+    if usage is None: return 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    usage_stats["requests"] += 1
+    usage_stats["prompt_tokens"] += usage.prompt_tokens or 0
+    usage_stats["completion_tokens"] += usage.completion_tokens or 0
+    usage_stats["cached_tokens"] += cached
+    tokens_total.inc(usage.prompt_tokens or 0, "prompt")
+    tokens_total.inc(usage.completion_tokens or 0, "completion")
+    tokens_total.inc(cached, "cached")
+    return cached
+
+def prompt_cache_stats():
+    total = usage_stats["prompt_tokens"]
+    return {**usage_stats, "cached_ratio": round(usage_stats["cached_tokens"] / total, 4) if total else 0.0}
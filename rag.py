@@ -1,70 +1,596 @@
 import os
-from qdrant_client import QdrantClient, models
-from openai import OpenAI
-from pypdf import PdfReader
+import json
+import time
+import asyncio
+import uuid
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from dotenv import load_dotenv
+from clients import client as client_ai, aclient
+from cache import EmbeddingStore, TTLCache, SemanticCache, normalize_query
+from lexical import BM25Index, rrf_fuse, tokenize, is_exact_token
+from chunking import get_chunker, CHUNK_STRATEGY, CHUNK_TOKENS, CHUNK_OVERLAP
+from extraction import iter_document_pages
+from vector_store import QdrantStore, NumpyStore, normalize_filters, merge_filters, matches_nothing, payload_matches
+from metrics import span, record_cache, index_stages
 
 load_dotenv()
-client_ai = OpenAI()
-qdrant = QdrantClient(location=":memory:") 
 COLLECTION_NAME = "solar_knowledge"
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIM = 1536
 
-def init_vector_db(pdf_path="data/conocimiento.pdf"):
-    if not os.path.exists(pdf_path):
-        print(f"⚠️ Archivo no encontrado: {pdf_path}")
-        return
-
-    qdrant.recreate_collection(
-        collection_name=COLLECTION_NAME,
-        vectors_config=models.VectorParams(size=1536, distance=models.Distance.COSINE),
-    )
-
-    print("--- 📄 Procesando PDF con Metadatos ---")
-    points = []
-    point_id = 0
-    pdf_name = os.path.basename(pdf_path)
-
-    reader = PdfReader(pdf_path)
-    
-    # Iteramos por página para capturar el número de página
-    for i, page in enumerate(reader.pages):
-        text = page.extract_text()
+# Backend vectorial (VECTOR_BACKEND):
+#   - "qdrant" (defecto): QDRANT_URL (servidor), QDRANT_PATH (local en disco) o en memoria.
+#   - "numpy": matriz contigua en proceso, con cuantización opcional (NUMPY_QUANTIZATION=
+#     none|float16|int8) y guardado/carga con memmap en NUMPY_INDEX_PATH.
+# Sin persistencia la colección se reconstruye al arrancar (desde el caché de embeddings,
+# así que sin pagar de nuevo).
+# Los stores se crean en la primera indexación (en segundo plano), no al importar el módulo.
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant")
+NUMPY_INDEX_PATH = os.getenv("NUMPY_INDEX_PATH") or None
+_qdrant = None
+_qdrant_lock = threading.Lock()
+
+def get_qdrant():
+    # Un solo cliente para todas las colecciones
+    global _qdrant
+    with _qdrant_lock:
+        if _qdrant is None:
+            from qdrant_client import QdrantClient
+            if os.getenv("QDRANT_URL"):
+                _qdrant = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+            elif os.getenv("QDRANT_PATH"):
+                _qdrant = QdrantClient(path=os.getenv("QDRANT_PATH"))
+            else:
+                _qdrant = QdrantClient(location=":memory:")
+    return _qdrant
+
+# Listo para buscar = terminó la primera indexación. Hasta entonces se responde sin RAG.
+index_ready = threading.Event()
+
+# Documentos a indexar: todo lo que haya en DATA_DIR (sub-carpetas incluidas)
+DATA_DIR = os.getenv("DATA_DIR", "data")
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".md")
+INDEX_MANIFEST_PATH = os.getenv("INDEX_MANIFEST_PATH", ".cache/index_manifest.json")
+
+# Lo que define cómo se ve un fragmento indexado. Va en el manifest y en el page_hash:
+# si cambia (otro chunker, otra ventana, otro modelo) se vuelve a fragmentar todo al arrancar,
+# aunque los archivos no hayan cambiado (los embeddings de textos repetidos salen del caché).
+INDEX_CONFIG = {"chunk_strategy": CHUNK_STRATEGY, "chunk_tokens": CHUNK_TOKENS,
+                "chunk_overlap": CHUNK_OVERLAP, "embed_model": EMBED_MODEL}
+INDEX_CONFIG_HASH = hashlib.sha256(json.dumps(INDEX_CONFIG, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+
+# Colecciones por tenant / línea de producto (TENANTS_PATH, JSON opcional):
+#   {"default": "solar",
+#    "tenants": {"solar": {"data_dir": "data", "collection": "solar_knowledge"},
+#                "industria": {"data_dir": "data_industria", "collection": "industria_knowledge",
+#                              "filters": {"doc_type": ["catalogos"]}}},
+#    "phone_prefixes": {"+5255": "industria"},
+#    "stages": {"closed": "postventa"}}
+# Cada tenant tiene su colección (y su BM25, manifest e índice en disco): una búsqueda solo
+# recorre lo de su tenant, así la latencia no crece con el corpus de los demás.
+# El tenant de un mensaje sale del prefijo del teléfono y, si no hay, de la etapa del usuario.
+# Cada fragmento lleva en el payload tenant, doc_type (primera carpeta dentro de data_dir:
+# data/manuales/x.pdf -> "manuales"; en la raíz, "general"), source y page, todos filtrables.
+# Sin archivo hay un solo tenant "default" = DATA_DIR en COLLECTION_NAME, igual que antes.
+TENANTS_PATH = os.getenv("TENANTS_PATH", "tenants.json")
+
+class KnowledgeBase:
+    def __init__(self, name, data_dir, collection, filters=None):
+        self.name = name
+        self.data_dir = data_dir
+        self.collection = collection
+        self.filters = filters or {}    # Filtros que se aplican siempre en este tenant
+        normalize_filters(self.filters)  # Falla al arrancar si el archivo trae un campo inválido
+        self.store = None
+        self.store_lock = threading.Lock()
+        self.index_lock = threading.Lock()  # Una sola re-indexación a la vez
+        self.manifest = {}                  # source -> sha256 del archivo ya indexado (con INDEX_CONFIG)
+        self.lexical_docs = {}              # source -> fragmentos vigentes (para BM25)
+        self.lexical_index = BM25Index()
+        # La colección de siempre conserva sus rutas; las demás van con sufijo
+        default = collection == COLLECTION_NAME
+        self.manifest_path = INDEX_MANIFEST_PATH if default else f"{os.path.splitext(INDEX_MANIFEST_PATH)[0]}.{collection}.json"
+        self.numpy_path = NUMPY_INDEX_PATH if default or not NUMPY_INDEX_PATH else f"{NUMPY_INDEX_PATH}.{collection}"
+
+    def get_store(self):
+        with self.store_lock:
+            if self.store is None:
+                self.store = self.make_store()
+        return self.store
+
+    def make_store(self):
+        if VECTOR_BACKEND == "numpy":
+            return NumpyStore(
+                EMBED_DIM,
+                quantization=os.getenv("NUMPY_QUANTIZATION", "none"),
+                path=self.numpy_path,
+                oversample=int(os.getenv("NUMPY_OVERSAMPLE", 4)),
+                block=int(os.getenv("NUMPY_SCORE_BLOCK", 2048)),  # Filas por bloque al puntuar (acota la memoria temporal)
+            )
+        qdrant_store = QdrantStore(get_qdrant(), self.collection, EMBED_DIM)
+        qdrant_store.persistent = bool(os.getenv("QDRANT_URL") or os.getenv("QDRANT_PATH"))
+        return qdrant_store
+
+def load_tenants(path=TENANTS_PATH):
+    # -> (tenants, tenant por defecto, {prefijo: tenant}, {etapa: tenant})
+    if not os.path.exists(path):
+        return {"default": KnowledgeBase("default", DATA_DIR, COLLECTION_NAME)}, "default", {}, {}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    tenants = {
+        name: KnowledgeBase(name, spec.get("data_dir", os.path.join(DATA_DIR, name)),
+                            spec.get("collection", f"{name}_knowledge"), spec.get("filters"))
+        for name, spec in config["tenants"].items()
+    }
+    collections = [kb.collection for kb in tenants.values()]
+    if len(set(collections)) != len(collections):
+        raise ValueError(f"{path}: cada tenant necesita su propia colección")
+    default = config.get("default") or next(iter(tenants))
+    routes = {**config.get("phone_prefixes", {}), **config.get("stages", {})}
+    unknown = {default, *routes.values()} - set(tenants)
+    if unknown:
+        raise ValueError(f"{path}: tenants no definidos: {', '.join(sorted(unknown))}")
+    # Prefijos más largos primero: "+5255" gana sobre "+52"
+    prefixes = dict(sorted(config.get("phone_prefixes", {}).items(), key=lambda kv: -len(kv[0])))
+    return tenants, default, prefixes, config.get("stages", {})
+
+tenants, DEFAULT_TENANT, PHONE_PREFIXES, STAGE_TENANTS = load_tenants()
+
+def tenant_for_phone(phone: str):
+    for prefix, tenant in PHONE_PREFIXES.items():
+        if phone.startswith(prefix):
+            return tenant
+    return None
+
+def needs_stage(phone: str):
+    # ¿Hace falta cargar al usuario para saber su tenant? (si no, búsqueda y BD van en paralelo)
+    return bool(STAGE_TENANTS) and tenant_for_phone(phone) is None
+
+def resolve_tenant(phone: str, stage=None):
+    return tenant_for_phone(phone) or STAGE_TENANTS.get(stage) or DEFAULT_TENANT
+
+def doc_type_for(source: str):
+    return source.split("/", 1)[0] if "/" in source else "general"
+
+# Caché de embeddings en disco (EMBED_CACHE_PATH="" lo desactiva)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", ".cache/embeddings.sqlite")
+embedding_store = EmbeddingStore(EMBED_CACHE_PATH) if EMBED_CACHE_PATH else None
+
+# Configuración de la ingesta (se puede ajustar por variables de entorno)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))        # Máx. fragmentos por llamada
+EMBED_BATCH_CHARS = int(os.getenv("EMBED_BATCH_CHARS", 24000))   # Máx. caracteres por llamada (~6k tokens)
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))       # Llamadas de embeddings en paralelo
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 5))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 256))     # Puntos por upsert a Qdrant
+
+# Cachés de consulta: embedding por texto normalizado y fragmentos recuperados.
+# El de contexto se vacía cada vez que se re-indexa la colección.
+query_cache = TTLCache(maxsize=int(os.getenv("QUERY_CACHE_SIZE", 2048)), ttl=int(os.getenv("QUERY_CACHE_TTL", 86400)))
+context_cache = TTLCache(maxsize=int(os.getenv("CONTEXT_CACHE_SIZE", 1024)), ttl=int(os.getenv("CONTEXT_CACHE_TTL", 3600)))
+
+# Caché de respuestas (preguntas de catálogo que no dependen del usuario): consulta parecida
+# (similitud >= ANSWER_CACHE_THRESHOLD) + mismos fragmentos recuperados => misma respuesta,
+# sin llamar al modelo. También se vacía al re-indexar.
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+answer_cache = SemanticCache(
+    maxsize=int(os.getenv("ANSWER_CACHE_SIZE", 512)),
+    ttl=int(os.getenv("ANSWER_CACHE_TTL", 21600)),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.92)),
+)
+
+# Búsqueda híbrida: BM25 local + Qdrant, combinados con RRF.
+# Si la consulta es de palabras clave y BM25 está seguro, ni siquiera se calcula el embedding.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 10))   # Candidatos por lado antes de fusionar
+retrieval_stats = {"lexical_only": 0, "hybrid": 0, "dense": 0, "not_ready": 0}
+
+def retryable_errors():
+    from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+    return (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+def make_batches(chunks, max_items=EMBED_BATCH_SIZE, max_chars=EMBED_BATCH_CHARS):
+    # Agrupa los fragmentos en lotes acotados por cantidad y por tamaño de texto
+    batch, size = [], 0
+    for chunk in chunks:
+        n = len(chunk["text"])
+        if batch and (len(batch) >= max_items or size + n > max_chars):
+            yield batch
+            batch, size = [], 0
+        batch.append(chunk)
+        size += n
+    if batch:
+        yield batch
+
+def embed_batch(texts):
+    # Una sola llamada para todo el lote, con reintentos y backoff exponencial (+ jitter)
+    for attempt in range(EMBED_MAX_RETRIES):
+        try:
+            resp = client_ai.with_options(max_retries=0).embeddings.create(input=texts, model=EMBED_MODEL)
+            return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+        except retryable_errors() as e:
+            if attempt == EMBED_MAX_RETRIES - 1:
+                raise
+            delay = min(2 ** attempt, 30) + random.random()
+            print(f"⏳ Embeddings falló ({e.__class__.__name__}), reintento en {delay:.1f}s...")
+            time.sleep(delay)
+
+def embed_texts(texts):
+    # Embeddings de textos sueltos (p. ej. los ejemplos del router) pasando por el caché en disco
+    cached = embedding_store.get_many(EMBED_MODEL, texts) if embedding_store else {}
+    missing = [t for t in dict.fromkeys(texts) if t not in cached]
+    for batch in make_batches([{"text": t} for t in missing]):
+        batch = [c["text"] for c in batch]
+        vectors = embed_batch(batch)
+        if embedding_store:
+            embedding_store.put_many(EMBED_MODEL, batch, vectors)
+        cached.update(zip(batch, vectors))
+    return [cached[t] for t in texts]
+
+def point_id_for(chunk):
+    # ID determinista: mismo documento + página + texto => mismo punto en Qdrant
+    digest = hashlib.sha256(f"{chunk['source']}|{chunk['page']}|{chunk['text']}".encode("utf-8")).hexdigest()
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, digest))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def page_fingerprint(text):
+    return hashlib.sha256(f"{INDEX_CONFIG_HASH}\x00{text}".encode("utf-8")).hexdigest()[:16]
+
+def iter_pdf_chunks(pdf_path, chunker=None, source=None, skip_page=None, **extra):
+    # Fragmentos de un documento con el payload que se indexa (la ingesta y los benchmarks usan este mismo).
+    # skip_page(page_no, page_hash) -> True: la página no se fragmenta (ya está indexada tal cual)
+    source = source or os.path.basename(pdf_path)
+    split = get_chunker(chunker)
+
+    for page_no, text in iter_document_pages(pdf_path):
         if not text: continue
-        
-        # Chunking simple por saltos de línea para no perder contexto de página
-        chunks = [t for t in text.split('\n') if len(t) > 30]
+        page_hash = page_fingerprint(text)
+        if skip_page and skip_page(page_no, page_hash): continue
 
-        for chunk in chunks:
-            # Vectorizamos
-            vec = client_ai.embeddings.create(input=chunk, model="text-embedding-3-small").data[0].embedding
-            
+        # Chunking por página (estrategia configurable) para no perder contexto de página
+        for chunk in split(text):
             # GUARDAMOS METADATOS CLAVE
-            payload = {
-                "text": chunk,
-                "source": pdf_name,
-                "page": i + 1  # Guardamos el número de página real
-            }
-
-            points.append(models.PointStruct(id=point_id, vector=vec, payload=payload))
-            point_id += 1
-    
-    qdrant.upsert(collection_name=COLLECTION_NAME, points=points)
-    print(f"✅ Indexado: {len(points)} fragmentos de {pdf_name}.")
-
-def search_context(query: str):
-    response = client_ai.embeddings.create(input=query, model="text-embedding-3-small")
-    hits = qdrant.query_points(
-        collection_name=COLLECTION_NAME,
-        query=response.data[0].embedding,
-        limit=3
-    ).points
-    
-    if not hits: return ""
-    
+            yield {"text": chunk, "source": source, "page": page_no, "page_hash": page_hash, **extra}
+
+def timed_embed_batch(texts):
+    with span("index.embed", index_stages, texts=len(texts)):
+        return embed_batch(texts)
+
+def backfill_payload(kb, store, source, docs):
+    # Puntos indexados antes de que existieran tenant / doc_type: se completan sin re-embeber
+    fields = {"tenant": kb.name, "doc_type": doc_type_for(source)}
+    if all(doc.get(k) == v for doc in docs for k, v in fields.items()):
+        return docs
+    store.set_payload(source, fields)
+    return [{**doc, **fields} for doc in docs]
+
+def index_document(kb, path, source):
+    # Indexa UN documento de forma incremental:
+    #   - páginas cuyo hash no cambió: no se extraen fragmentos ni se tocan sus puntos
+    #   - fragmentos con embedding en caché: se suben sin llamar a la API
+    #   - solo lo nuevo o modificado pasa a la etapa de embeddings
+    # Los puntos nuevos se suben ANTES de borrar los viejos: la búsqueda nunca queda vacía.
+    stats = {"chunks": 0, "embed_calls": 0, "upserts": 0, "cached": 0, "skipped": 0, "deleted": 0}
+    store = kb.get_store()
+    buffer = []
+    indexed = store.points(source)
+    indexed_pages = {}
+    for pid, payload in indexed.items():
+        indexed_pages.setdefault(payload.get("page"), []).append(pid)
+    page_hashes = {payload.get("page"): payload.get("page_hash") for payload in indexed.values()}
+    seen = set()
+    docs = []  # Fragmentos vigentes (para el índice léxico)
+
+    def flush():
+        if not buffer: return
+        with span("index.upsert", index_stages):
+            store.upsert(list(buffer))
+        stats["upserts"] += 1
+        buffer.clear()
+
+    def add_point(chunk, vec):
+        buffer.append((chunk["id"], vec, chunk["payload"]))
+        stats["chunks"] += 1
+        if len(buffer) >= UPSERT_BATCH_SIZE:
+            flush()
+
+    def keep_page(page_no, page_hash):
+        # Página sin cambios: sus puntos siguen valiendo tal cual
+        if page_hashes.get(page_no) != page_hash: return False
+        for pid in indexed_pages[page_no]:
+            seen.add(pid)
+            docs.append({**indexed[pid], "id": pid})
+        stats["skipped"] += len(indexed_pages[page_no])
+        return True
+
+    def chunks_to_embed():
+        pending = []
+        for payload in iter_pdf_chunks(path, source=source, skip_page=keep_page,
+                                       tenant=kb.name, doc_type=doc_type_for(source)):
+            pid = point_id_for(payload)
+            if pid in seen: continue
+            seen.add(pid)
+            docs.append({**payload, "id": pid})
+            pending.append({"id": pid, "text": payload["text"], "payload": payload})
+            if len(pending) >= EMBED_BATCH_SIZE:
+                yield from resolve_cached(pending)
+                pending = []
+        yield from resolve_cached(pending)
+
+    def resolve_cached(chunks):
+        cached = embedding_store.get_many(EMBED_MODEL, [c["text"] for c in chunks]) if embedding_store else {}
+        for chunk in chunks:
+            if chunk["text"] in cached:
+                stats["cached"] += 1
+                add_point(chunk, cached[chunk["text"]])
+            else:
+                yield chunk
+
+    # Pipeline: lotes -> embeddings concurrentes -> upsert por tandas.
+    # Limitamos los lotes "en vuelo" para no cargar todo el documento en memoria.
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
+        pending = {}
+        batches = make_batches(chunks_to_embed())
+        exhausted = False
+
+        while pending or not exhausted:
+            while not exhausted and len(pending) < EMBED_CONCURRENCY * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                pending[pool.submit(timed_embed_batch, [c["text"] for c in batch])] = batch
+
+            if not pending: break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                vectors = future.result()
+                stats["embed_calls"] += 1
+                if embedding_store:
+                    embedding_store.put_many(EMBED_MODEL, [c["text"] for c in batch], vectors)
+                for chunk, vec in zip(batch, vectors):
+                    add_point(chunk, vec)
+        flush()
+
+    # Fragmentos que ya no existen en el documento (texto o página cambiaron)
+    stale = set(indexed) - seen
+    if stale:
+        store.delete_ids(stale)
+        stats["deleted"] = len(stale)
+
+    kb.lexical_docs[source] = backfill_payload(kb, store, source, docs)
+    return stats
+
+def scan_documents(data_dir):
+    # {source: ruta}; el source es la ruta relativa a data/ (para los archivos
+    # de la raíz coincide con el nombre, como antes)
+    found = {}
+    for root, _, files in os.walk(data_dir):
+        for name in sorted(files):
+            if name.startswith(".") or not name.lower().endswith(SUPPORTED_EXTENSIONS): continue
+            path = os.path.join(root, name)
+            found[os.path.relpath(path, data_dir).replace(os.sep, "/")] = path
+    return found
+
+def documents_signature():
+    # Firma barata (mtime + tamaño) de las carpetas de todos los tenants, sin leer los archivos
+    signature = {}
+    for kb in tenants.values():
+        if not os.path.isdir(kb.data_dir): continue
+        for source, path in scan_documents(kb.data_dir).items():
+            st = os.stat(path)
+            signature[f"{kb.name}:{source}"] = (st.st_mtime_ns, st.st_size)
+    return signature
+
+def load_manifest(kb):
+    # Solo tiene sentido si la colección sobrevive al reinicio
+    if not kb.store.persistent or not os.path.exists(kb.manifest_path): return {}
+    with open(kb.manifest_path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("config") == INDEX_CONFIG:
+        return data["documents"]
+    # Otra configuración (o un manifest viejo, sin "config"): se conservan los nombres
+    # para detectar los documentos borrados, pero ningún hash coincide
+    documents = data["documents"] if "config" in data else data
+    print(f"⚙️ [{kb.name}] Cambió la configuración del índice ({INDEX_CONFIG}): se re-indexan todos los documentos.")
+    return dict.fromkeys(documents)
+
+def save_manifest(kb):
+    if not kb.store.persistent: return
+    folder = os.path.dirname(kb.manifest_path)
+    if folder: os.makedirs(folder, exist_ok=True)
+    tmp = kb.manifest_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"config": INDEX_CONFIG, "documents": kb.manifest}, f, indent=1)
+    os.replace(tmp, kb.manifest_path)
+
+def init_vector_db(path=None, tenant=None):
+    # Sincroniza las colecciones de todos los tenants (o solo la de `tenant`) con sus carpetas.
+    # `path` (carpeta o un solo archivo) reemplaza la carpeta del tenant.
+    # Se puede llamar con el servidor andando: solo re-indexa lo que cambió.
+    kbs = [tenants[tenant]] if tenant else list(tenants.values())
+    results = {kb.name: sync_collection(kb, path or kb.data_dir) for kb in kbs}
+    index_ready.set()
+    return results[kbs[0].name] if len(kbs) == 1 else results
+
+def sync_collection(kb, path):
+    if not os.path.exists(path):
+        print(f"⚠️ Archivo no encontrado: {path}")
+        kb.get_store().ensure()  # Sin documentos no hay nada que esperar: se responde sin contexto
+        return None
+
+    with kb.index_lock, span("index.total", index_stages):
+        store = kb.get_store()
+        store.ensure()
+        manifest, lexical_docs = kb.manifest, kb.lexical_docs
+        if not manifest:
+            manifest.update(load_manifest(kb))
+
+        if os.path.isdir(path):
+            with span("index.scan", index_stages):
+                documents = scan_documents(path)
+            removed = [s for s in list(manifest) if s not in documents]
+        else:
+            documents = {os.path.basename(path): path}
+            removed = []
+
+        print(f"--- 📄 [{kb.name}] Procesando {len(documents)} documentos con Metadatos ---")
+        start = time.perf_counter()
+        stats = {"documents": len(documents), "changed": 0, "removed": len(removed),
+                 "chunks": 0, "embed_calls": 0, "upserts": 0, "cached": 0, "skipped": 0, "deleted": 0}
+
+        # Todas las escrituras de la sincronización van en un solo lote: con NumPy la matriz
+        # y su cuantización se arman una vez al final (no por cada tanda de UPSERT_BATCH_SIZE)
+        with store.batch():
+            for source, doc_path in documents.items():
+                sha = file_sha256(doc_path)
+                if manifest.get(source) == sha and store.count(source):
+                    # Archivo idéntico y ya indexado: solo recuperamos sus fragmentos para BM25
+                    if source not in lexical_docs:
+                        docs = [{**payload, "id": pid} for pid, payload in store.points(source).items()]
+                        lexical_docs[source] = backfill_payload(kb, store, source, docs)
+                    continue
+
+                with span("index.document", index_stages, source=source):
+                    doc_stats = index_document(kb, doc_path, source)
+                for key in ("chunks", "embed_calls", "upserts", "cached", "skipped", "deleted"):
+                    stats[key] += doc_stats[key]
+                stats["changed"] += 1
+                manifest[source] = sha
+                print(f"   📄 {source}: {doc_stats['chunks']} nuevos, {doc_stats['skipped']} sin cambios, {doc_stats['deleted']} eliminados")
+
+            # Documentos que ya no están en data/
+            for source in removed:
+                store.delete_source(source)
+                manifest.pop(source, None)
+                lexical_docs.pop(source, None)
+                print(f"   🗑️ {source}: eliminado del índice")
+
+        # Índice léxico sobre los mismos fragmentos (se reemplaza de una sola vez)
+        with span("index.bm25", index_stages):
+            kb.lexical_index = BM25Index([doc for docs in lexical_docs.values() for doc in docs])
+
+        # La colección cambió: los contextos cacheados ya no son válidos
+        if stats["chunks"] or stats["deleted"] or removed:
+            context_cache.clear()
+            answer_cache.clear()
+            with span("index.persist", index_stages):
+                store.persist()
+        save_manifest(kb)
+
+    elapsed = time.perf_counter() - start
+    stats["seconds"] = round(elapsed, 3)
+    stats["chunks_per_sec"] = round(stats["chunks"] / elapsed, 1) if elapsed > 0 else 0.0
+    print(f"✅ Indexado: {stats['chunks']} fragmentos de {stats['changed']}/{stats['documents']} documentos "
+          f"en {elapsed:.2f}s ({stats['chunks_per_sec']} fragmentos/s, {stats['embed_calls']} llamadas de embeddings, "
+          f"{stats['cached']} desde caché, {stats['skipped']} sin cambios, {stats['deleted']} eliminados).")
+    return stats
+
+async def embed_query(query: str):
+    key = (EMBED_MODEL, normalize_query(query))
+    vec = query_cache.get(key)
+    record_cache("query_embedding", vec is not None)
+    if vec is None:
+        with span("rag.embed"):
+            vec = (await aclient.embeddings.create(input=query, model=EMBED_MODEL)).data[0].embedding
+        query_cache.set(key, vec)
+    return vec
+
+def format_context(hits):
     # Formateamos el contexto CON los metadatos para que GPT los vea
     context_string = ""
-    for hit in hits:
-        info = hit.payload
+    for info in hits:
         context_string += f"[Fuente: {info['source']}, Pag: {info['page']}] {info['text']}\n"
-        
-    return context_string
\ No newline at end of file
+    return context_string
+
+async def search_hits(query: str, limit=3, tenant=None, filters=None):
+    # Fragmentos rankeados (payload + score) de la colección del tenant, cacheados por
+    # consulta normalizada + filtros. filters: ver vector_store.normalize_filters
+    # Los filtros del pedido se intersectan con los del tenant (no los pisan)
+    kb = tenants[tenant or DEFAULT_TENANT]
+    filters = merge_filters(kb.filters, filters)
+    if matches_nothing(filters):
+        return []
+    key = (kb.name, normalize_query(query), limit, filters)
+    cached = context_cache.get(key)
+    record_cache("context", cached is not None)
+    if cached is not None:
+        return cached
+    if not index_ready.is_set():
+        retrieval_stats["not_ready"] += 1
+        return []  # Índice todavía cargando: sin contexto (y sin cachear el vacío)
+
+    lexical, confident = lexical_search(kb, query, filters)
+    if confident:
+        retrieval_stats["lexical_only"] += 1
+        hits = [{**hit, "retrieval": "lexical"} for hit in lexical[:limit]]  # Sin embedding de la consulta
+    else:
+        hits = await dense_search(kb, query, HYBRID_CANDIDATES if lexical else limit, filters)
+        if lexical:
+            retrieval_stats["hybrid"] += 1
+            hits = rrf_fuse([hits, lexical], limit=limit)
+        else:
+            retrieval_stats["dense"] += 1
+
+    context_cache.set(key, hits)
+    return hits
+
+def lexical_search(kb, query: str, filters=None):
+    # -> (candidatos BM25, ¿alcanzan solos?)
+    index = kb.lexical_index
+    if not HYBRID_SEARCH or not len(index): return [], False
+    where = (lambda doc: payload_matches(doc, filters)) if filters else None
+    with span("rag.bm25"):
+        lexical = index.search(query, limit=HYBRID_CANDIDATES, where=where)
+    return lexical, bool(lexical) and index.confident(query, lexical)
+
+def lexical_confident(query: str, tenant=None):
+    # Para el router: si BM25 ya resuelve la consulta es una pregunta de catálogo
+    # y no hace falta el embedding para clasificarla (ni después para buscar)
+    if not index_ready.is_set(): return False
+    kb = tenants[tenant or DEFAULT_TENANT]
+    return lexical_search(kb, query, normalize_filters(kb.filters))[1]
+
+async def dense_search(kb, query: str, limit: int, filters=None):
+    vector = await embed_query(query)
+    # La búsqueda es síncrona (Qdrant / NumPy): va a un hilo para no frenar el event loop
+    with span("rag.vector", backend=VECTOR_BACKEND, tenant=kb.name, filtered=bool(filters)):
+        return await asyncio.to_thread(kb.get_store().search, vector, limit, filters)
+
+def answer_terms(query: str, hits):
+    # Términos de la consulta que eligen contenido DENTRO de los fragmentos recuperados
+    # (números, productos): "instalación residencial" e "instalación industrial" traen el
+    # mismo fragmento, pero no pueden compartir respuesta. "cuánto cuesta" / "cuánto sale"
+    # no aparecen en el texto y no separan grupos.
+    present = {t for hit in hits for t in tokenize(hit["text"])}
+    return tuple(sorted({t for t in tokenize(query) if is_exact_token(t) or t in present}))
+
+def depends_on_history(query: str, hits, history):
+    # "¿y cuánto cuesta?" después de hablar de la instalación residencial: sin términos propios
+    # la pregunta solo se entiende con la conversación, y otra conversación con los mismos
+    # fragmentos caería en el mismo grupo. Esas no se cachean.
+    return bool(history) and not answer_terms(query, hits)
+
+async def answer_key(query: str, hits, *scope):
+    # (vector, grupo) para answer_cache: los ids de los fragmentos + answer_terms fijan el
+    # grupo exacto, el embedding (ya cacheado por la búsqueda densa) decide si la pregunta es "la misma"
+    vector = await embed_query(query)
+    return vector, (tuple(sorted(h["id"] for h in hits)), answer_terms(query, hits), *scope)
+
+async def search_context(query: str, tenant=None, filters=None):
+    return format_context(await search_hits(query, tenant=tenant, filters=filters))
+
+def cache_stats():
+    return {"query_embeddings": query_cache.stats(), "context": context_cache.stats(),
+            "answers": answer_cache.stats(), "retrieval": dict(retrieval_stats),
+            "collections": {kb.name: {"collection": kb.collection, "chunks": len(kb.lexical_index)}
+                            for kb in tenants.values()}}
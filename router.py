@@ -0,0 +1,188 @@
+import os
+import re
+import asyncio
+import numpy as np
+from collections import Counter
+from lexical import strip_accents
+
+# Router de intención: decide ANTES de llamar a OpenAI qué necesita cada mensaje.
+#   1. Reglas (regex, microsegundos): saludos, gracias, "ok", un correo suelto, "me llamo X".
+#   2. Consultas que BM25 resuelve solo (tokens exactos: "$5000", "9am"): pregunta, sin embedding.
+#   3. Clasificador por centroide más cercano sobre embeddings (solo mensajes cortos).
+#      El embedding del mensaje es el mismo que usa la búsqueda densa (query_cache),
+#      así que clasificar no cuesta una llamada extra cuando después sí hay RAG.
+#   4. Por defecto: RAG + modelo grande (lo mismo que antes).
+# Cada ruta dice si hace falta RAG, qué modelo usar, y si alcanza con una respuesta
+# fija y/o con actualizar el lead directamente (sin la ida y vuelta de la tool call).
+
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+ROUTER_CLASSIFIER = os.getenv("ROUTER_CLASSIFIER", "1") == "1"
+ROUTER_CLASSIFY_MAX_WORDS = int(os.getenv("ROUTER_CLASSIFY_MAX_WORDS", 8))  # Más largo = pregunta
+ROUTER_MIN_SCORE = float(os.getenv("ROUTER_MIN_SCORE", 0.45))    # Similitud mínima con el centroide
+ROUTER_MIN_MARGIN = float(os.getenv("ROUTER_MIN_MARGIN", 0.03))  # Ventaja mínima sobre el segundo
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o")
+CHAT_MODEL_SMALL = os.getenv("CHAT_MODEL_SMALL", "gpt-4o-mini")
+
+EMAIL = r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+EMAIL_ONLY = re.compile(rf"^(?:(?:mi |el )?(?:correo|email|mail|e-mail)(?: es)?:?\s*)?({EMAIL})$")
+NAME_ONLY = re.compile(r"^(?:hola,?\s+)?(?:me llamo|mi nombre es)\s+([a-zñ]+(?:\s+[a-zñ]+){0,2})$")
+NAME_TAIL = re.compile(r"(?:me llamo|mi nombre es)\s+(.*)$")
+# Palabras que no forman parte de un nombre: "me llamo Ana y tú?", "mi nombre es Juan quiero info"
+NOT_NAME = set("""
+y e o u pero que tu usted ustedes gracias quiero queria quisiera necesito busco tengo estoy soy
+info informacion precio precios cotizar cotizacion saber por para con de del el la los las un una
+hola buenas ok vale bien aqui favor como cuanto cuando donde
+""".split())
+GREETING = re.compile(
+    r"^(?:hola+|holi|buenas|buen dia|buenos dias|buenas tardes|buenas noches|hey|saludos|que tal)"
+    r"(?:\s+(?:que tal|como estas|buen dia|buenos dias|buenas tardes|buenas noches))?$"
+)
+THANKS = re.compile(r"^(?:(?:ok|vale|listo|perfecto|genial)\s+)?(?:muchas |mil )?gracias(?:\s+(?:mil|por todo|por la info(?:rmacion)?))?$")
+# Datos del usuario dentro de una pregunta ("me llamo Ana, cuánto cuesta?"): el turno no es genérico
+PERSONAL_DATA = re.compile(rf"{EMAIL}|\b(?:me llamo|mi nombre|mi correo|mi email|mi mail|mi telefono|mi numero|mi direccion)\b|\d{{7,}}")
+ACK = re.compile(r"^(?:ok|okay|okey|vale|dale|listo|perfecto|entendido|de acuerdo|genial|excelente|bien|si|claro|va|sale)$")
+
+# Ejemplos por intención para el clasificador (se promedian en un centroide)
+INTENT_EXAMPLES = {
+    "question": [
+        "cuánto cuesta la instalación", "precio del mantenimiento", "qué servicios tienen",
+        "en qué horario atienden", "quiénes son ustedes", "hacen instalaciones industriales",
+        "cuánto sale para mi casa", "tienen garantía los paneles",
+    ],
+    "smalltalk": [
+        "hola", "buenas tardes", "gracias", "ok perfecto", "muy bien", "jaja", "excelente, gracias",
+        "sí claro", "de nada", "nos vemos", "👍",
+    ],
+}
+# question -> RAG + modelo grande ; smalltalk -> sin RAG, modelo chico
+INTENT_ROUTES = {"question": (True, CHAT_MODEL), "smalltalk": (False, CHAT_MODEL_SMALL)}
+
+router_stats = Counter()
+_centroids = None
+_centroids_lock = asyncio.Lock()
+
+def normalize(message: str):
+    text = strip_accents(message.casefold()).strip()
+    text = re.sub(r"[¡!¿?.,;:]+", " ", text) if "@" not in text else text.strip(" ¡!¿?,;:")
+    return re.sub(r"\s+", " ", text).strip().rstrip(".")
+
+def make_route(intent, source, rag=True, model=CHAT_MODEL, reply=None, updates=None):
+    # answer_key: (vector, grupo) si la respuesta se puede guardar en el caché de respuestas
+    return {"intent": intent, "source": source, "rag": rag, "model": model,
+            "reply": reply, "updates": updates or {}, "answer_key": None}
+
+def mentions_personal_data(message: str):
+    return bool(PERSONAL_DATA.search(normalize(message)))
+
+def is_bare_name(message: str, name: str):
+    # Solo el nombre y nada más. Si sigue algo ("Juan, quiero info", "Ana y tú") el mensaje
+    # lo contesta el modelo (que también guarda el nombre con update_lead_info)
+    if any(word in NOT_NAME for word in name.split()):
+        return False
+    tail = NAME_TAIL.search(strip_accents(message.casefold()))
+    return bool(tail) and not re.search(r"[,;:¿?]", tail.group(1).rstrip(" .!¡"))
+
+def route_rules(message: str):
+    text = normalize(message)
+    if not text:
+        return make_route("empty", "rule", rag=False, model=CHAT_MODEL_SMALL)
+
+    match = EMAIL_ONLY.match(text)
+    if match:
+        # Protocolo de venta: si el cliente da el correo, confirmar cita y terminar
+        email = match.group(1)
+        return make_route("email", "rule", rag=False, model=CHAT_MODEL_SMALL,
+                          reply=f"¡Perfecto! Registré tu correo {email}. Te escribiremos ahí para confirmar la cita. ¡Gracias por contactar a SolarTech!",
+                          updates={"email": email, "stage": "closed"})
+
+    match = NAME_ONLY.match(text)
+    if match and is_bare_name(message, match.group(1)):
+        # Nombre tal como lo escribió el usuario (con tildes), no el normalizado
+        words = len(match.group(1).split())
+        name = " ".join(message.strip(" .!¡").split()[-words:]).title()
+        return make_route("name", "rule", rag=False, model=CHAT_MODEL_SMALL,
+                          reply=f"Gracias {name}. ¿Buscas paneles para Casa o Industria?",
+                          updates={"name": name, "stage": "qualifying"})
+
+    if THANKS.match(text):
+        return make_route("thanks", "rule", rag=False, model=CHAT_MODEL_SMALL,
+                          reply="¡Con gusto! ¿Hay algo más en lo que pueda ayudarte?")
+    if GREETING.match(text):
+        return make_route("greeting", "rule", rag=False, model=CHAT_MODEL_SMALL)
+    if ACK.match(text):
+        return make_route("ack", "rule", rag=False, model=CHAT_MODEL_SMALL)
+    return None
+
+async def load_centroids():
+    # Una sola vez por proceso; los embeddings de los ejemplos salen del caché en disco
+    global _centroids
+    async with _centroids_lock:
+        if _centroids is None:
+            from rag import embed_texts
+            texts = [t for examples in INTENT_EXAMPLES.values() for t in examples]
+            vectors = np.asarray(await asyncio.to_thread(embed_texts, texts), dtype=np.float32)
+            centroids, start = {}, 0
+            for intent, examples in INTENT_EXAMPLES.items():
+                mean = vectors[start:start + len(examples)].mean(axis=0)
+                centroids[intent] = mean / np.linalg.norm(mean)
+                start += len(examples)
+            _centroids = centroids
+    return _centroids
+
+async def classify(message: str):
+    from rag import embed_query
+    centroids = await load_centroids()
+    vector = np.asarray(await embed_query(message), dtype=np.float32)
+    vector /= max(float(np.linalg.norm(vector)), 1e-12)
+    scores = sorted(((float(c @ vector), intent) for intent, c in centroids.items()), reverse=True)
+    best, intent = scores[0]
+    runner_up = scores[1][0] if len(scores) > 1 else -1.0
+    if best < ROUTER_MIN_SCORE or best - runner_up < ROUTER_MIN_MARGIN:
+        return None  # Dudoso: mejor pagar RAG + modelo grande que responder mal
+    return intent
+
+async def route_message(message: str, tenant=None):
+    if not ROUTER_ENABLED:
+        return make_route("question", "disabled")
+
+    route = route_rules(message)
+    if route is None and ROUTER_CLASSIFIER and len(message.split()) <= ROUTER_CLASSIFY_MAX_WORDS:
+        from rag import lexical_confident
+        if lexical_confident(message, tenant):
+            # El camino solo-léxico de la búsqueda no embebe la consulta: clasificarla lo anularía
+            return make_route("question", "lexical")
+        try:
+            intent = await classify(message)
+        except Exception as e:
+            print(f"⚠️ Clasificador no disponible ({e.__class__.__name__}), usando la ruta por defecto.")
+            intent = None
+        if intent:
+            rag, model = INTENT_ROUTES[intent]
+            route = make_route(intent, "classifier", rag=rag, model=model)
+    return route or make_route("question", "default")
+
+def finalize_route(route, user, history):
+    # Ajustes que dependen del estado del usuario (se conoce después de cargar la BD)
+    if route["intent"] == "greeting" and not history and not user.name:
+        route["reply"] = "¡Hola! Bienvenido a SolarTech. Soy SolarBot. Para empezar, ¿cuál es tu nombre?"
+    if route["intent"] == "name" and user.stage not in (None, "onboarding"):
+        # Con el nombre se pasa de onboarding a qualifying (como en el prompt), nunca se retrocede
+        route["updates"].pop("stage", None)
+    return route
+
+def record_route(route):
+    router_stats["turns"] += 1
+    router_stats[f"intent:{route['intent']}"] += 1
+    router_stats[f"source:{route['source']}"] += 1
+    if not route["rag"]: router_stats["rag_skipped"] += 1
+    if route["reply"]: router_stats["llm_skipped"] += 1
+    elif route["model"] != CHAT_MODEL: router_stats["small_model"] += 1
+    if route["updates"]: router_stats["direct_updates"] += 1
+    print(f"🧭 Ruta: {route['intent']} ({route['source']}) | RAG: {'sí' if route['rag'] else 'no'} | "
+          f"{'respuesta fija' if route['reply'] else route['model']}")
+
+def router_snapshot():
+    turns = router_stats["turns"]
+    return {**router_stats,
+            "rag_skipped_ratio": round(router_stats["rag_skipped"] / turns, 4) if turns else 0.0,
+            "llm_skipped_ratio": round(router_stats["llm_skipped"] / turns, 4) if turns else 0.0}
@@ -1,10 +1,33 @@
+import json
+import time
+import random
+import asyncio
+import argparse
 import requests
 
 # CONFIGURACIÓN
 # Esta es la dirección donde vive tu cerebro (main.py)
 API_URL = "http://127.0.0.1:8000/webhook"
+STREAM_URL = "http://127.0.0.1:8000/webhook/stream"
 
-def iniciar_simulacion():
+def enviar_stream(payload):
+    # Imprime la respuesta token a token a medida que llega (Server-Sent Events)
+    print("🤖 Bot: ", end="", flush=True)
+    with requests.post(STREAM_URL, json=payload, stream=True) as response:
+        if response.status_code != 200:
+            print(f"\n❌ Error del Servidor ({response.status_code}):")
+            print(f"   {response.text}\n")
+            return
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "): continue
+            event = json.loads(line[len("data: "):])
+            if event["type"] == "delta":
+                print(event["content"], end="", flush=True)
+            elif event["type"] == "tools":
+                print(f"[🛠️ {', '.join(event['names'])}] ", end="", flush=True)
+    print("\n")
+
+def iniciar_simulacion(stream=False):
     print("\n--- 📱 SIMULADOR DE WHATSAPP (CLIENTE) ---")
     print("Este programa simula ser un usuario enviando mensajes a tu API.")
     print("------------------------------------------------------------")
@@ -43,6 +66,10 @@ def iniciar_simulacion():
             }
 
             # 4. Enviar al Servidor (Tu API)
+            if stream:
+                enviar_stream(payload)
+                continue
+
             print("   (Enviando...)", end="\r")
             
             # Hacemos la petición POST
@@ -68,5 +95,89 @@ def iniciar_simulacion():
             print(f"\n❌ Error inesperado: {e}")
             break
 
+# --- MODO CARGA ---
+# Muchos teléfonos simulados a la vez, cada uno reproduciendo una conversación guionada
+# (espera la respuesta antes de mandar el siguiente mensaje, como una persona).
+# Para correrlo sin red ni costo, junto al servidor falso:
+#   python benchmarks/fake_openai.py --port 9000 --latency 0.8
+#   OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake uvicorn main:app
+#   python simulador.py --load --users 50 --rounds 2
+
+GUIONES = [
+    ["Hola", "Me llamo Carla", "¿Cuánto cuesta la instalación residencial?", "¿Y el mantenimiento?", "carla@correo.com"],
+    ["Buenas tardes", "Quiero paneles para mi fábrica", "¿Cuánto sale la instalación industrial?", "ok gracias"],
+    ["hola", "¿En qué horario atienden?", "¿Quiénes son ustedes?", "perfecto"],
+    ["Me llamo Pedro", "¿Qué servicios tienen?", "¿El mantenimiento es mensual?", "pedro@empresa.com", "gracias"],
+]
+
+def percentil(valores, p):
+    if not valores: return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))]
+
+async def enviar_carga(client, url, phone, message, message_id, resultados):
+    inicio = time.perf_counter()
+    try:
+        # message_id único: en modo cola un "ok" repetido es un mensaje nuevo, no un reintento
+        response = await client.post(url, json={"phone": phone, "message": message, "message_id": message_id})
+        if response.status_code == 202:
+            # Modo cola: esperamos la respuesta consultando el job
+            status_url = url.rsplit("/webhook", 1)[0] + response.json()["status_url"]
+            while response.status_code in (200, 202) and response.json().get("status") in ("queued", "running"):
+                await asyncio.sleep(0.2)
+                response = await client.get(status_url)
+        resultados["codigos"][response.status_code] = resultados["codigos"].get(response.status_code, 0) + 1
+        if response.status_code != 200 or response.json().get("status") == "failed":
+            resultados["errores"] += 1
+            return
+    except Exception as e:
+        resultados["errores"] += 1
+        resultados["codigos"][e.__class__.__name__] = resultados["codigos"].get(e.__class__.__name__, 0) + 1
+        return
+    resultados["latencias"].append(time.perf_counter() - inicio)
+
+async def usuario_simulado(client, url, phone, guion, rondas, pausa, resultados):
+    for ronda in range(rondas):
+        for i, message in enumerate(guion):
+            await enviar_carga(client, url, phone, message, f"{phone}-{ronda}-{i}", resultados)
+            await asyncio.sleep(random.uniform(0, 2 * pausa))  # "Tiempo de escritura" del usuario
+
+async def prueba_de_carga(url, usuarios, rondas, pausa, timeout):
+    import httpx
+    resultados = {"latencias": [], "errores": 0, "codigos": {}}
+    corrida = f"{int(time.time()) % 100000}"  # Teléfonos nuevos en cada corrida (historial limpio)
+    limits = httpx.Limits(max_connections=usuarios, max_keepalive_connections=usuarios)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(
+            usuario_simulado(client, url, f"carga-{corrida}-{i}", GUIONES[i % len(GUIONES)], rondas, pausa, resultados)
+            for i in range(usuarios)
+        ))
+        duracion = time.perf_counter() - inicio
+
+    latencias = resultados["latencias"]
+    total = len(latencias) + resultados["errores"]
+    print(f"\n--- 📊 PRUEBA DE CARGA: {usuarios} usuarios, {total} mensajes en {duracion:.1f}s ---")
+    print(f"   Throughput: {len(latencias) / duracion:.2f} respuestas/s | errores: {resultados['errores']} | códigos: {resultados['codigos']}")
+    if latencias:
+        print(f"   Latencia p50 {percentil(latencias, 50):.3f}s | p95 {percentil(latencias, 95):.3f}s | "
+              f"p99 {percentil(latencias, 99):.3f}s | máx {max(latencias):.3f}s")
+    return resultados
+
 if __name__ == "__main__":
-    iniciar_simulacion()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true", help="Muestra la respuesta a medida que se genera")
+    parser.add_argument("--load", action="store_true", help="Modo carga (no interactivo)")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--users", type=int, default=20, help="Teléfonos simulados en paralelo")
+    parser.add_argument("--rounds", type=int, default=1, help="Veces que cada usuario repite su guion")
+    parser.add_argument("--think", type=float, default=0.5, help="Pausa media entre mensajes (s)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.load:
+        random.seed(args.seed)
+        asyncio.run(prueba_de_carga(args.url, args.users, args.rounds, args.think, args.timeout))
+    else:
+        iniciar_simulacion(stream=args.stream)
\ No newline at end of file
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+
+os.environ.setdefault("EMBED_CACHE_PATH", "")  # Sin caché de embeddings en disco durante los tests
+os.environ.setdefault("OPENAI_API_KEY", "sk-offline")
+
+from cache import SemanticCache
+from rag import answer_terms, depends_on_history
+
+PRICES = [{"id": "p2", "text": "Servicios y Precios\nInstalación Residencial: $1,000 USD\n"
+                               "Instalación Industrial: $5,000 USD\nMantenimiento Mensual: $100 USD por mes"}]
+
+def test_answer_terms_separate_products_in_the_same_chunk():
+    residential = answer_terms("cuánto cuesta la instalación residencial", PRICES)
+    industrial = answer_terms("cuánto cuesta la instalación industrial", PRICES)
+    assert residential != industrial
+    assert "residencial" in residential and "industrial" in industrial
+
+def test_answer_terms_ignore_words_outside_the_chunk():
+    assert answer_terms("cuánto cuesta la instalación residencial", PRICES) == \
+        answer_terms("y cuánto me sale la instalación residencial?", PRICES)
+
+def test_answer_terms_keep_exact_tokens():
+    assert "5000" in answer_terms("tienen algo por $5000?", [{"id": "x", "text": "Catálogo general"}])
+
+def test_semantic_cache_only_matches_within_a_group():
+    cache = SemanticCache(maxsize=10, ttl=60, threshold=0.9)
+    vector = np.ones(8, dtype=np.float32)
+    cache.set(vector, ("p2", ("instalacion", "residencial")), "Cuesta $1,000 USD.")
+    assert cache.get(vector * 2, ("p2", ("instalacion", "residencial"))) == "Cuesta $1,000 USD."
+    assert cache.get(vector, ("p2", ("industrial", "instalacion"))) is None
+
+def test_semantic_cache_threshold_and_lru():
+    cache = SemanticCache(maxsize=2, ttl=60, threshold=0.9)
+    a, b, c = np.eye(3, dtype=np.float32)
+    cache.set(a, "g", "A")
+    cache.set(b, "g", "B")
+    assert cache.get(a + 0.2 * c, "g") == "A"  # Similitud ~0.98
+    assert cache.get(a + c, "g") is None        # Similitud ~0.71
+    cache.set(c, "g", "C")                       # Desaloja a B (el menos usado)
+    assert cache.get(b, "g") is None
+    assert cache.get(a, "g") == "A"
+    assert cache.stats()["evictions"] == 1
+
+def test_follow_ups_without_own_terms_depend_on_history():
+    history = [{"role": "user", "content": "cuánto sale la instalación residencial"},
+               {"role": "assistant", "content": "Cuesta $1,000 USD."}]
+    assert depends_on_history("¿y cuánto cuesta?", PRICES, history)
+    assert not depends_on_history("¿y cuánto cuesta?", PRICES, [])
+    assert not depends_on_history("¿y la instalación industrial?", PRICES, history)
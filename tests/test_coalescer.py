@@ -0,0 +1,149 @@
+import time
+import asyncio
+import pytest
+from coalescer import MessageCoalescer
+
+# Ventanas cortas para que la suite corra rápido; los márgenes son amplios para no depender del reloj.
+WINDOW = 0.1
+
+class FakeTurn:
+    # handler(phone, mensajes, commit): registra cada lote y puede demorar antes / después del commit
+    def __init__(self, before_commit=0.0, after_commit=0.0, error=None):
+        self.before_commit = before_commit
+        self.after_commit = after_commit
+        self.error = error
+        self.calls = []
+        self.completed = []
+
+    async def __call__(self, phone, messages, commit):
+        self.calls.append(list(messages))
+        await asyncio.sleep(self.before_commit)
+        if self.error: raise self.error
+        commit()
+        await asyncio.sleep(self.after_commit)
+        self.completed.append(list(messages))
+        return " + ".join(messages)
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_single_message_is_not_delayed():
+    async def scenario():
+        turn = FakeTurn()
+        coalescer = MessageCoalescer(turn, window=1.0, max_wait=3.0)
+        start = time.monotonic()
+        result = await coalescer.submit("1", "hola")
+        return result, time.monotonic() - start, coalescer
+
+    result, elapsed, coalescer = run(scenario())
+    assert result == ("hola", 1)
+    assert elapsed < 0.5  # Sin esperar la ventana de 1s
+    assert coalescer.phones == {}
+
+def test_burst_cancels_uncommitted_turn_and_merges():
+    async def scenario():
+        turn = FakeTurn(before_commit=0.2)
+        coalescer = MessageCoalescer(turn, window=WINDOW, max_wait=3.0)
+        first = asyncio.create_task(coalescer.submit("1", "hola"))
+        await asyncio.sleep(0.05)  # El primer turno ya arrancó pero no llegó al commit
+        second = asyncio.create_task(coalescer.submit("1", "cuánto cuesta?"))
+        return await first, await second, turn, coalescer
+
+    first, second, turn, coalescer = run(scenario())
+    assert first == (None, 2)
+    assert second == ("hola + cuánto cuesta?", 2)
+    assert turn.calls == [["hola"], ["hola", "cuánto cuesta?"]]
+    assert turn.completed == [["hola", "cuánto cuesta?"]]
+    assert coalescer.stats["cancelled"] == 1
+    assert coalescer.stats["merged"] == 1
+    assert coalescer.phones == {}
+
+def test_committed_turn_is_not_cancelled():
+    async def scenario():
+        turn = FakeTurn(after_commit=0.2)
+        coalescer = MessageCoalescer(turn, window=WINDOW, max_wait=3.0)
+        first = asyncio.create_task(coalescer.submit("1", "me llamo Ana"))
+        await asyncio.sleep(0.05)  # Ya hizo commit: tiene efectos, se deja terminar
+        second = asyncio.create_task(coalescer.submit("1", "y el precio?"))
+        return await first, await second, turn, coalescer
+
+    first, second, turn, coalescer = run(scenario())
+    assert first == ("me llamo Ana", 1)
+    assert second == ("y el precio?", 1)
+    assert turn.completed == [["me llamo Ana"], ["y el precio?"]]
+    assert coalescer.stats["cancelled"] == 0
+
+def test_messages_during_a_turn_are_debounced_together():
+    async def scenario():
+        turn = FakeTurn(after_commit=0.2)
+        coalescer = MessageCoalescer(turn, window=WINDOW, max_wait=3.0)
+        tasks = [asyncio.create_task(coalescer.submit("1", "hola"))]
+        await asyncio.sleep(0.05)
+        for message in ("una pregunta", "cuánto cuesta?"):
+            tasks.append(asyncio.create_task(coalescer.submit("1", message)))
+            await asyncio.sleep(0.02)
+        return await asyncio.gather(*tasks), turn
+
+    results, turn = run(scenario())
+    assert turn.completed == [["hola"], ["una pregunta", "cuánto cuesta?"]]
+    assert results == [("hola", 1), (None, 2), ("una pregunta + cuánto cuesta?", 2)]
+
+def test_max_messages_flushes_without_waiting():
+    async def scenario():
+        turn = FakeTurn(after_commit=0.1)
+        coalescer = MessageCoalescer(turn, window=5.0, max_wait=10.0, max_messages=2)
+        first = asyncio.create_task(coalescer.submit("1", "a"))
+        await asyncio.sleep(0.02)
+        start = time.monotonic()
+        rest = [asyncio.create_task(coalescer.submit("1", m)) for m in ("b", "c")]
+        await asyncio.gather(first, *rest)
+        return time.monotonic() - start, turn
+
+    elapsed, turn = run(scenario())
+    assert turn.completed == [["a"], ["b", "c"]]
+    assert elapsed < 2.0  # Lote lleno: no espera la ventana de 5s
+
+def test_phones_are_independent():
+    async def scenario():
+        turn = FakeTurn(before_commit=0.1)
+        coalescer = MessageCoalescer(turn, window=WINDOW, max_wait=3.0)
+        return await asyncio.gather(coalescer.submit("1", "hola"), coalescer.submit("2", "buenas")), coalescer
+
+    results, coalescer = run(scenario())
+    assert results == [("hola", 1), ("buenas", 1)]
+    assert coalescer.stats["cancelled"] == 0
+
+def test_handler_error_reaches_every_message_in_the_batch():
+    async def scenario():
+        turn = FakeTurn(before_commit=0.05, error=RuntimeError("modelo caído"))
+        coalescer = MessageCoalescer(turn, window=WINDOW, max_wait=3.0)
+        with pytest.raises(RuntimeError):
+            await coalescer.submit("1", "hola")
+        return coalescer
+
+    coalescer = run(scenario())
+    assert coalescer.stats["errors"] == 1
+    assert coalescer.phones == {}
+
+def test_phone_lock_serializes_with_coalesced_turns():
+    async def scenario():
+        order = []
+
+        async def handler(phone, messages, commit):
+            commit()
+            order.append("turn-start")
+            await asyncio.sleep(0.1)
+            order.append("turn-end")
+            return "ok"
+
+        coalescer = MessageCoalescer(handler, window=WINDOW, max_wait=3.0)
+        turn = asyncio.create_task(coalescer.submit("1", "hola"))
+        await asyncio.sleep(0.02)
+        async with coalescer.phone_lock("1"):
+            order.append("stream")
+        await turn
+        return order, coalescer
+
+    order, coalescer = run(scenario())
+    assert order == ["turn-start", "turn-end", "stream"]
+    assert coalescer.phones == {}
@@ -0,0 +1,167 @@
+import asyncio
+import pytest
+import jobs
+from jobs import JobRunner, SQLiteJobQueue, callback_allowed
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(jobs, "JOB_CALLBACK_HOSTS", {"hooks.example.com"})
+
+async def handler(job):
+    return {"response": f"eco: {job['payload']['message']}", "merged": 1}
+
+async def wait_for_status(queue, job_id, status, timeout=5.0):
+    for _ in range(int(timeout / 0.02)):
+        job = queue.get(job_id)
+        if job["status"] == status: return job
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"job {job_id} sigue en {queue.get(job_id)['status']}")
+
+def test_callback_allowed_checks_scheme_and_host():
+    assert callback_allowed("https://hooks.example.com/whatsapp")
+    assert callback_allowed("http://HOOKS.example.com:8080/x")
+    assert not callback_allowed("https://evil.example.net/x")
+    assert not callback_allowed("ftp://hooks.example.com/x")
+    assert not callback_allowed("\u0000http://hooks.example.com")
+    assert not callback_allowed("http://[::1")
+    assert not callback_allowed("hooks.example.com/x")
+
+def test_invalid_callback_does_not_kill_the_worker(tmp_path):
+    async def scenario():
+        runner = JobRunner(handler, queue=SQLiteJobQueue(str(tmp_path / "jobs.sqlite")), workers=1)
+        await runner.start()
+        try:
+            bad, _ = await runner.submit("1", {"message": "hola", "callback_url": "\u0000http://a"})
+            await wait_for_status(runner.queue, bad["id"], "done")
+            good, _ = await runner.submit("1", {"message": "precio", "callback_url": None})
+            done = await wait_for_status(runner.queue, good["id"], "done")
+        finally:
+            await runner.close()
+        return done, runner
+
+    done, runner = asyncio.run(scenario())
+    assert done["result"]["response"] == "eco: precio"
+    assert runner.stats["callback_errors"] == 1
+    assert runner.stats["done"] == 2
+
+def test_queue_errors_do_not_kill_the_worker(tmp_path):
+    class FlakyQueue(SQLiteJobQueue):
+        failures = 2
+
+        def claim(self):
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("database is locked")
+            return super().claim()
+
+    async def scenario():
+        runner = JobRunner(handler, queue=FlakyQueue(str(tmp_path / "jobs.sqlite")), workers=1)
+        job, _ = await runner.submit("1", {"message": "hola", "callback_url": None})
+        await runner.start()
+        try:
+            done = await wait_for_status(runner.queue, job["id"], "done")
+        finally:
+            await runner.close()
+        return done, runner
+
+    done, runner = asyncio.run(scenario())
+    assert done["result"]["response"] == "eco: hola"
+    assert runner.stats["worker_errors"] == 2
+
+def test_handler_errors_are_retried_then_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(jobs.random, "random", lambda: 0.0)
+    calls = []
+
+    async def broken(job):
+        calls.append(job["attempts"])
+        raise ValueError("modelo caído")
+
+    async def scenario():
+        queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"))
+        runner = JobRunner(broken, queue=queue, workers=1)
+        job, _ = await runner.submit("1", {"message": "hola", "callback_url": None})
+        await runner.start()
+        try:
+            failed = await wait_for_status(queue, job["id"], "failed")
+        finally:
+            await runner.close()
+        return failed
+
+    failed = asyncio.run(scenario())
+    assert calls == [1, 2]
+    assert "ValueError" in failed["error"]
+
+def test_duplicate_submissions_share_one_job(tmp_path):
+    async def scenario():
+        runner = JobRunner(handler, queue=SQLiteJobQueue(str(tmp_path / "jobs.sqlite")), workers=1)
+        first, created = await runner.submit("1", {"message": "hola", "callback_url": None}, key="wamid.1")
+        again, created_again = await runner.submit("1", {"message": "hola", "callback_url": None}, key="wamid.1")
+        return first, created, again, created_again, runner
+
+    first, created, again, created_again, runner = asyncio.run(scenario())
+    assert created and not created_again
+    assert first["id"] == again["id"]
+    assert runner.stats["duplicates"] == 1
+
+def test_same_text_without_key_is_a_new_message(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DEDUP_WINDOW", 0)
+
+    async def scenario():
+        runner = JobRunner(handler, queue=SQLiteJobQueue(str(tmp_path / "jobs.sqlite")), workers=1)
+        first, _ = await runner.submit("1", {"message": "si", "callback_url": None})
+        second, created = await runner.submit("1", {"message": "si", "callback_url": None})
+        return first, second, created
+
+    first, second, created = asyncio.run(scenario())
+    assert created and first["id"] != second["id"]
+
+def test_content_dedup_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DEDUP_WINDOW", 60)
+
+    async def scenario():
+        runner = JobRunner(handler, queue=SQLiteJobQueue(str(tmp_path / "jobs.sqlite")), workers=1)
+        first, _ = await runner.submit("1", {"message": "si", "callback_url": None})
+        second, created = await runner.submit("1", {"message": "si", "callback_url": None})
+        return first, second, created
+
+    first, second, created = asyncio.run(scenario())
+    assert not created and first["id"] == second["id"]
+
+def test_slow_handler_keeps_its_lease(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_LEASE", 0.3)
+    calls = []
+
+    async def slow(job):
+        calls.append(job["attempts"])
+        await asyncio.sleep(1.0)  # Más de 3 leases: sin heartbeat otro worker lo reclamaría
+        return {"response": "ok", "merged": 1}
+
+    async def scenario():
+        runner = JobRunner(slow, queue=SQLiteJobQueue(str(tmp_path / "jobs.sqlite")), workers=2)
+        job, _ = await runner.submit("1", {"message": "hola", "callback_url": None})
+        await runner.start()
+        try:
+            done = await wait_for_status(runner.queue, job["id"], "done")
+        finally:
+            await runner.close()
+        return done, runner
+
+    done, runner = asyncio.run(scenario())
+    assert calls == [1]
+    assert done["attempts"] == 1
+    assert runner.stats["lease_lost"] == 0
+
+def test_stale_claim_cannot_complete_or_fail(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_LEASE", 0.0)
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"))
+    job, _ = queue.enqueue("k:1", "1", {"message": "hola", "callback_url": None})
+    stale = queue.claim()
+    current = queue.claim()  # Lease vencido: otro worker lo reclama
+    assert current["id"] == stale["id"] and current["attempts"] == stale["attempts"] + 1
+    assert not queue.extend(stale["id"], stale["attempts"])
+    assert not queue.complete(stale["id"], stale["attempts"], {"response": "viejo"})
+    assert not queue.fail(stale["id"], stale["attempts"], "timeout", 1.0)
+    assert queue.complete(current["id"], current["attempts"], {"response": "nuevo"})
+    assert queue.get(job["id"])["result"] == {"response": "nuevo"}
@@ -0,0 +1,68 @@
+import pytest
+from types import SimpleNamespace
+from router import route_rules, finalize_route, mentions_personal_data
+
+@pytest.mark.parametrize("message, name", [
+    ("Me llamo Ana", "Ana"),
+    ("Hola, me llamo Ana.", "Ana"),
+    ("mi nombre es María José", "María José"),
+    ("me llamo José Luis Pérez", "José Luis Pérez"),
+])
+def test_bare_names_are_handled_by_the_rule(message, name):
+    route = route_rules(message)
+    assert route["intent"] == "name"
+    assert route["updates"] == {"name": name, "stage": "qualifying"}
+    assert name in route["reply"]
+    assert not route["rag"]
+
+@pytest.mark.parametrize("message", [
+    "Mi nombre es Juan, quiero info",
+    "me llamo Ana y tu",
+    "me llamo juan gracias",
+    "me llamo Ana, gracias!",
+    "me llamo Pedro quiero cotizar",
+    "mi nombre es Luis, cuánto cuesta?",
+])
+def test_names_followed_by_something_else_go_to_the_model(message):
+    assert route_rules(message) is None
+
+def test_name_rule_does_not_move_a_lead_backwards():
+    user = SimpleNamespace(name=None, stage="closed")
+    route = finalize_route(route_rules("me llamo Ana"), user, [])
+    assert route["updates"] == {"name": "Ana"}
+
+    user = SimpleNamespace(name=None, stage="onboarding")
+    route = finalize_route(route_rules("me llamo Ana"), user, [])
+    assert route["updates"]["stage"] == "qualifying"
+
+@pytest.mark.parametrize("message", ["ana@example.com", "mi correo es ana@example.com", "Email: ana@example.com"])
+def test_bare_email_closes_the_lead(message):
+    route = route_rules(message)
+    assert route["intent"] == "email"
+    assert route["updates"] == {"email": "ana@example.com", "stage": "closed"}
+
+@pytest.mark.parametrize("message, intent", [
+    ("hola", "greeting"), ("Buenas tardes!", "greeting"), ("holaaa que tal", "greeting"),
+    ("gracias", "thanks"), ("ok muchas gracias", "thanks"),
+    ("ok", "ack"), ("de acuerdo", "ack"),
+    ("   ", "empty"),
+])
+def test_smalltalk_rules(message, intent):
+    route = route_rules(message)
+    assert route["intent"] == intent
+    assert not route["rag"]
+
+@pytest.mark.parametrize("message", [
+    "cuánto cuesta la instalación residencial", "hola, cuánto cuesta?", "mi correo es ana@example.com y quiero info",
+])
+def test_questions_are_not_caught_by_rules(message):
+    assert route_rules(message) is None
+
+def test_greeting_for_a_new_user_asks_for_the_name():
+    route = finalize_route(route_rules("hola"), SimpleNamespace(name=None, stage="onboarding"), [])
+    assert "nombre" in route["reply"]
+
+def test_personal_data_detection():
+    assert mentions_personal_data("me llamo Ana, cuánto cuesta?")
+    assert mentions_personal_data("mi número es 5512345678")
+    assert not mentions_personal_data("cuánto cuesta la instalación")
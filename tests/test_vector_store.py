@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from vector_store import NumpyStore, normalize_filters, merge_filters, matches_nothing
+
+DIM = 16
+
+def corpus(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(n, DIM)).astype(np.float32)
+    return [(f"p{i}", vectors[i], {"source": f"doc{i % 3}.pdf", "page": i}) for i in range(n)], vectors
+
+@pytest.mark.parametrize("quantization", ["none", "float16", "int8"])
+def test_block_scan_matches_a_single_pass(quantization):
+    points, _ = corpus()
+    query = np.random.default_rng(1).normal(size=DIM)
+    whole = NumpyStore(DIM, quantization=quantization, block=10_000)
+    blocks = NumpyStore(DIM, quantization=quantization, block=7)  # Bloques que no dividen n
+    for store in (whole, blocks):
+        store.upsert(points)
+    for filters in (None, normalize_filters({"source": "doc1.pdf", "page": (50, 250)})):
+        expected = [h["id"] for h in whole.search(query, 5, filters)]
+        assert [h["id"] for h in blocks.search(query, 5, filters)] == expected
+
+def test_block_scan_is_exact_without_quantization():
+    points, vectors = corpus()
+    query = np.random.default_rng(2).normal(size=DIM).astype(np.float32)
+    store = NumpyStore(DIM, block=16)
+    store.upsert(points)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = [f"p{i}" for i in np.argsort(-(normalized @ query))[:3]]
+    assert [h["id"] for h in store.search(query, 3)] == expected
+
+def test_batch_publishes_one_snapshot_at_the_end():
+    points, _ = corpus(90)
+    store = NumpyStore(DIM, quantization="int8")
+    store.upsert(points[:30])
+    before = store.state
+    with store.batch():
+        for start in range(30, 90, 20):
+            store.upsert(points[start:start + 20])
+        store.delete_source("doc0.pdf")
+        store.set_payload("doc1.pdf", {"doc_type": "manual"})
+        # Quien escribe ve sus cambios; las búsquedas siguen sobre el snapshot anterior
+        assert store.count() == 60 and store.count("doc0.pdf") == 0
+        assert store.state is before
+    assert store.count() == 60
+    assert len(store.state["quant"]) == 60
+    assert {h["doc_type"] for h in store.search(points[1][1], 3, normalize_filters({"source": "doc1.pdf"}))} == {"manual"}
+
+def test_payload_only_batch_reuses_the_matrix():
+    points, _ = corpus(30)
+    store = NumpyStore(DIM, quantization="int8")
+    store.upsert(points)
+    quant = store.state["quant"]
+    store.set_payload("doc2.pdf", {"doc_type": "faq"})
+    assert store.state["quant"] is quant
+    assert store.points("doc2.pdf")["p2"]["doc_type"] == "faq"
+
+def test_persisted_index_reloads_the_same_results(tmp_path):
+    points, _ = corpus()
+    store = NumpyStore(DIM, quantization="int8", path=str(tmp_path))
+    with store.batch():
+        store.upsert(points)
+    store.persist()
+    reloaded = NumpyStore(DIM, quantization="int8", path=str(tmp_path), block=32)
+    query = points[5][1]
+    assert [h["id"] for h in reloaded.search(query, 3)] == [h["id"] for h in store.search(query, 3)]
+    assert reloaded.search(query, 1)[0]["id"] == "p5"
+
+def test_request_filters_cannot_widen_the_tenant_filters():
+    tenant = {"doc_type": ["catalogos"], "page": (1, 20)}
+    assert merge_filters(tenant, {"doc_type": "manuales"}) == (("doc_type", ()), ("page", (1, 20)))
+    assert matches_nothing(merge_filters(tenant, {"doc_type": "manuales"}))
+    assert merge_filters(tenant, {"doc_type": ["catalogos", "manuales"], "page": (5, 40)}) == \
+        (("doc_type", ("catalogos",)), ("page", (5, 20)))
+    assert matches_nothing(merge_filters(tenant, {"page": (30, None)}))
+
+def test_empty_request_values_do_not_filter():
+    tenant = {"doc_type": ["catalogos"]}
+    request = {"source": None, "doc_type": None, "page": (None, None)}
+    assert merge_filters(tenant, request) == (("doc_type", ("catalogos",)),)
+    assert merge_filters({}, request) is None
+    assert merge_filters(tenant, None) == merge_filters(tenant)
+    assert not matches_nothing(None)
+
+def test_impossible_filters_match_no_points():
+    points, _ = corpus(30)
+    store = NumpyStore(DIM)
+    store.upsert(points)
+    filters = merge_filters({"source": "doc0.pdf"}, {"source": "doc1.pdf"})
+    assert store.search(points[0][1], 3, filters) == []
@@ -1,8 +1,10 @@
-import smtplib
 import os
 import json
-from email.mime.text import MIMEText
-from sqlalchemy.orm import Session
+import asyncio
+from sqlalchemy.ext.asyncio import AsyncSession
+from outbox import email_outbox
+
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", 10))  # Segundos por defecto si la tool no define el suyo
 
 # 1. Definición para OpenAI
 tools_schema = [
@@ -39,41 +41,79 @@ tools_schema = [
     }
 ]
 
-# 2. Lógica Python
-
-def send_email_action(to_email, subject, body):
-    sender = os.getenv("EMAIL_SENDER")
-    password = os.getenv("EMAIL_PASSWORD")
-    
-    if not sender or not password:
-        return "Error: Credenciales de correo no configuradas en el servidor."
+# Metadatos propios de cada tool (OpenAI rechaza claves extra dentro de tools_schema):
+#   - needs_feedback: el modelo necesita ver el resultado para responder (consultas).
+#     Las de solo efecto (guardar datos, encolar un correo) no: si la primera respuesta
+#     ya trae texto, nos ahorramos la segunda llamada.
+#   - timeout: segundos antes de darla por fallida.
+tools_meta = {
+    "update_lead_info": {"needs_feedback": False, "timeout": 2},
+    "send_email": {"needs_feedback": False, "timeout": 5},
+}
+tool_stats = {"calls": 0, "errors": 0, "timeouts": 0, "followups": 0, "followups_skipped": 0}
 
-    msg = MIMEText(body)
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = to_email
+# 2. Lógica Python
 
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(sender, password)
-            server.send_message(msg)
-        return "Correo enviado exitosamente."
-    except Exception as e:
-        return f"Error enviando correo: {str(e)}"
+def apply_lead_updates(user, args):
+    # También lo usa el router cuando extrae el nombre / correo sin pasar por el LLM
+    if "name" in args: user.name = args["name"]
+    if "email" in args: user.email = args["email"]
+    if "stage" in args: user.stage = args["stage"]
+    # Sin commit aquí: el cambio se confirma junto con los mensajes en save_messages
+    # (un solo commit por turno)
+    return "Información actualizada en base de datos."
 
-def execute_tool(tool_call, db: Session, user):
+async def execute_tool(tool_call, db: AsyncSession, user):
     fn_name = tool_call.function.name
     args = json.loads(tool_call.function.arguments)
     print(f"🛠️ Ejecutando Tool: {fn_name} | Args: {args}")
 
     if fn_name == "update_lead_info":
-        if "name" in args: user.name = args["name"]
-        if "email" in args: user.email = args["email"]
-        if "stage" in args: user.stage = args["stage"]
-        db.commit()
-        return "Información actualizada en base de datos."
+        return apply_lead_updates(user, args)
 
     elif fn_name == "send_email":
-        return send_email_action(args["to_email"], args["subject"], args["body"])
+        # Se encola en el outbox y responde al instante; el envío SMTP lo hace el worker
+        if not email_outbox.configured():
+            return "Error: Credenciales de correo no configuradas en el servidor."
+        email_id = await email_outbox.enqueue(args["to_email"], args["subject"], args["body"], user_id=user.id)
+        return f"Correo encolado para envío (id {email_id})."
     
-    return "Herramienta no encontrada"
\ No newline at end of file
+    return "Herramienta no encontrada"
+
+async def run_tool(tool_call, db: AsyncSession, user):
+    # (resultado, ok). Un error o timeout no tumba el turno: el resultado se lo
+    # devolvemos al modelo como texto
+    name = tool_call.function.name
+    timeout = tools_meta.get(name, {}).get("timeout", TOOL_TIMEOUT)
+    tool_stats["calls"] += 1
+    try:
+        result = await asyncio.wait_for(execute_tool(tool_call, db, user), timeout=timeout)
+    except asyncio.TimeoutError:
+        tool_stats["timeouts"] += 1
+        print(f"⏱️ Tool {name} superó {timeout}s.")
+        return f"Error: la herramienta {name} tardó demasiado.", False
+    except Exception as e:
+        tool_stats["errors"] += 1
+        print(f"⚠️ Tool {name} falló: {e}")
+        return f"Error ejecutando {name}: {e}", False
+    ok = not str(result).startswith("Error")
+    if not ok: tool_stats["errors"] += 1
+    return result, ok
+
+async def run_tools_parallel(tool_calls, db: AsyncSession, user):
+    # Todas a la vez; el orden de los resultados es el de las tool calls.
+    # Ojo: comparten la sesión `db`, así que ninguna tool debe ejecutar queries
+    # con ella (update_lead_info solo modifica el objeto; el outbox usa su propia sesión).
+    return await asyncio.gather(*(run_tool(t, db, user) for t in tool_calls))
+
+def needs_followup(first_text, tool_calls, results):
+    # ¿Hace falta la segunda llamada al modelo?
+    if not (first_text or "").strip():
+        return True
+    for tool, (_, ok) in zip(tool_calls, results):
+        if not ok or tools_meta.get(tool.function.name, {}).get("needs_feedback", True):
+            return True
+    return False
+
+def record_followup(needed: bool):
+    tool_stats["followups" if needed else "followups_skipped"] += 1
@@ -0,0 +1,399 @@
+import os
+import json
+import warnings
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+# Backends vectoriales intercambiables detrás de rag.init_vector_db / rag.search_hits.
+# Ambos exponen la misma interfaz mínima:
+#   ensure() / points(source) / count(source) / upsert(points) / delete_ids(ids)
+#   delete_source(source) / set_payload(source, values) / search(vector, limit, filters) / persist()
+#   batch(): agrupa las escrituras de una sincronización (NumPy arma el snapshot una sola vez)
+# donde points = [(id, vector, payload)] y search devuelve [{**payload, "id", "score"}].
+# qdrant_client tarda más de un segundo en importarse: solo se carga si se usa ese backend.
+
+# Filtros de búsqueda (los campos tienen índice de payload en Qdrant y columnas en NumPy):
+#   {"source": "a.pdf" | [...], "doc_type": ..., "tenant": ..., "page": (desde, hasta)}
+KEYWORD_FIELDS = ("tenant", "doc_type", "source")
+RANGE_FIELDS = ("page",)
+MISSING = -1  # Valor de columna para un campo numérico ausente (no cumple ningún rango)
+
+def normalize_filters(filters):
+    # Forma canónica y hasheable (sirve de clave de caché); None = sin filtro
+    if not filters: return None
+    unknown = set(filters) - set(KEYWORD_FIELDS) - set(RANGE_FIELDS)
+    if unknown:
+        raise ValueError(f"Filtro desconocido: {', '.join(sorted(unknown))}")
+    out = {}
+    for field in KEYWORD_FIELDS:
+        value = filters.get(field)
+        if value:
+            out[field] = tuple(sorted({value} if isinstance(value, str) else set(value)))
+    for field in RANGE_FIELDS:
+        value = filters.get(field)
+        if value and (value[0] is not None or value[1] is not None):
+            out[field] = (value[0], value[1])
+    return tuple(sorted(out.items())) or None
+
+def merge_filters(*filters):
+    # Intersección (AND) de varios filtros, p.ej. los fijos del tenant y los del pedido:
+    # cada uno solo puede achicar el resultado, nunca reemplazar al otro. Los valores vacíos
+    # (None, "") no filtran. Un campo puede quedar sin valores posibles: ver matches_nothing
+    out = {}
+    for current in filters:
+        for field, value in normalize_filters(current) or ():
+            if field not in out:
+                out[field] = value
+            elif field in RANGE_FIELDS:
+                lows = [v for v in (out[field][0], value[0]) if v is not None]
+                highs = [v for v in (out[field][1], value[1]) if v is not None]
+                out[field] = (max(lows) if lows else None, min(highs) if highs else None)
+            else:
+                out[field] = tuple(sorted(set(out[field]) & set(value)))
+    return tuple(sorted(out.items())) or None
+
+def matches_nothing(filters):
+    # Intersección vacía: ningún valor permitido o un rango invertido
+    for field, value in filters or ():
+        if field in RANGE_FIELDS:
+            if value[0] is not None and value[1] is not None and value[0] > value[1]: return True
+        elif not value:
+            return True
+    return False
+
+def payload_matches(payload, filters):
+    # El mismo filtro evaluado en Python (índice BM25)
+    for field, value in filters or ():
+        if field in RANGE_FIELDS:
+            current = payload.get(field)
+            if current is None or (value[0] is not None and current < value[0]) or (value[1] is not None and current > value[1]):
+                return False
+        elif payload.get(field) not in value:
+            return False
+    return True
+
+class QdrantStore:
+    def __init__(self, client, collection: str, dim: int):
+        from qdrant_client import models
+        self.models = models
+        self.client = client
+        self.collection = collection
+        self.dim = dim
+        self.persistent = False
+        self.indexed = False
+
+    def ensure(self):
+        if not self.client.collection_exists(self.collection):
+            self.client.create_collection(
+                collection_name=self.collection,
+                vectors_config=self.models.VectorParams(size=self.dim, distance=self.models.Distance.COSINE),
+            )
+        if not self.indexed:
+            # Índices de payload: con filtro, Qdrant recorre solo los puntos que cumplen
+            # en lugar de filtrar después de buscar en toda la colección
+            schema = self.client.get_collection(self.collection).payload_schema or {}
+            types = {**{f: self.models.PayloadSchemaType.KEYWORD for f in KEYWORD_FIELDS},
+                     **{f: self.models.PayloadSchemaType.INTEGER for f in RANGE_FIELDS}}
+            with warnings.catch_warnings():
+                # Qdrant local (":memory:" / QDRANT_PATH) avisa que los índices no tienen efecto ahí
+                warnings.simplefilter("ignore", UserWarning)
+                for field, field_type in types.items():
+                    if field not in schema:
+                        self.client.create_payload_index(self.collection, field_name=field, field_schema=field_type)
+            self.indexed = True
+
+    def build_filter(self, filters):
+        models = self.models
+        must = []
+        for field, value in filters or ():
+            if field in RANGE_FIELDS:
+                must.append(models.FieldCondition(key=field, range=models.Range(gte=value[0], lte=value[1])))
+            elif len(value) == 1:
+                must.append(models.FieldCondition(key=field, match=models.MatchValue(value=value[0])))
+            else:
+                must.append(models.FieldCondition(key=field, match=models.MatchAny(any=list(value))))
+        return models.Filter(must=must) if must else None
+
+    def source_filter(self, source):
+        return self.build_filter(normalize_filters({"source": source}))
+
+    def points(self, source):
+        # {id: payload} de un documento (sin traer los vectores)
+        found, offset = {}, None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection, scroll_filter=self.source_filter(source),
+                limit=1024, offset=offset, with_payload=True, with_vectors=False,
+            )
+            found.update((str(p.id), p.payload) for p in points)
+            if offset is None:
+                return found
+
+    def count(self, source=None):
+        count_filter = self.source_filter(source) if source else None
+        return self.client.count(self.collection, count_filter=count_filter, exact=True).count
+
+    def upsert(self, points):
+        self.client.upsert(
+            collection_name=self.collection,
+            points=[self.models.PointStruct(id=pid, vector=vec, payload=payload) for pid, vec, payload in points],
+        )
+
+    def delete_ids(self, ids):
+        self.client.delete(collection_name=self.collection, points_selector=self.models.PointIdsList(points=list(ids)))
+
+    def delete_source(self, source):
+        self.client.delete(collection_name=self.collection, points_selector=self.models.FilterSelector(filter=self.source_filter(source)))
+
+    def set_payload(self, source, values):
+        self.client.set_payload(collection_name=self.collection, payload=values, points=self.source_filter(source))
+
+    def search(self, vector, limit=3, filters=None):
+        points = self.client.query_points(collection_name=self.collection, query=vector, limit=limit,
+                                          query_filter=self.build_filter(filters)).points
+        return [{**p.payload, "id": str(p.id), "score": p.score} for p in points]
+
+    @contextmanager
+    def batch(self):
+        yield  # Cada upsert ya es una escritura independiente en Qdrant
+
+    def persist(self):
+        pass  # Qdrant persiste solo (QDRANT_PATH / QDRANT_URL)
+
+# Índice en memoria con NumPy: una matriz contigua de vectores normalizados,
+# top-k con UN producto matriz-vector. Opcionalmente cuantizado (float16 / int8):
+# se busca sobre la versión cuantizada, se toman k * oversample candidatos y se
+# re-puntúan con los float32 (que pueden vivir en disco vía memmap).
+# La matriz se recorre por bloques de `block` filas: el producto convierte cada bloque
+# int8 / float16 a float32, y así el temporal queda acotado (block x dim) sin importar n.
+
+def quantize(matrix, mode):
+    if mode == "float16":
+        return matrix.astype(np.float16), None
+    if mode == "int8":
+        # Escala simétrica por fila: q = round(v / s), s = max|v| / 127
+        scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.zeros(0, dtype=np.float32)
+        scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales
+    return None, None
+
+class NumpyStore:
+    def __init__(self, dim: int, quantization="none", path=None, oversample=4, block=2048):
+        if quantization not in ("none", "float16", "int8"):
+            raise ValueError(f"Cuantización desconocida: {quantization} (none, float16, int8)")
+        self.dim = dim
+        self.quantization = quantization
+        self.path = path
+        self.oversample = oversample
+        self.block = max(1, block)
+        self.persistent = bool(path)
+        self.lock = threading.Lock()  # Escrituras; las búsquedas leen un snapshot sin bloquear
+        self.draft = None  # Escrituras pendientes dentro de batch()
+        self.state = self.build([], [], np.zeros((0, dim), dtype=np.float32))
+        if path and os.path.exists(os.path.join(path, "meta.json")):
+            self.load()
+
+    def build(self, ids, payloads, full):
+        # Snapshot inmutable: se reemplaza entero en cada escritura (copy-on-write)
+        quant, scales = quantize(full, self.quantization)
+        return {"ids": ids, "payloads": payloads, "rows": {pid: i for i, pid in enumerate(ids)},
+                "full": full, "quant": quant, "scales": scales, "columns": columns(payloads)}
+
+    def ensure(self):
+        pass
+
+    def current(self):
+        # Quien escribe ve sus escrituras pendientes (index_document lee points / count a mitad de sync)
+        draft = self.draft
+        return draft if draft is not None else self.state
+
+    def points(self, source):
+        state = self.current()
+        return {pid: p for pid, p in zip(state["ids"], state["payloads"]) if p.get("source") == source}
+
+    def count(self, source=None):
+        state = self.current()
+        if source is None: return len(state["ids"])
+        return sum(1 for p in state["payloads"] if p.get("source") == source)
+
+    @contextmanager
+    def batch(self):
+        # Las escrituras se acumulan en un borrador (listas de filas, sin copiar la matriz)
+        # y el snapshot (matriz contigua + cuantización) se arma UNA vez al salir.
+        # Anidado (o cada upsert suelto) reutiliza el borrador abierto.
+        if self.draft is not None:
+            yield self.draft
+            return
+        with self.lock:
+            state = self.state
+            self.draft = {"ids": list(state["ids"]), "payloads": list(state["payloads"]),
+                          "vectors": list(state["full"]), "rows": dict(state["rows"]),
+                          "vectors_changed": False, "payloads_changed": False}
+        try:
+            yield self.draft
+        finally:
+            with self.lock:
+                draft, self.draft = self.draft, None
+                if draft["vectors_changed"]:
+                    full = np.asarray(draft["vectors"], dtype=np.float32).reshape(-1, self.dim)
+                    self.state = self.build(draft["ids"], draft["payloads"], full)
+                elif draft["payloads_changed"]:
+                    # Solo cambian payloads: vectores y cuantización se reutilizan tal cual
+                    self.state = {**self.state, "payloads": draft["payloads"], "columns": columns(draft["payloads"])}
+
+    def upsert(self, points):
+        if not points: return
+        vectors = np.asarray([vec for _, vec, _ in points], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)  # Coseno = producto punto
+        with self.batch() as draft, self.lock:
+            for (pid, _, payload), vec in zip(points, vectors):
+                pid = str(pid)
+                row = draft["rows"].get(pid)
+                if row is None:
+                    draft["rows"][pid] = len(draft["ids"])
+                    draft["ids"].append(pid)
+                    draft["payloads"].append(payload)
+                    draft["vectors"].append(vec)
+                else:
+                    draft["vectors"][row] = vec
+                    draft["payloads"][row] = payload
+            draft["vectors_changed"] = True
+
+    def delete_where(self, drop):
+        with self.batch() as draft, self.lock:
+            keep = [i for i, (pid, p) in enumerate(zip(draft["ids"], draft["payloads"])) if not drop(pid, p)]
+            if len(keep) == len(draft["ids"]): return
+            for key in ("ids", "payloads", "vectors"):
+                draft[key] = [draft[key][i] for i in keep]
+            draft["rows"] = {pid: i for i, pid in enumerate(draft["ids"])}
+            draft["vectors_changed"] = True
+
+    def delete_ids(self, ids):
+        ids = set(map(str, ids))
+        self.delete_where(lambda pid, p: pid in ids)
+
+    def delete_source(self, source):
+        self.delete_where(lambda pid, p: p.get("source") == source)
+
+    def set_payload(self, source, values):
+        with self.batch() as draft, self.lock:
+            draft["payloads"] = [{**p, **values} if p.get("source") == source else p for p in draft["payloads"]]
+            draft["payloads_changed"] = True
+
+    def mask(self, state, filters):
+        cols = state["columns"]
+        mask = np.ones(len(state["ids"]), dtype=bool)
+        for field, value in filters:
+            if field in RANGE_FIELDS:
+                mask &= cols[field] != MISSING
+                if value[0] is not None: mask &= cols[field] >= value[0]
+                if value[1] is not None: mask &= cols[field] <= value[1]
+            else:
+                mask &= np.isin(cols[field], value)
+        return mask
+
+    def search(self, vector, limit=3, filters=None):
+        state = self.state
+        n = len(state["ids"])
+        if n == 0: return []
+        q = np.array(vector, dtype=np.float32)
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+
+        # Con filtro se puntúan solo las filas que cumplen (máscara sobre las columnas de payload)
+        subset = np.flatnonzero(self.mask(state, filters)) if filters else None
+        if subset is not None and len(subset) == 0: return []
+
+        if state["quant"] is None:
+            rows, final = scan(state["full"], q, limit, self.block, subset)
+        else:
+            candidates, _ = scan(state["quant"], q, limit * self.oversample, self.block, subset, state["scales"])
+            # Re-scoring exacto (float32) solo de los candidatos
+            exact = state["full"][candidates] @ q
+            order = np.argsort(-exact)[:limit]
+            rows, final = candidates[order], exact[order]
+
+        return [{**state["payloads"][i], "id": state["ids"][i], "score": float(score)} for i, score in zip(rows, final)]
+
+    def persist(self):
+        # vectors.npy (float32) + quant.npy / scales.npy + meta.json, escritos en
+        # archivos temporales y renombrados para que una caída no deje el índice a medias
+        if not self.path: return
+        os.makedirs(self.path, exist_ok=True)
+
+        def save(name, array):
+            tmp = os.path.join(self.path, name + ".tmp.npy")
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(self.path, name + ".npy"))
+
+        with self.lock:
+            state = self.state
+            save("vectors", state["full"])
+            if state["quant"] is not None: save("quant", state["quant"])
+            if state["scales"] is not None: save("scales", state["scales"])
+            tmp = os.path.join(self.path, "meta.json.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "quantization": self.quantization,
+                           "ids": state["ids"], "payloads": state["payloads"]}, f)
+            os.replace(tmp, os.path.join(self.path, "meta.json"))
+            # upsert / delete dejan la matriz entera en RAM: se vuelve a abrir desde disco
+            # (memory-mapped, como en load) para que solo quede residente la cuantizada
+            self.state = {**state, "full": np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")}
+            if state["quant"] is not None:
+                self.state["quant"] = np.load(os.path.join(self.path, "quant.npy"), mmap_mode="r")
+
+    def load(self):
+        with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        # float32 memory-mapped: solo se leen de disco las filas que se re-puntúan
+        full = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")
+        state = {"ids": meta["ids"], "payloads": meta["payloads"], "rows": {pid: i for i, pid in enumerate(meta["ids"])},
+                 "full": full, "quant": None, "scales": None, "columns": columns(meta["payloads"])}
+        if meta["quantization"] == self.quantization and self.quantization != "none":
+            state["quant"] = np.load(os.path.join(self.path, "quant.npy"), mmap_mode="r")
+            if self.quantization == "int8":
+                state["scales"] = np.load(os.path.join(self.path, "scales.npy"))
+        elif self.quantization != "none":
+            state["quant"], state["scales"] = quantize(np.asarray(full), self.quantization)
+        self.state = state
+
+    def memory_bytes(self):
+        # Lo que queda residente: la matriz que se recorre en cada búsqueda cuenta siempre;
+        # los float32 memory-mapped solo se leen para re-puntuar candidatos, no cuentan
+        state = self.state
+        scanned = [a for a in (state["quant"], state["scales"]) if a is not None]
+        if not isinstance(state["full"], np.memmap) or state["quant"] is None:
+            scanned.append(state["full"])
+        return sum(a.nbytes for a in scanned)
+
+def columns(payloads):
+    # Campos filtrables como arrays (una comparación vectorizada en lugar de recorrer dicts)
+    cols = {f: np.asarray([str(p.get(f) or "") for p in payloads], dtype=str) for f in KEYWORD_FIELDS}
+    for f in RANGE_FIELDS:
+        cols[f] = np.asarray([p.get(f) if p.get(f) is not None else MISSING for p in payloads], dtype=np.int64)
+    return cols
+
+def scan(matrix, q, k, block, subset=None, scales=None):
+    # Top-k (filas absolutas, puntajes) recorriendo `matrix` (o solo las filas de `subset`)
+    # de a `block` filas, con un top-k acumulado entre bloques
+    n = len(matrix) if subset is None else len(subset)
+    best_rows, best_scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    for start in range(0, n, block):
+        if subset is None:
+            rows = np.arange(start, min(start + block, n))
+            scores = matrix[start:start + block] @ q
+        else:
+            rows = subset[start:start + block]
+            scores = matrix[rows] @ q
+        if scales is not None:
+            scores *= scales[rows]
+        rows = np.concatenate([best_rows, rows])
+        scores = np.concatenate([best_scores, scores])
+        keep = top_k(scores, k)
+        best_rows, best_scores = rows[keep], scores[keep]
+    return best_rows, best_scores
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]